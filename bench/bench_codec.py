@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 比较大块数据在csurpc调用中的CPU消耗(每GB数据消耗的CPU秒数),
+    分别测试老的传输方式(每个连接一个调用)、mux方式(数据在pickle中)、mux加带外数据段(oob)方式
+
+运行方法: python bench/bench_codec.py [-s 块大小KB] [-n 传输总量MB]
+"""
+
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import csurpc  # noqa: E402
+
+
+class _BenchHandle:
+    def __init__(self, block_size):
+        self.block = b'r' * block_size
+
+    def write_block(self, _file_path, offset, data):
+        # 模拟os_write_file,只返回写入的长度
+        return 0, offset + len(data)
+
+    def read_block(self, _file_path, _offset, _read_len):
+        # 模拟os_read_file
+        return 0, self.block
+
+
+def _start_server(block_size, use_epoll):
+    exit_flag = [False]
+    srv = csurpc.Server('bench', _BenchHandle(block_size), lambda: exit_flag[0], password='bench',
+                        thread_count=4, use_epoll=use_epoll)
+    srv.bind('tcp://127.0.0.1:0')
+    port = srv.ss.getsockname()[1]
+    t = threading.Thread(target=srv.run)
+    t.daemon = True
+    t.start()
+    time.sleep(0.2)  # 等待服务开始监听
+    return exit_flag, t, port
+
+
+def bench_one(mode, direction, block_size, total_size):
+    """
+    :param mode: 'legacy'、'mux'或'oob'
+    :param direction: 'write'表示数据在参数中(如os_write_file),'read'表示数据在返回值中(如os_read_file)
+    :return: (每GB的CPU秒数, MB/s)
+    """
+    exit_flag, t, port = _start_server(block_size, mode != 'legacy')
+    client = csurpc.Client()
+    client.connect(f"tcp://127.0.0.1:{port}", password='bench')
+    if mode == 'mux':
+        client.trans.oob = False
+
+    block = b'w' * block_size
+    count = max(1, total_size // block_size)
+    start_cpu = time.process_time()
+    start_time = time.time()
+    for i in range(count):
+        if direction == 'write':
+            client.write_block('/tmp/bench', i * block_size, block)
+        else:
+            client.read_block('/tmp/bench', i * block_size, block_size)
+    used_cpu = time.process_time() - start_cpu
+    used_time = time.time() - start_time
+
+    client.close()
+    exit_flag[0] = True
+    t.join(3)
+    gb = count * block_size / (1024 * 1024 * 1024)
+    return used_cpu / gb, count * block_size / used_time / (1024 * 1024)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-s", "--block-size", action="store", type="int", dest="block_kb", default=4096,
+                      help="Block size in KB, default is 4096")
+    parser.add_option("-n", "--total", action="store", type="int", dest="total_mb", default=2048,
+                      help="Total MB to transfer for each case, default is 2048")
+    (options, _args) = parser.parse_args()
+
+    block_size = options.block_kb * 1024
+    total_size = options.total_mb * 1024 * 1024
+    print(f"block size: {options.block_kb}KB, total: {options.total_mb}MB")
+    print(f"{'mode':>8} {'direction':>10} {'cpu s/GB':>10} {'MB/s':>10}")
+    for direction in ['write', 'read']:
+        for mode in ['legacy', 'mux', 'oob']:
+            cpu_per_gb, mbps = bench_one(mode, direction, block_size, total_size)
+            print(f"{mode:>8} {direction:>10} {cpu_per_gb:>10.3f} {mbps:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: csurpc的压力测试: 在本机回环地址上启动一个Server,用N个客户端、每个客户端M个并发调用去压测,
+    测试不同大小的数据(在参数中或在返回值中)的每秒调用次数、MB/s、延迟的p50/p99,以及每次调用消耗的CPU。
+    结果可以输出为json文件,与之前的结果比较,用于发现cs_low_trans收发包或pickle处理的性能回退。
+
+运行方法: python bench/bench_csurpc.py [-c 客户端数] [-m 每个客户端的并发数] [-t 秒数] [-o 结果.json] [-b 基准.json]
+    CPU是整个进程(包括服务端和客户端)消耗的CPU。
+    加上--extra-fds 1100时,先打开1100个文件描述符,使所有socket的文件描述符都大于1024,验证收发包不受select()的限制
+"""
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import csurpc  # noqa: E402
+
+# 默认测试的数据大小
+DEFAULT_SIZE_LIST = [0, 1024, 64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024]
+
+# 每个测试至少完成的调用次数,大的数据在测试时间内可能只能完成几次调用
+MIN_CALLS = 3
+
+
+class _BenchHandle:
+    def __init__(self):
+        self.block_dict = {}
+        self.mutex = threading.Lock()
+
+    def write_block(self, data):
+        # 数据在参数中,模拟os_write_file
+        return 0, len(data)
+
+    def read_block(self, size):
+        # 数据在返回值中,模拟os_read_file,同样大小的数据只生成一次
+        self.mutex.acquire()
+        try:
+            block = self.block_dict.get(size)
+            if block is None:
+                block = b'r' * size
+                self.block_dict[size] = block
+        finally:
+            self.mutex.release()
+        return 0, block
+
+
+def _percentile(sorted_list, p):
+    if not sorted_list:
+        return 0
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * p))]
+
+
+def _get_git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+        return out.stdout.decode().strip()
+    except OSError:
+        return ''
+
+
+def _open_extra_fds(count):
+    """
+    先打开count个文件描述符,后面创建的socket的文件描述符都会比它们大
+    :return: 打开的文件描述符的列表
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = count + 1024
+    if soft != resource.RLIM_INFINITY and soft < need:
+        if hard != resource.RLIM_INFINITY:
+            need = min(need, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (need, hard))
+    return [os.open(os.devnull, os.O_RDONLY) for _i in range(count)]
+
+
+def _start_server(use_epoll, thread_count):
+    exit_flag = [False]
+    srv = csurpc.Server('bench', _BenchHandle(), lambda: exit_flag[0], password='bench',
+                        thread_count=thread_count, use_epoll=use_epoll)
+    srv.bind('tcp://127.0.0.1:0')
+    port = srv.ss.getsockname()[1]
+    t = threading.Thread(target=srv.run)
+    t.daemon = True
+    t.start()
+    time.sleep(0.2)  # 等待服务开始监听
+    return exit_flag, t, port, srv.ss.fileno()
+
+
+def _run_slot(client, direction, size, payload, end_time, latency_list, err_list):
+    """
+    一个并发调用: 在测试时间内不停地发起同步调用
+    """
+    calls = 0
+    while calls < MIN_CALLS or time.time() < end_time:
+        start_time = time.time()
+        try:
+            if direction == 'write':
+                client.write_block(payload)
+            else:
+                client.read_block(size)
+        except Exception as e:
+            err_list.append(str(e))
+            return
+        latency_list.append(time.time() - start_time)
+        calls += 1
+
+
+def bench_one(port, use_epoll, direction, size, clients, inflight, max_inflight_mb, seconds):
+    """
+    测试一种数据大小
+    :param direction: 'write'表示数据在参数中,'read'表示数据在返回值中
+    :param clients: 客户端数,mux模式下每个客户端一个连接,连接上同时有inflight个调用
+    :param inflight: 每个客户端的并发调用数,老的传输方式下每个并发调用使用单独的连接
+    :param max_inflight_mb: 所有并发调用的数据总量的上限,大的数据会减少并发数,避免内存不够
+    :return: dict, 测试的结果
+    """
+    slots = clients * inflight
+    if size:
+        slots = max(1, min(slots, max_inflight_mb * 1024 * 1024 // size))
+
+    client_list = []
+    for _i in range(clients if use_epoll else slots):
+        client = csurpc.Client()
+        client.connect(f"tcp://127.0.0.1:{port}", password='bench')
+        client_list.append(client)
+
+    payload = b'w' * size if direction == 'write' else None
+    latency_list = []
+    err_list = []
+    start_cpu = time.process_time()
+    start_time = time.time()
+    end_time = start_time + seconds
+    thread_list = []
+    for i in range(slots):
+        t = threading.Thread(target=_run_slot, args=(client_list[i % len(client_list)], direction, size, payload,
+                                                      end_time, latency_list, err_list))
+        t.daemon = True
+        t.start()
+        thread_list.append(t)
+    for t in thread_list:
+        t.join()
+    used_time = time.time() - start_time
+    used_cpu = time.process_time() - start_cpu
+    for client in client_list:
+        client.close()
+    if err_list:
+        raise Exception(f"call failed: {err_list[0]}")
+
+    calls = len(latency_list)
+    latency_list.sort()
+    return {
+        "direction": direction,
+        "size": size,
+        "clients": min(clients, slots),
+        "inflight": slots,
+        "calls": calls,
+        "calls_per_sec": round(calls / used_time, 1),
+        "mb_per_sec": round(calls * size / used_time / (1024 * 1024), 1),
+        "p50_ms": round(_percentile(latency_list, 0.5) * 1000, 3),
+        "p99_ms": round(_percentile(latency_list, 0.99) * 1000, 3),
+        "cpu_us_per_call": round(used_cpu / calls * 1000000, 1),
+    }
+
+
+def _case_key(item):
+    return item['direction'], item['size']
+
+
+def compare_with_baseline(result_list, baseline_file, max_regress):
+    """
+    与之前的结果比较,每秒调用次数下降超过max_regress或每次调用的CPU上升超过max_regress时认为有回退
+    :return: 回退的测试个数
+    """
+    with open(baseline_file) as fp:
+        baseline = json.load(fp)
+    base_dict = {_case_key(item): item for item in baseline['results']}
+    regress_count = 0
+    print(f"\ncompare with {baseline_file} (commit: {baseline['meta'].get('commit', '')}):")
+    print(f"{'direction':>9} {'size':>10} {'calls/s':>10} {'cpu/call':>10}")
+    for item in result_list:
+        base = base_dict.get(_case_key(item))
+        if base is None or not base['calls_per_sec'] or not base['cpu_us_per_call']:
+            continue
+        rate_change = item['calls_per_sec'] / base['calls_per_sec'] - 1
+        cpu_change = item['cpu_us_per_call'] / base['cpu_us_per_call'] - 1
+        is_regress = rate_change < -max_regress or cpu_change > max_regress
+        if is_regress:
+            regress_count += 1
+        print(f"{item['direction']:>9} {item['size']:>10} {rate_change:>+10.1%} {cpu_change:>+10.1%}"
+              f"{'  REGRESS' if is_regress else ''}")
+    return regress_count
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-c", "--clients", action="store", type="int", dest="clients", default=4,
+                      help="Number of clients, default is 4")
+    parser.add_option("-m", "--inflight", action="store", type="int", dest="inflight", default=4,
+                      help="Concurrent calls of each client, default is 4")
+    parser.add_option("-t", "--time", action="store", type="float", dest="seconds", default=2,
+                      help="Seconds for each case, default is 2")
+    parser.add_option("-s", "--sizes", action="store", type="string", dest="sizes", default='',
+                      help="Comma separated payload sizes in bytes, default is 0,1K,64K,1M,16M,64M")
+    parser.add_option("-d", "--direction", action="store", type="string", dest="direction", default='write,read',
+                      help="Comma separated directions: write (data in args) and read (data in result)")
+    parser.add_option("-l", "--legacy", action="store_true", dest="legacy", default=False,
+                      help="Use the thread mode server, each concurrent call uses its own connection")
+    parser.add_option("--extra-fds", action="store", type="int", dest="extra_fds", default=0,
+                      help="Open this many file descriptors before the test, so that all sockets use fds above them")
+    parser.add_option("--max-inflight-mb", action="store", type="int", dest="max_inflight_mb", default=512,
+                      help="Limit of the total payload of concurrent calls, default is 512")
+    parser.add_option("-o", "--output", action="store", type="string", dest="output", default='',
+                      help="Write the results to this json file")
+    parser.add_option("-b", "--baseline", action="store", type="string", dest="baseline", default='',
+                      help="Compare with the results in this json file, exit with 1 if regressed")
+    parser.add_option("--max-regress", action="store", type="float", dest="max_regress", default=0.1,
+                      help="Allowed regression when comparing with the baseline, default is 0.1")
+    (options, _args) = parser.parse_args()
+
+    if options.sizes:
+        size_list = [int(item) for item in options.sizes.split(',')]
+    else:
+        size_list = DEFAULT_SIZE_LIST
+    direction_list = [item.strip() for item in options.direction.split(',') if item.strip()]
+    use_epoll = not options.legacy
+    thread_count = options.clients * options.inflight
+    extra_fd_list = _open_extra_fds(options.extra_fds)
+    exit_flag, t, port, listen_fd = _start_server(use_epoll, thread_count)
+    if extra_fd_list:
+        print(f"opened {len(extra_fd_list)} extra fds, listen fd is {listen_fd}")
+
+    result_list = []
+    print(f"{'direction':>9} {'size':>10} {'inflight':>8} {'calls':>8} {'calls/s':>10} {'MB/s':>8} "
+          f"{'p50(ms)':>9} {'p99(ms)':>9} {'cpu(us)':>9}")
+    for direction in direction_list:
+        for size in size_list:
+            item = bench_one(port, use_epoll, direction, size, options.clients, options.inflight,
+                             options.max_inflight_mb, options.seconds)
+            result_list.append(item)
+            print(f"{direction:>9} {size:>10} {item['inflight']:>8} {item['calls']:>8} {item['calls_per_sec']:>10} "
+                  f"{item['mb_per_sec']:>8} {item['p50_ms']:>9} {item['p99_ms']:>9} {item['cpu_us_per_call']:>9}")
+    exit_flag[0] = True
+    t.join(3)
+    for fd in extra_fd_list:
+        os.close(fd)
+
+    report = {
+        "meta": {
+            "commit": _get_git_commit(),
+            "time": time.strftime('%Y-%m-%d %H:%M:%S'),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "server": 'thread' if options.legacy else 'epoll',
+            "clients": options.clients,
+            "inflight": options.inflight,
+            "seconds": options.seconds,
+            "extra_fds": options.extra_fds,
+        },
+        "results": result_list,
+    }
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    if options.baseline:
+        if compare_with_baseline(result_list, options.baseline, options.max_regress):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
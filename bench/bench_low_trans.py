@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: cs_low_trans收发包的性能测试,在本机回环地址上测试不同大小的包的吞吐量(MB/s)
+
+运行方法: python bench/bench_low_trans.py [-t 秒数]
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import cs_low_trans  # noqa: E402
+
+FRAME_SIZE_LIST = [512 * 1024, 4 * 1024 * 1024, 64 * 1024 * 1024]
+
+
+def _echo_server(ss, reply_size):
+    """
+    收到一个包后,回复一个指定大小的包
+    """
+    sock, _addr = ss.accept()
+    reply_data = b'r' * reply_size
+    while True:
+        err, _msg, cmd, _data = cs_low_trans.recv_cmd(sock, 60)
+        if err or cmd < 0:
+            break
+        err, _msg = cs_low_trans.reply_cmd(sock, 0, reply_data, 60)
+        if err:
+            break
+    sock.close()
+
+
+def bench_one(frame_size, direction, seconds):
+    """
+    测试一种包大小
+    :param frame_size: 包的大小
+    :param direction: 'send'表示客户端发大包,服务端回复空包; 'recv'表示客户端发空包,服务端回复大包
+    :param seconds: 测试的时长
+    :return: (次数, MB/s)
+    """
+    ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ss.bind(('127.0.0.1', 0))
+    ss.listen(1)
+    port = ss.getsockname()[1]
+    reply_size = frame_size if direction == 'recv' else 0
+    t = threading.Thread(target=_echo_server, args=(ss, reply_size))
+    t.daemon = True
+    t.start()
+
+    sock = socket.create_connection(('127.0.0.1', port), 10)
+    send_data = b's' * frame_size if direction == 'send' else b''
+    count = 0
+    start_time = time.time()
+    while True:
+        err, msg, _ret_code, _ret_data = cs_low_trans.send_cmd(sock, 1, send_data, 60)
+        if err:
+            raise Exception(f"send_cmd failed: {msg}")
+        count += 1
+        used_time = time.time() - start_time
+        if used_time >= seconds:
+            break
+    cs_low_trans.send_cmd(sock, -1, b'', 1)
+    sock.close()
+    ss.close()
+    return count, count * frame_size / used_time / (1024 * 1024)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-t", "--time", action="store", type="float", dest="seconds", default=3,
+                      help="Seconds for each frame size, default is 3")
+    (options, _args) = parser.parse_args()
+
+    print(f"{'frame':>10} {'direction':>10} {'count':>8} {'MB/s':>10}")
+    for frame_size in FRAME_SIZE_LIST:
+        for direction in ['send', 'recv']:
+            count, mbps = bench_one(frame_size, direction, options.seconds)
+            print(f"{frame_size // 1024:>8}KB {direction:>10} {count:>8} {mbps:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
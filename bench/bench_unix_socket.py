@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 本机回环地址的tcp与unix套接字的比较,测试小调用的延迟,以及每次调用都新建连接(含验证)时的延迟
+
+运行方法: python bench/bench_unix_socket.py [-t 秒数]
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import csurpc  # noqa: E402
+
+
+class _BenchHandle:
+    def echo(self, data):
+        return data
+
+
+def _percentile(sorted_list, p):
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * p))]
+
+
+def bench_one(conn_url, reconnect, seconds):
+    """
+    测试一种连接方式
+    :param conn_url: 连接的url
+    :param reconnect: 为True时每次调用都新建连接
+    :param seconds: 测试的时长
+    :return: (次数, 平均延迟, p99延迟), 延迟的单位是微秒
+    """
+    data = b'x' * 64
+    elapsed_list = []
+    c = None
+    start_time = time.time()
+    while time.time() - start_time < seconds:
+        t = time.time()
+        if reconnect or c is None:
+            c = csurpc.Client()
+            c.connect(conn_url)
+        c.echo(data)
+        if reconnect:
+            c.close()
+        elapsed_list.append((time.time() - t) * 1000000)
+    if c is not None:
+        c.close()
+    elapsed_list.sort()
+    return len(elapsed_list), sum(elapsed_list) / len(elapsed_list), _percentile(elapsed_list, 0.99)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-t", "--time", action="store", type="float", dest="seconds", default=3,
+                      help="Seconds for each case, default is 3")
+    parser.add_option("-p", "--port", action="store", type="int", dest="port", default=24242,
+                      help="Tcp port used by the test server, default is 24242")
+    (options, _args) = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    unix_url = f"unix://{os.path.join(tmp_dir, 'bench.sock')}"
+    tcp_url = f"tcp://127.0.0.1:{options.port}"
+    is_exit = False
+    srv_list = []
+    for conn_url in [tcp_url, unix_url]:
+        srv = csurpc.Server('bench', _BenchHandle(), lambda: is_exit, thread_count=4, use_epoll=True)
+        srv.bind(conn_url)
+        t = threading.Thread(target=srv.run)
+        t.daemon = True
+        t.start()
+        srv_list.append(t)
+    time.sleep(0.5)
+
+    print(f"{'case':>12} {'url':>6} {'count':>8} {'avg(us)':>10} {'p99(us)':>10}")
+    for case, reconnect in [('call', False), ('connect+call', True)]:
+        for conn_url in [tcp_url, unix_url]:
+            count, avg_us, p99_us = bench_one(conn_url, reconnect, options.seconds)
+            print(f"{case:>12} {conn_url.split(':')[0]:>6} {count:>8} {avg_us:>10.1f} {p99_us:>10.1f}")
+
+    is_exit = True
+    for t in srv_list:
+        t.join()
+    os.rmdir(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
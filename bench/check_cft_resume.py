@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 检查源端agent重启后csu_file_trans.trans_dir能否从断点续传: 在子进程中启动一个agent(同时作为源端和目标端),
+    传输过程中断点清单记录了大文件的位置后杀掉agent再重新启动,trans_dir重新连接后应调用resume_cft从断点续传,
+    最后检查目标端的文件与源端一致,并且重启后写入的数据量不超过断点之后剩余的数据量。
+
+运行方法: python bench/check_cft_resume.py [--file-count 4] [--file-size 96]
+    全部通过时输出OK,返回0,否则输出失败的原因,返回1
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from optparse import SUPPRESS_HELP, OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import config  # noqa: E402
+import csu_file_trans  # noqa: E402
+import csurpc  # noqa: E402
+import rpc_utils  # noqa: E402
+
+RPC_PASS = 'check'
+
+# 子进程agent中每写一块后休眠的时间,使传输不会在杀掉agent之前就完成了
+WRITE_BLOCK_DELAY = 0.01
+
+
+class _AgentHandle:
+    """
+    子进程agent中提供的cft相关的函数,与service_hander中的相同,另外统计写入的数据量
+    """
+    written_bytes = 0
+
+    @staticmethod
+    def create_cft(*args):
+        return csu_file_trans.create_cft(*args)
+
+    @staticmethod
+    def get_cft_state(cft_id):
+        return csu_file_trans.get_cft_state(cft_id)
+
+    @staticmethod
+    def resume_cft(cft_id):
+        return csu_file_trans.resume_cft(cft_id)
+
+    @staticmethod
+    def remove_cft(cft_id):
+        return csu_file_trans.remove_cft(cft_id)
+
+    @staticmethod
+    def cft_batch_cmd(req_list):
+        return csu_file_trans.cft_batch_cmd(req_list)
+
+    @staticmethod
+    def set_file_attr(file_path, attr):
+        return csu_file_trans.set_file_attr(file_path, attr)
+
+    @staticmethod
+    def cft_open_file(file_path):
+        return csu_file_trans.cft_open_file(file_path)
+
+    @staticmethod
+    def cft_write_block(handle, offset, data):
+        _AgentHandle.written_bytes += len(data)
+        time.sleep(WRITE_BLOCK_DELAY)
+        return csu_file_trans.cft_write_block(handle, offset, data)
+
+    @staticmethod
+    def cft_close_file(handle, attr=None, file_size=None):
+        return csu_file_trans.cft_close_file(handle, attr, file_size)
+
+    @staticmethod
+    def cft_file_checksums(file_path, block_size, offset=0, length=-1):
+        return csu_file_trans.cft_file_checksums(file_path, block_size, offset, length)
+
+    @staticmethod
+    def cft_get_manifest(dir_path):
+        return csu_file_trans.cft_get_manifest(dir_path)
+
+    @staticmethod
+    def get_file_size(file_path):
+        if not os.path.exists(file_path):
+            return -1
+        return os.path.getsize(file_path)
+
+    @staticmethod
+    def get_written_bytes():
+        return _AgentHandle.written_bytes
+
+
+def run_agent(port, data_path):
+    """
+    子进程中运行的agent,直到被杀掉
+    """
+    config.set_key('agent_rpc_port', port)
+    config.set_key('internal_rpc_pass', RPC_PASS)
+    config.set_key('my_ip', '127.0.0.1')
+    # config中没有设置数据目录的函数,断点清单放在检查用的临时目录中
+    setattr(config, '__data_path', data_path)
+    srv = csurpc.Server('check-agent', _AgentHandle(), lambda: False, password=RPC_PASS, thread_count=16,
+                        use_epoll=True)
+    srv.bind(f'tcp://127.0.0.1:{port}')
+    srv.run()
+
+
+def start_agent(port, data_path):
+    cmd = [sys.executable, os.path.abspath(__file__), '--agent', '--port', str(port), '--data-path', data_path]
+    proc = subprocess.Popen(cmd)
+    for _i in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise Exception("agent did not start")
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def make_src_dir(src_dir, file_count, file_size):
+    for i in range(file_count):
+        with open(os.path.join(src_dir, f'big{i}'), 'wb') as fp:
+            fp.write(os.urandom(file_size))
+    for i in range(20):
+        with open(os.path.join(src_dir, f'small{i}'), 'wb') as fp:
+            fp.write(os.urandom(1000 * i))
+
+
+def dir_digest(dir_path):
+    ret = {}
+    for name in sorted(os.listdir(dir_path)):
+        with open(os.path.join(dir_path, name), 'rb') as fp:
+            ret[name] = hashlib.sha256(fp.read()).hexdigest()
+    return ret
+
+
+def get_ckpt_bytes(ckpt_file):
+    """
+    :return: 断点清单中记录的大文件已确认写入的字节数
+    """
+    if not os.path.exists(ckpt_file):
+        return 0
+    pos_dict = {}
+    with open(ckpt_file) as fp:
+        for line in fp.read().splitlines()[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # 正在写的最后一行
+            if 'pos' in record:
+                path, start, pos = record['pos']
+                pos_dict[(path, start)] = max(pos_dict.get((path, start), start), pos) - start
+    return sum(pos_dict.values())
+
+
+def check_resume(tmp_dir, file_count, file_size):
+    """
+    :return: 失败的原因的列表
+    """
+    src_dir = os.path.join(tmp_dir, 'src')
+    dst_dir = os.path.join(tmp_dir, 'dst')
+    data_path = os.path.join(tmp_dir, 'data')
+    for path in [src_dir, dst_dir, data_path]:
+        os.mkdir(path)
+    make_src_dir(src_dir, file_count, file_size)
+    total_size = sum(os.path.getsize(os.path.join(src_dir, name)) for name in os.listdir(src_dir))
+
+    port = get_free_port()
+    config.set_key('internal_rpc_pass', RPC_PASS)
+    proc = start_agent(port, data_path)
+    err_list = []
+    try:
+        err_code, rpc = rpc_utils.get_rpc_connect('127.0.0.1', port)
+        if err_code != 0:
+            return [rpc]
+        result = []
+
+        def run_trans():
+            result.append(csu_file_trans.trans_dir(rpc, src_dir, '127.0.0.1', dst_dir, None,
+                                                   connect_func=lambda: rpc_utils.get_rpc_connect('127.0.0.1', port)))
+        t = threading.Thread(target=run_trans)
+        t.daemon = True
+        t.start()
+
+        # 等断点清单中记录了大文件的位置后杀掉agent
+        ckpt_bytes = 0
+        ckpt_dir = os.path.join(data_path, 'cft')
+        start_time = time.time()
+        while not ckpt_bytes and time.time() - start_time < 120:
+            time.sleep(0.1)
+            for name in os.listdir(ckpt_dir) if os.path.isdir(ckpt_dir) else []:
+                ckpt_bytes = get_ckpt_bytes(os.path.join(ckpt_dir, name))
+        if not ckpt_bytes:
+            return ["no position was recorded in the checkpoint manifest"]
+        proc.send_signal(signal.SIGKILL)
+        proc.wait()
+        if ckpt_bytes >= total_size:
+            return ["the job finished before the agent was killed, use a bigger --file-size"]
+        time.sleep(1)
+        proc = start_agent(port, data_path)
+
+        t.join(600)
+        if t.is_alive():
+            return ["trans_dir did not finish"]
+        err_code, err_msg = result[0]
+        if err_code != 0:
+            return [f"trans_dir failed after the agent restart: {err_msg}"]
+        if dir_digest(src_dir) != dir_digest(dst_dir):
+            err_list.append("destination files do not match the source")
+        err_code, rpc2 = rpc_utils.get_rpc_connect('127.0.0.1', port)
+        if err_code != 0:
+            return err_list + [rpc2]
+        try:
+            written_bytes = rpc2.get_written_bytes()
+        finally:
+            rpc2.close()
+        # 断点之前已确认写入的数据不应再传输
+        if written_bytes > total_size - ckpt_bytes:
+            err_list.append(f"{written_bytes} bytes were written after the restart, but only "
+                            f"{total_size - ckpt_bytes} bytes were left after the checkpoint")
+        print(f"checkpoint at kill: {ckpt_bytes} of {total_size} bytes, written after restart: {written_bytes} bytes")
+    finally:
+        proc.kill()
+        proc.wait()
+    return err_list
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--file-count", action="store", type="int", dest="file_count", default=4,
+                      help="Number of big files in the source directory, default is 4")
+    parser.add_option("--file-size", action="store", type="int", dest="file_size", default=96,
+                      help="Size of each big file in MB, default is 96")
+    parser.add_option("--agent", action="store_true", dest="agent", default=False, help=SUPPRESS_HELP)
+    parser.add_option("--port", action="store", type="int", dest="port", default=0, help=SUPPRESS_HELP)
+    parser.add_option("--data-path", action="store", type="string", dest="data_path", help=SUPPRESS_HELP)
+    (options, _args) = parser.parse_args()
+
+    if options.agent:
+        run_agent(options.port, options.data_path)
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        err_list = check_resume(tmp_dir, options.file_count, options.file_size * 1024 * 1024)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if err_list:
+        for err in err_list:
+            print(f"FAILED: {err}")
+        sys.exit(1)
+    print("OK: the job was resumed from the checkpoint after the source agent restarted")
+
+
+if __name__ == '__main__':
+    main()
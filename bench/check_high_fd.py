@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: 检查文件描述符大于1024时csurpc是否正常: 先调大RLIMIT_NOFILE并打开1100个文件描述符,
+    使后面创建的所有socket的文件描述符都大于1024(select()在这时会出错),然后分别对线程模式和事件循环模式的服务端,
+    通过tcp和unix套接字做普通调用、大数据的调用、并发的异步调用、批量调用和流式调用。
+
+运行方法: python bench/check_high_fd.py [--extra-fds 1100]
+    全部通过时输出OK,返回0,否则输出失败的项目,返回1
+"""
+
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+import csurpc  # noqa: E402
+
+FD_SETSIZE = 1024
+
+
+class _CheckHandle:
+    def echo(self, data):
+        return data
+
+    def gen(self, count):
+        for i in range(count):
+            yield i
+
+
+def _open_extra_fds(count):
+    """
+    调大RLIMIT_NOFILE后打开count个文件描述符,后面创建的socket的文件描述符都会比它们大
+    :return: 打开的文件描述符的列表
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    need = count + 1024
+    if soft != resource.RLIM_INFINITY and soft < need:
+        if hard != resource.RLIM_INFINITY and hard < need:
+            raise Exception(f"RLIMIT_NOFILE hard limit {hard} is less than {need}, run as root or raise it")
+        resource.setrlimit(resource.RLIMIT_NOFILE, (need, hard))
+    return [os.open(os.devnull, os.O_RDONLY) for _i in range(count)]
+
+
+def check_client(conn_url, use_epoll):
+    """
+    对一个服务端做各种调用
+    :return: 失败的项目的列表
+    """
+    err_list = []
+    c = csurpc.Client(call_timeout=30)
+    c.connect(conn_url, password='check')
+    try:
+        fd = c.trans.sock.fileno()
+        if fd <= FD_SETSIZE:
+            err_list.append(f"client fd {fd} is not greater than {FD_SETSIZE}")
+        if c.echo(b'x' * 100) != b'x' * 100:
+            err_list.append("small call returned wrong data")
+        big = os.urandom(8 * 1024 * 1024)
+        if c.echo(big) != big:
+            err_list.append("8MB call returned wrong data")
+        if use_epoll:
+            future_list = [c.echo(i, async_mode=True) for i in range(50)]
+            if [future.get(30) for future in future_list] != list(range(50)):
+                err_list.append("concurrent async calls returned wrong data")
+            with c.batch() as b:
+                r1 = b.echo(1)
+                r2 = b.echo(2)
+            if (r1.get(), r2.get()) != (1, 2):
+                err_list.append("batch call returned wrong data")
+            if list(c.gen(100)) != list(range(100)):
+                err_list.append("stream call returned wrong data")
+    finally:
+        c.close()
+    return err_list
+
+
+def check_server(use_epoll, tmp_dir):
+    """
+    启动一个同时监听tcp和unix套接字的服务端,检查通过两种方式的调用
+    :return: 失败的项目的列表
+    """
+    exit_flag = [False]
+    srv = csurpc.Server('check', _CheckHandle(), lambda: exit_flag[0], password='check', thread_count=8,
+                        use_epoll=use_epoll)
+    srv.bind('tcp://127.0.0.1:0')
+    port = srv.ss.getsockname()[1]
+    unix_path = os.path.join(tmp_dir, f"check-{int(use_epoll)}.sock")
+    srv.bind(f"unix://{unix_path}")
+    t = threading.Thread(target=srv.run)
+    t.daemon = True
+    t.start()
+    time.sleep(0.2)  # 等待服务开始监听
+
+    mode = 'epoll' if use_epoll else 'thread'
+    err_list = []
+    for ss in srv.ss_list:
+        if ss.fileno() <= FD_SETSIZE:
+            err_list.append(f"{mode}: listen fd {ss.fileno()} is not greater than {FD_SETSIZE}")
+    for conn_url in [f"tcp://127.0.0.1:{port}", f"unix://{unix_path}"]:
+        try:
+            err_list += [f"{mode} {conn_url}: {err}" for err in check_client(conn_url, use_epoll)]
+        except Exception as e:
+            err_list.append(f"{mode} {conn_url}: {repr(e)}")
+    if use_epoll:
+        conn_fd_list = list(srv.conn_dict)
+        if [fd for fd in conn_fd_list if fd <= FD_SETSIZE]:
+            err_list.append(f"{mode}: server connection fds {conn_fd_list} are not all greater than {FD_SETSIZE}")
+
+    exit_flag[0] = True
+    t.join(10)
+    if t.is_alive():
+        err_list.append(f"{mode}: server did not stop")
+    return err_list
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--extra-fds", action="store", type="int", dest="extra_fds", default=1100,
+                      help="Number of fds opened before the test, default is 1100")
+    (options, _args) = parser.parse_args()
+
+    extra_fd_list = _open_extra_fds(options.extra_fds)
+    tmp_dir = tempfile.mkdtemp()
+    err_list = []
+    try:
+        for use_epoll in [False, True]:
+            err_list += check_server(use_epoll, tmp_dir)
+    finally:
+        for fd in extra_fd_list:
+            os.close(fd)
+        os.rmdir(tmp_dir)
+
+    if err_list:
+        for err in err_list:
+            print(f"FAILED: {err}")
+        sys.exit(1)
+    print(f"OK: opened {len(extra_fd_list)} extra fds, all calls passed on the thread and epoll servers")
+
+
+if __name__ == '__main__':
+    main()
@@ -153,27 +153,30 @@ def thread_func_pipe_out_cmd(cmd_dict):
         logging.error(f"{pre_msg} failed: can not connect {src_host}: {repr(e)}!")
         return -1, repr(e)
 
-    logging.info(f"{pre_msg} begin run {dst_cmd} ...")
-    callback = PipeCmdCallback(rpc, cmd_id)
-    err_code, err_msg = run_cmd_readout(dst_cmd, callback.stdout, callback.stderr)
-    if err_code != 0:
-        logging.info(f"{pre_msg} failed: {err_msg}")
-
     try:
-        req = {}
-        req['type'] = 'CLOSE'
-        req['err_code'] = err_code
+        logging.info(f"{pre_msg} begin run {dst_cmd} ...")
+        callback = PipeCmdCallback(rpc, cmd_id)
+        err_code, err_msg = run_cmd_readout(dst_cmd, callback.stdout, callback.stderr)
         if err_code != 0:
-            req['err_msg'] = err_msg
+            logging.info(f"{pre_msg} failed: {err_msg}")
 
-        err_code, err_msg = rpc.chp_send_pipe_out_data(cmd_id, req, b'')
-        if err_code != 0:
-            err_msg = f"pipe_out_cmd(cmd_id={cmd_id} call rpc.chp_send_pipe_out_data error: {err_msg}"
+        try:
+            req = {}
+            req['type'] = 'CLOSE'
+            req['err_code'] = err_code
+            if err_code != 0:
+                req['err_msg'] = err_msg
+
+            err_code, err_msg = rpc.chp_send_pipe_out_data(cmd_id, req, b'')
+            if err_code != 0:
+                err_msg = f"pipe_out_cmd(cmd_id={cmd_id} call rpc.chp_send_pipe_out_data error: {err_msg}"
+                logging.error(err_msg)
+        except Exception as e:
+            err_code = -1
+            err_msg = f"pipe_out_cmd(cmd_id={cmd_id} unknown error: {repr(e)}"
             logging.error(err_msg)
-    except Exception as e:
-        err_code = -1
-        err_msg = f"pipe_out_cmd(cmd_id={cmd_id} unknown error: {repr(e)}"
-        logging.error(err_msg)
+    finally:
+        rpc.close()
 
     __lock.acquire()
     try:
@@ -22,8 +22,9 @@
 @description: RPC调用的底层数据包传输模块
 """
 
-import errno
 import hashlib
+import hmac
+import os
 import random
 import select
 import socket
@@ -35,74 +36,256 @@ from typing import Tuple
 magic = b'UHSGNEHCCPR'
 magic_len = len(magic)
 
+# 包头: magic + 命令(或返回码) + 包体长度
+header_fmt = "!%dsiI" % magic_len
+header_len = struct.calcsize(header_fmt)
+
 CMD_AUTH = 0
 
+# 用会话票据恢复验证,代替CMD_AUTH。这是带扩展头的命令,call_id为0,包体是之前验证成功时服务端给的票据,
+# 加上用票据密钥(由密码和票据计算得到,不在网络上传输)对这次连接的验证挑战做的HMAC。
+# 客户端发出此命令后不等待应答,马上可以发后面的调用
+CMD_RESUME = 1
 
-def send_data(sock: socket, data: bytes, timeout:int) -> Tuple[int, str]:
+# 会话票据: 过期时间(8字节,服务端的时间戳) + 随机串(16字节) + HMAC-SHA256(32字节)
+ticket_fmt = "!Q16s"
+ticket_head_len = struct.calcsize(ticket_fmt)
+ticket_len = ticket_head_len + hashlib.sha256().digest_size
+
+# CMD_RESUME中票据后面的HMAC的长度
+resume_proof_len = hashlib.sha256().digest_size
+
+# SO_PEERCRED取到的对端进程信息: pid, uid, gid
+peercred_fmt = "3i"
+
+# 扩展包在包体的最前面带一个扩展头: 调用ID(call_id)和标志位(flags),
+# 通过call_id,一个连接上可以同时有多个调用,服务端的响应也可以乱序返回
+ext_header_fmt = "!QI"
+ext_header_len = struct.calcsize(ext_header_fmt)
+
+# 扩展头中的标志位: 包体中带有带外(out-of-band)数据段。
+# 这时扩展头后面是: 数据段个数(4字节) + 各数据段的长度(每个8字节) + pickle数据 + 各数据段,
+# 大的bytes数据不放在pickle数据中,而是作为单独的数据段发送和接收,避免多次拷贝
+FLAG_OOB = 0x1
+
+# 扩展头中的标志位: 请求方能接收带外数据段,响应中可以使用FLAG_OOB
+FLAG_ACCEPT_OOB = 0x2
+
+# 扩展头中的标志位: 扩展头后面的数据已经用zlib压缩过了,接收方需要先解压
+FLAG_ZLIB = 0x4
+
+# 扩展头中的标志位: 请求方能接收压缩的数据,响应中可以使用FLAG_ZLIB
+FLAG_ACCEPT_ZLIB = 0x8
+
+# 扩展头中的标志位: 流式响应中的一个数据块,同一个call_id会连续返回多个这样的响应
+FLAG_STREAM = 0x10
+
+# 扩展头中的标志位: 流式响应的最后一个包,不带数据,返回码不为0时包体是错误信息;
+# 在客户端发给服务端的CMD_STREAM_CREDIT中,表示取消这个流
+FLAG_STREAM_END = 0x20
+
+# 扩展头中的标志位: 请求方能接收流式响应,服务端函数返回生成器时可以分块返回
+FLAG_ACCEPT_STREAM = 0x40
+
+# 扩展头中的标志位: 扩展头后面紧跟着4字节的调用剩余时间(毫秒),然后才是其它数据。
+# 传的是剩余时间而不是绝对时间,服务端收到后换算成本地时间,这样两边的时钟不一致也没有关系
+FLAG_DEADLINE = 0x80
+
+deadline_fmt = "!I"
+deadline_len = struct.calcsize(deadline_fmt)
+
+# 扩展头中的标志位: 扩展头(以及调用剩余时间)后面是2字节的长度和被调用的函数名(utf-8,批量调用时用逗号分隔),
+# 然后才是其它数据。服务端不需要解开pickle数据就能按函数名决定由哪个线程池执行
+FLAG_FUNC_NAME = 0x100
+
+func_name_len_fmt = "!H"
+func_name_len_len = struct.calcsize(func_name_len_fmt)
+func_name_max_len = 0xFFFF
+
+# 一个包的最大长度,超过时认为包格式错误,避免按对端发来的长度分配过大的内存
+MAX_FRAME_LEN = 256 * 1024 * 1024
+
+# 验证之前的包(CMD_AUTH、CMD_RESUME)的最大长度,这时还不知道对端是谁,只接收很小的包
+AUTH_MAX_LEN = 4096
+
+# 接收数据时预先分配的缓冲区的最大长度,更长的数据随着接收逐步扩大缓冲区,
+# 这样对端发来的长度再大,占用的内存也不会超过实际收到的数据量的两倍
+RECV_PREALLOC_MAX = 16 * 1024 * 1024
+
+# 接收包体时至少等待的时间(秒)
+BODY_TIMEOUT_MIN = 2
+
+# 按包体长度估算接收时间时,假定的最低传输速率(字节/秒)
+BODY_MIN_RATE = 1024 * 1024
+
+oob_count_fmt = "!I"
+oob_count_len = struct.calcsize(oob_count_fmt)
+oob_seg_len_fmt = "!Q"
+oob_seg_len_len = struct.calcsize(oob_seg_len_fmt)
+
+
+def _buf_len(buf) -> int:
+    if isinstance(buf, memoryview):
+        return buf.nbytes
+    return len(buf)
+
+
+def _poll_ms(timeout) -> float:
     """
-    发送数据,会把所有的数据发送完
+    把超时时间(秒)转换为poll()使用的毫秒数,None表示一直等待
+    """
+    if timeout is None:
+        return None
+    return max(timeout * 1000, 0)
+
+
+def wait_readable(sock: socket, timeout) -> bool:
+    """
+    等待socket可读。使用poll()而不是select(),文件描述符大于等于1024时也可以使用
+    :param timeout: 超时时间,单位秒,None表示一直等待
+    :return: True表示可读(或连接已断开),False表示超时
+    """
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    return bool(poller.poll(_poll_ms(timeout)))
+
+
+def send_buffers(sock: socket, buf_list: list, timeout: int) -> Tuple[int, str]:
+    """
+    把多段数据用sendmsg一次发送出去(scatter/gather),不需要先把各段数据拼接起来
     :param sock    : socket对象
-    :param data    : 要发送的数据
+    :param buf_list: 要发送的数据段的列表,每一段是bytes、bytearray或memoryview
     :param timeout : 超时时间
     :return: 返回值有两个,第一个是错误码,0表示成功, 1表示超时,-1表示出错,第二个是错误信息
     :rtype : int, string
     """
 
-    left_size = len(data)
-    read_list = []
-    write_list = [sock]
-    while left_size > 0:
+    view_list = [memoryview(buf).cast('B') for buf in buf_list if _buf_len(buf) > 0]
+    # 用poll()等待可写,没有select()对文件描述符不能大于等于1024的限制。一个包只注册一次。
+    # 非阻塞的socket先直接发送,发不出去时才等待;有超时的socket先等待,避免阻塞超过timeout
+    poller = None
+    need_wait = sock.gettimeout() != 0
+    while view_list:
+        if need_wait:
+            if poller is None:
+                poller = select.poll()
+                poller.register(sock, select.POLLOUT)
+            if not poller.poll(_poll_ms(timeout)):
+                return 1, 'timeout'
         try:
-            _rs, ws, _es = select.select(read_list, write_list, read_list, timeout)
-        except select.error as e:
-            if e.args[0] == errno.EINTR:  # 这是收到信号打断了select函数
-                continue
-            return -1, repr(e)
-        if not ws:
-            return 1, 'timeout'
-        try:
-            ret = sock.send(data)
+            ret = sock.sendmsg(view_list)
+        except (BlockingIOError, InterruptedError):
+            need_wait = True
+            continue
         except socket.error as e:
             return -1, e.strerror
-        left_size -= ret
-        if left_size > 0:
-            data = data[ret:]
+        # 去掉已经发送完的数据段,部分发送的数据段只保留没有发送的部分
+        while ret > 0:
+            first_len = view_list[0].nbytes
+            if ret >= first_len:
+                ret -= first_len
+                view_list.pop(0)
+            else:
+                view_list[0] = view_list[0][ret:]
+                ret = 0
     return 0, ''
 
 
-def recv_data(sock: socket, need_len: int, timeout: int) -> Tuple[int, str, bytes]:
+def calc_body_timeout(data_len: int, timeout: float) -> float:
+    """
+    按包体的长度估算接收包体的超时时间
+    :param data_len: 包体的长度
+    :param timeout: 允许的最长时间,通常是调用剩余的时间
+    :return: 超时时间,单位秒
+    """
+    return max(min(timeout, BODY_TIMEOUT_MIN + data_len / BODY_MIN_RATE), 0.001)
+
+
+def pack_deadline(data, timeout: float) -> list:
     """
-    接收数据,直到接收到指定长度的数据才会返回
+    在包体前面加上调用的剩余时间,发送时扩展头中需要带上FLAG_DEADLINE
+    :param data: bytes或者是数据段的列表
+    :param timeout: 调用的剩余时间,单位秒
+    :return: 数据段的列表,可以直接传给send_cmd_ex()
+    """
+    remain_ms = min(max(int(timeout * 1000), 0), 0xFFFFFFFF)
+    if isinstance(data, (list, tuple)):
+        return [struct.pack(deadline_fmt, remain_ms)] + list(data)
+    return [struct.pack(deadline_fmt, remain_ms), data]
+
+
+def pack_func_name(data, func_name: str) -> list:
+    """
+    在包体前面加上被调用的函数名,发送时扩展头中需要带上FLAG_FUNC_NAME
+    :param data: bytes或者是数据段的列表
+    :param func_name: 函数名,批量调用时是用逗号分隔的多个函数名
+    :return: 数据段的列表,可以直接传给send_cmd_ex(),函数名太长时返回None
+    """
+    raw = func_name.encode('utf-8')
+    if len(raw) > func_name_max_len:
+        return None
+    if isinstance(data, (list, tuple)):
+        return [struct.pack(func_name_len_fmt, len(raw)), raw] + list(data)
+    return [struct.pack(func_name_len_fmt, len(raw)), raw, data]
+
+
+def send_data(sock: socket, data: bytes, timeout:int) -> Tuple[int, str]:
+    """
+    发送数据,会把所有的数据发送完
+    :param sock    : socket对象
+    :param data    : 要发送的数据
+    :param timeout : 超时时间
+    :return: 返回值有两个,第一个是错误码,0表示成功, 1表示超时,-1表示出错,第二个是错误信息
+    :rtype : int, string
+    """
+
+    return send_buffers(sock, [data], timeout)
+
+
+def recv_data(sock: socket, need_len: int, timeout: int) -> Tuple[int, str, bytearray]:
+    """
+    接收数据,直到接收到指定长度的数据才会返回。数据直接接收到预先分配好的bytearray中,不需要多次拼接,
+    但预先分配的长度不超过RECV_PREALLOC_MAX,更长的数据在收满后再加倍扩大缓冲区
     :param sock    : socket对象
     :param need_len: 要接收数据的长度
     :param timeout : 超时时间
     :return: 返回值有三个,第一个是错误码,0表示成功, 1表示超时,-1表示出错,第二个是错误信息,第三个是接收到的数据
-    :rtype : (int, string, bytes)
+    :rtype : (int, string, bytearray)
     """
 
     recv_size = 0
-    data = b''
-    read_list = [sock]
-    write_list = []
+    data = bytearray(min(need_len, RECV_PREALLOC_MAX))
+    view = memoryview(data)
+    # 与send_buffers()相同,用poll()等待可读,非阻塞的socket先直接接收
+    poller = None
+    need_wait = sock.gettimeout() != 0
 
     while recv_size < need_len:
+        if recv_size == len(data):
+            # 缓冲区已收满,说明对端确实在发这么多数据,加倍扩大缓冲区
+            view.release()
+            new_data = bytearray(min(need_len, recv_size * 2))
+            new_data[:recv_size] = data
+            data = new_data
+            view = memoryview(data)
+        if need_wait:
+            if poller is None:
+                poller = select.poll()
+                poller.register(sock, select.POLLIN)
+            if not poller.poll(_poll_ms(timeout)):
+                return 1, 'timeout', b''
         try:
-            rs, _ws, _es = select.select(read_list, write_list, read_list, timeout)
-        except select.error as e:
-            if e.args[0] == errno.EINTR:  # 这是收到信号打断了select函数
-                continue
-            return -1, repr(e), b''
-        if not rs:
-            return 1, 'timeout', b''
-        try:
-            segment = sock.recv(need_len - recv_size)
+            n = sock.recv_into(view[recv_size:])
+        except (BlockingIOError, InterruptedError):
+            need_wait = True
+            continue
         except socket.error as e:
-            return -1, e.strerror, data
-        if not segment:  # 没有接收到任何数据,则表明对方的socket可能关闭了
-            return -1, 'socket maybe closed', data
-        recv_size += len(segment)
-        data += segment
+            return -1, e.strerror, data[:recv_size]
+        if not n:  # 没有接收到任何数据,则表明对方的socket可能关闭了
+            return -1, 'socket maybe closed', data[:recv_size]
+        recv_size += n
 
+    view.release()
     return 0, '', data
 
 
@@ -120,22 +303,22 @@ def send_cmd(sock: socket, cmd: int, data: bytes, timeout: int) -> Tuple[int, st
     global magic
     global magic_len
 
-    len_data = len(data)
-    fmt = "!%dsiI%ds" % (magic_len, len_data)
-    raw = struct.pack(fmt, magic, cmd, len_data, data)
-    err, msg = send_data(sock, raw, timeout)
+    deadline = time.time() + timeout
+    len_data = _buf_len(data)
+    header = struct.pack(header_fmt, magic, cmd, len_data)
+    err, msg = send_buffers(sock, [header, data], timeout)
     if err:
         return err, msg, 0, b''
 
-    err, msg, raw = recv_data(sock, magic_len+8, timeout)
+    err, msg, raw = recv_data(sock, header_len, timeout)
     if err:
         return err, f'after send_cmd, recv reply header failed: {msg}', 0, b''
-    fmt = "!%dsiI" % magic_len
-    recv_magic, ret_code, data_len, = struct.unpack(fmt, raw)
+    recv_magic, ret_code, data_len, = struct.unpack(header_fmt, raw)
     if recv_magic != magic:
-        return -2, 'Invalid packet format!', -1, ''
+        return -2, 'Invalid packet format!', -1, b''
     if data_len > 0:
-        err, msg, raw = recv_data(sock, data_len, 2)
+        # 包体已经在路上了,按包体的长度等待,但不超过调用剩余的时间
+        err, msg, raw = recv_data(sock, data_len, calc_body_timeout(data_len, deadline - time.time()))
         if err:
             return err, f'after send_cmd, recv reply body(len={data_len}) failed: {msg}', 0, b''
     else:
@@ -143,25 +326,27 @@ def send_cmd(sock: socket, cmd: int, data: bytes, timeout: int) -> Tuple[int, st
     return 0, '', ret_code, raw
 
 
-def recv_cmd(sock: socket, timeout: int) -> Tuple[int, str, int, bytes]:
+def recv_cmd(sock: socket, timeout: int, max_len: int = None) -> Tuple[int, str, int, bytes]:
     """
     接收命令
     :param sock    : socket对象
     :param timeout : 超时时间
+    :param max_len : 包体的最大长度,超过时按包格式错误返回,为None时不限制
     :return: (err, msg, cmd, data), err是错误码,0表示成功, 1表示超时,-1表示出错,msg是错误信息, data是返回的数据
     :rtype : int, string, int, bytes
     """
     global magic
     global magic_len
 
-    err, msg, raw = recv_data(sock, magic_len+8, timeout)
+    err, msg, raw = recv_data(sock, header_len, timeout)
     if err:
         return err, msg, -1, b''
 
-    fmt = "!%dsiI" % magic_len
-    recv_magic, cmd, len_data, = struct.unpack(fmt, raw)
+    recv_magic, cmd, len_data, = struct.unpack(header_fmt, raw)
     if recv_magic != magic:
-        return -2, 'Invalid packet format!', ''
+        return -2, 'Invalid packet format!', -1, b''
+    if max_len is not None and len_data > max_len:
+        return -2, f'Invalid packet format: packet length {len_data} exceeds {max_len}!', -1, b''
 
     if len_data > 0:
         err, msg, raw = recv_data(sock, len_data, timeout)
@@ -186,17 +371,139 @@ def reply_cmd(sock: socket, ret_code: int, ret_data: bytes, timeout: int) -> Tup
     global magic
     global magic_len
 
-    data_len = len(ret_data)
-    if data_len > 0:
-        fmt = "!%dsiI%ds" % (magic_len, data_len)
-        raw = struct.pack(fmt, magic, ret_code, data_len, ret_data)
-    else:
-        fmt = "!%dsiI" % magic_len
-        raw = struct.pack(fmt, magic, ret_code, 0)
-    err, msg = send_data(sock, raw, timeout)
+    header = struct.pack(header_fmt, magic, ret_code, _buf_len(ret_data))
+    err, msg = send_buffers(sock, [header, ret_data], timeout)
     return err, msg
 
 
+def send_cmd_ex(sock: socket, cmd: int, call_id: int, flags: int, data: bytes, timeout: int) -> Tuple[int, str]:
+    """
+    发送带扩展头的命令或响应,只发送,不等待结果
+    :param sock    : socket对象
+    :param cmd     : 命令类型,如果是响应,则为返回码
+    :param call_id : 调用ID
+    :param flags   : 标志位
+    :param data    : 要发送的数据
+    :param timeout : 超时时间
+    :return: (err, msg), err是错误码,0表示成功, 1表示超时,-1表示出错,msg是错误信息
+    """
+
+    if isinstance(data, (list, tuple)):
+        buf_list = list(data)
+    else:
+        buf_list = [data]
+    data_len = sum([_buf_len(buf) for buf in buf_list])
+    header = struct.pack(header_fmt + "QI", magic, cmd, ext_header_len + data_len, call_id, flags)
+    return send_buffers(sock, [header] + buf_list, timeout)
+
+
+def pack_oob_segments(pickle_data: bytes, seg_list: list) -> list:
+    """
+    把pickle数据和带外数据段组成带FLAG_OOB标志的包体
+    :param pickle_data: pickle数据
+    :param seg_list: 带外数据段的列表
+    :return: 组成包体的数据段列表,可以直接传给send_cmd_ex()
+    """
+    table = struct.pack("!I%dQ" % len(seg_list), len(seg_list), *[_buf_len(seg) for seg in seg_list])
+    return [table, pickle_data] + seg_list
+
+
+def parse_oob_table(table: bytes, count: int, left_len: int) -> Tuple[int, list]:
+    """
+    解析带外数据段的长度表
+    :param table: 长度表的数据
+    :param count: 数据段的个数
+    :param left_len: 包体中长度表后面剩余的长度
+    :return: (pickle_len, seg_len_list)
+    """
+    seg_len_list = list(struct.unpack("!%dQ" % count, table))
+    pickle_len = left_len - sum(seg_len_list)
+    if pickle_len < 0:
+        raise ValueError('Invalid packet format: bad oob segment table!')
+    return pickle_len, seg_len_list
+
+
+def recv_cmd_ex(sock: socket, timeout: int, max_len: int = None) -> Tuple[int, str, int, int, int, bytes, list]:
+    """
+    接收带扩展头的命令或响应,带外数据段会分别接收到各自的bytearray中
+    :param sock    : socket对象
+    :param timeout : 超时时间
+    :param max_len : 包的最大长度,超过时按包格式错误返回,为None时不限制
+    :return: (err, msg, cmd, call_id, flags, data, seg_list), err是错误码,0表示成功, 1表示超时,-1表示出错,
+             msg是错误信息, data是扩展头后面的数据(有带外数据段时是pickle数据), seg_list是带外数据段的列表
+    """
+    err, msg, raw = recv_data(sock, header_len, timeout)
+    if err:
+        return err, msg, -1, 0, 0, b'', []
+
+    recv_magic, cmd, len_data, = struct.unpack(header_fmt, raw)
+    if recv_magic != magic:
+        return -2, 'Invalid packet format!', -1, 0, 0, b'', []
+    if len_data < ext_header_len:
+        return -2, 'Invalid packet format: ext header too short!', -1, 0, 0, b'', []
+    if max_len is not None and len_data > max_len:
+        return -2, f'Invalid packet format: packet length {len_data} exceeds {max_len}!', -1, 0, 0, b'', []
+
+    err, msg, raw = recv_data(sock, ext_header_len, timeout)
+    if err:
+        return err, msg, -1, 0, 0, b'', []
+    call_id, flags = struct.unpack(ext_header_fmt, raw)
+    left_len = len_data - ext_header_len
+
+    seg_len_list = []
+    if flags & FLAG_OOB:
+        err, msg, raw = recv_data(sock, oob_count_len, timeout)
+        if err:
+            return err, msg, -1, 0, 0, b'', []
+        count, = struct.unpack(oob_count_fmt, raw)
+        left_len -= oob_count_len + count * oob_seg_len_len
+        if left_len < 0:
+            return -2, 'Invalid packet format: bad oob segment count!', -1, 0, 0, b'', []
+        err, msg, raw = recv_data(sock, count * oob_seg_len_len, timeout)
+        if err:
+            return err, msg, -1, 0, 0, b'', []
+        try:
+            left_len, seg_len_list = parse_oob_table(raw, count, left_len)
+        except (ValueError, struct.error) as e:
+            return -2, str(e), -1, 0, 0, b'', []
+
+    data = b''
+    if left_len > 0:
+        err, msg, data = recv_data(sock, left_len, timeout)
+        if err:
+            return err, msg, -1, 0, 0, b'', []
+    seg_list = []
+    for seg_len in seg_len_list:
+        err, msg, seg = recv_data(sock, seg_len, timeout)
+        if err:
+            return err, msg, -1, 0, 0, b'', []
+        seg_list.append(seg)
+    return 0, '', cmd, call_id, flags, data, seg_list
+
+
+def unpack_ext_header(data: bytes) -> Tuple[int, int, memoryview]:
+    """
+    解析扩展包的包体
+    :param data: 收到的包体
+    :return: (call_id, flags, payload), payload是去掉扩展头后的数据
+    """
+    if len(data) < ext_header_len:
+        raise ValueError('Invalid packet format: ext header too short!')
+    call_id, flags = struct.unpack_from(ext_header_fmt, data)
+    return call_id, flags, memoryview(data)[ext_header_len:]
+
+
+def set_nodelay(sock: socket):
+    """
+    关闭tcp连接的Nagle算法。每个包都是一次发出的,不会有很多小的写操作,
+    而连续发出的两个小包(如CMD_RESUME后面跟着的调用)如果等待对端的ACK,会被延迟确认拖慢几十毫秒
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
 def connect(ip: str, port: int, password: str, conn_timeout: int, data_timeout: int) -> Tuple[int, str, object]:
     """
     客户端连接服务端进行验证
@@ -206,21 +513,32 @@ def connect(ip: str, port: int, password: str, conn_timeout: int, data_timeout:
     :param timeout:
     :return: (err, msg, sock)
     """
+    err, msg, sock, _reply_data = connect_ex(ip, port, password, conn_timeout, data_timeout)
+    return err, msg, sock
+
+
+def connect_ex(ip: str, port: int, password: str, conn_timeout: int, data_timeout: int) -> Tuple[int, str, object, bytes]:
+    """
+    客户端连接服务端进行验证,与connect()相同,但多返回服务端验证成功时回复的数据,
+    新版本的服务端会在这个数据中带上服务端支持的功能
+    :return: (err, msg, sock, reply_data)
+    """
 
     # sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
         # sock.connect((ip, port))
         sock = socket.create_connection((ip, port), conn_timeout)
     except Exception as e:
-        return -1, str(e), None
+        return -1, str(e), None, b''
+    set_nodelay(sock)
     err, msg, raw = recv_data(sock, magic_len+64, data_timeout)
     if err:
         sock.close()
-        return -1, msg, None
+        return -1, msg, None, b''
 
     if raw[:magic_len] != magic:
         sock.close()
-        return -2, 'Invalid packet format!', None
+        return -2, 'Invalid packet format!', None, b''
 
     # 把收到的字符串(服务端随机生成的)与本地的密码混合,然后做hash运算,把运算后的字符串(hash_str)发给服务端
     random_str = raw[magic_len:]
@@ -231,14 +549,199 @@ def connect(ip: str, port: int, password: str, conn_timeout: int, data_timeout:
     err, msg, ret_code, ret_data = send_cmd(sock, CMD_AUTH, raw, data_timeout)
     if err:
         sock.close()
-        return err, msg, None
+        return err, msg, None, b''
     # print "ret_code", ret_code, "ret_data", ret_data, "sock", sock
     if ret_code:
         sock.close()
-        return ret_code, ret_data, None
+        return ret_code, bytes(ret_data), None, b''
+    return 0, '', sock, ret_data
+
+
+def _ticket_mac(password: str, client_ip: str, ticket_head: bytes) -> bytes:
+    key = hashlib.sha256(b'csurpc-ticket\0' + password.encode('utf-8')).digest()
+    return hmac.new(key, ticket_head + client_ip.encode('utf-8'), hashlib.sha256).digest()
+
+
+def make_ticket_key(password: str, ticket: bytes) -> bytes:
+    """
+    由密码和票据得到这个票据的密钥,客户端和服务端各自计算,密钥不在网络上传输。
+    恢复验证时客户端用此密钥对服务端的验证挑战做HMAC,证明自己知道密码,只截获票据的人无法使用票据
+    """
+    key = hashlib.sha256(b'csurpc-ticket-key\0' + password.encode('utf-8')).digest()
+    return hmac.new(key, bytes(ticket), hashlib.sha256).digest()
+
+
+def make_resume_data(password: str, ticket: bytes, random_bytes: bytes) -> bytes:
+    """
+    生成CMD_RESUME命令的数据: 票据 + 用票据密钥对验证挑战中的随机串做的HMAC
+    :param password: 服务的密码
+    :param ticket: 之前验证成功时服务端给的票据
+    :param random_bytes: 这次连接时服务端发过来的验证挑战中的随机串
+    :return: CMD_RESUME命令的数据
+    """
+    proof = hmac.new(make_ticket_key(password, ticket), bytes(random_bytes), hashlib.sha256).digest()
+    return bytes(ticket) + proof
+
+
+def make_session_ticket(password: str, client_ip: str, ttl: int) -> bytes:
+    """
+    生成会话票据,客户端重连时用票据代替验证挑战的应答,服务端不需要再单独回复验证结果,
+    客户端发出票据后马上就可以发调用。
+    票据用密码做HMAC,并绑定客户端的ip,服务端不需要保存票据,密码修改后原来的票据都会失效
+    :param password: 服务的密码
+    :param client_ip: 客户端的ip地址
+    :param ttl: 票据的有效期,单位秒
+    :return: 票据
+    """
+    ticket_head = struct.pack(ticket_fmt, int(time.time()) + ttl, os.urandom(16))
+    return ticket_head + _ticket_mac(password, client_ip, ticket_head)
+
+
+def check_session_ticket(data: bytes, password: str, client_ip: str, random_bytes: bytes) -> Tuple[int, str]:
+    """
+    检查客户端CMD_RESUME命令中发过来的会话票据,以及用票据密钥对验证挑战做的HMAC
+    :param data: CMD_RESUME命令的数据,格式见make_resume_data()
+    :param password: 服务的密码
+    :param client_ip: 客户端的ip地址
+    :param random_bytes: 这次连接时发给客户端的验证挑战中的随机串
+    :return: (err, msg), err==0表示票据有效
+    """
+    if len(data) != ticket_len + resume_proof_len:
+        return -2, 'Invalid ticket format!'
+    ticket = bytes(data[:ticket_len])
+    ticket_head = ticket[:ticket_head_len]
+    if not hmac.compare_digest(ticket[ticket_head_len:], _ticket_mac(password, client_ip, ticket_head)):
+        return 1, 'Invalid ticket'
+    expire_time, _nonce = struct.unpack(ticket_fmt, ticket_head)
+    if expire_time < time.time():
+        return 1, 'Ticket expired'
+    proof = hmac.new(make_ticket_key(password, ticket), bytes(random_bytes), hashlib.sha256).digest()
+    if not hmac.compare_digest(bytes(data[ticket_len:]), proof):
+        return 1, 'Invalid ticket'
+    return 0, ''
+
+
+def connect_resume(ip: str, port: int, password: str, ticket: bytes, conn_timeout: int,
+                   data_timeout: int) -> Tuple[int, str, object]:
+    """
+    客户端连接服务端,用会话票据恢复验证。收到服务端的验证挑战后发出CMD_RESUME,不等待服务端的应答,
+    CMD_RESUME的应答(call_id为0)由调用者在后面接收
+    :return: (err, msg, sock)
+    """
+    try:
+        sock = socket.create_connection((ip, port), conn_timeout)
+    except Exception as e:
+        return -1, str(e), None
+    set_nodelay(sock)
+    err, msg, raw = recv_data(sock, magic_len + 64, data_timeout)
+    if err:
+        sock.close()
+        return -1, msg, None
+    if raw[:magic_len] != magic:
+        sock.close()
+        return -2, 'Invalid packet format!', None
+    err, msg = send_cmd_ex(sock, CMD_RESUME, 0, 0, make_resume_data(password, ticket, raw[magic_len:]), data_timeout)
+    if err:
+        sock.close()
+        return err, msg, None
     return 0, '', sock
 
 
+def connect_unix(path: str, conn_timeout: int, data_timeout: int) -> Tuple[int, str, object, bytes]:
+    """
+    客户端通过unix套接字连接本机的服务端。服务端用SO_PEERCRED验证客户端进程的用户,
+    不需要密码,连接后服务端直接回复验证的结果
+    :param path: unix套接字的路径
+    :return: (err, msg, sock, reply_data), 与connect_ex()相同
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(conn_timeout)
+        sock.connect(path)
+    except Exception as e:
+        sock.close()
+        return -1, str(e), None, b''
+    err, msg, ret_code, ret_data = recv_cmd(sock, data_timeout, AUTH_MAX_LEN)
+    if err:
+        sock.close()
+        return err, msg, None, b''
+    if ret_code:
+        sock.close()
+        return ret_code, bytes(ret_data), None, b''
+    return 0, '', sock, ret_data
+
+
+def get_peer_cred(sock: socket) -> Tuple[int, int, int]:
+    """
+    获得unix套接字对端进程的信息
+    :return: (pid, uid, gid)
+    """
+    raw = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize(peercred_fmt))
+    return struct.unpack(peercred_fmt, raw)
+
+
+def check_peer_cred(sock: socket, allow_uids) -> Tuple[int, str]:
+    """
+    检查unix套接字对端进程的用户是否允许连接
+    :param sock: unix套接字的连接
+    :param allow_uids: 允许连接的用户id的集合
+    :return: (err, msg), err==0表示验证成功,err==1表示验证失败
+    """
+    try:
+        _pid, uid, _gid = get_peer_cred(sock)
+    except OSError as e:
+        return -1, str(e)
+    if uid not in allow_uids:
+        return 1, f'Authentication failed: uid {uid} is not allowed'
+    return 0, ''
+
+
+def auth_unix_connect(sock: socket, allow_uids, timeout: int) -> Tuple[int, str]:
+    """
+    服务端用SO_PEERCRED验证unix套接字的连接,验证后马上给客户端回复结果,不需要验证挑战
+    :param sock: socket连接
+    :param allow_uids: 允许连接的用户id的集合
+    :param timeout: 超时时间
+    :return: (err, msg), 与auth_connect()相同
+    """
+    err, msg = check_peer_cred(sock, allow_uids)
+    if err < 0:
+        return err, msg
+    if err:
+        reply_cmd(sock, -1, b'Authentication failed', timeout)
+        return err, msg
+    return reply_cmd(sock, 0, b'Authentication success', timeout)
+
+
+def make_auth_challenge() -> Tuple[bytes, bytes]:
+    """
+    生成服务端发给客户端的验证挑战包
+    :return: (raw, random_bytes), raw是要发送给客户端的数据,random_bytes是其中的随机串,验证时需要用到
+    """
+    random_str = ''.join(random.sample('abcdABCDefghEFGHijklIJKLmnMN'+str(time.time())+'opOPqrstQRSTuvwUVWxyXYzZ', 64))
+    random_bytes = random_str.encode('utf-8')
+    return magic + random_bytes, random_bytes
+
+
+def check_auth_data(data: bytes, ha_pwd: str, random_bytes: bytes) -> Tuple[int, str]:
+    """
+    检查客户端CMD_AUTH命令中发过来的hash串是否正确
+    :param data: CMD_AUTH命令的数据
+    :param ha_pwd: HA服务的密码
+    :param random_bytes: 之前发给客户端的随机串
+    :return: (err, msg), err==0表示验证成功,err==1表示验证失败,err<0表示包格式错误
+    """
+    if data[:magic_len] != magic:
+        return -2, 'Invalid packet format!'
+
+    client_hash_str = data[magic_len:]
+    mixed_str = ha_pwd.encode("utf-8")+random_bytes
+    server_hash_str = hashlib.sha256(mixed_str).hexdigest().encode("utf-8")
+    if client_hash_str != server_hash_str:
+        return 1, 'Authentication failed'
+    return 0, ''
+
+
 def auth_connect(sock: socket, ha_pwd: str, timeout: int) -> Tuple[int, str]:
     """
     服务端验证连接,方法为: 当接后客户端的连接后,马上给客户端返回一个随机字段串random_str,客户端收到这个随机字符串后,用自己的密码与这个
@@ -251,26 +754,22 @@ def auth_connect(sock: socket, ha_pwd: str, timeout: int) -> Tuple[int, str]:
     :return: (err, msg),如果err<0,说明发生错误,如果err==1,则表示验证失败,如果err==0,
     """
 
-    random_str = ''.join(random.sample('abcdABCDefghEFGHijklIJKLmnMN'+str(time.time())+'opOPqrstQRSTuvwUVWxyXYzZ', 64))
-    random_bytes= random_str.encode('utf-8')
-    raw = magic+random_bytes
+    raw, random_bytes = make_auth_challenge()
     err, msg = send_data(sock, raw, timeout)
     if err:
         return err, msg
 
-    err, msg, cmd, raw = recv_cmd(sock, timeout)
+    # 验证之前不知道对端是谁,只接收验证包大小的包
+    err, msg, cmd, raw = recv_cmd(sock, timeout, AUTH_MAX_LEN)
     if err:
         return err, msg
     if cmd != CMD_AUTH:
         return -1, "Recv a command not AUTH: cmd=%d" % cmd
 
-    if raw[:magic_len] != magic:
-        return -2, 'Invalid packet format!'
-
-    client_hash_str = raw[magic_len:]
-    mixed_str = ha_pwd.encode("utf-8")+random_bytes
-    server_hash_str = hashlib.sha256(mixed_str).hexdigest().encode("utf-8")
-    if client_hash_str != server_hash_str:
+    err, msg = check_auth_data(raw, ha_pwd, random_bytes)
+    if err < 0:
+        return err, msg
+    if err:
         err, msg = reply_cmd(sock, -1, b'Authentication failed', timeout)
         sock.close()
         if err == 0:
@@ -23,12 +23,18 @@
 """
 
 
+import collections
+import hashlib
+import json
 import os
+import shutil
+import stat
 import threading
 import queue
 import time
 import logging
 import traceback
+import zlib
 
 import rpc_utils
 import config
@@ -36,6 +42,40 @@ import config
 __lock = threading.Lock()
 __running_cft_dict = dict()
 
+# 并行传输时,超过此大小的文件切分成多个范围,由多个传输流同时传输
+CFT_RANGE_SIZE = 256 * 1024 * 1024
+
+# 流水线方式传输大文件时,同时在传输中的块数
+CFT_WINDOW_SIZE = 8
+
+# 目标端为流水线写入打开的文件,超过此时间没有写入时自动关闭,防止源端异常退出后文件一直打开
+CFT_FILE_IDLE_TIMEOUT = 3600
+
+# 断点清单中大文件传输位置的保存间隔,每个范围确认写入这么多数据后记录一次
+CFT_CKPT_POS_INTERVAL = 64 * 1024 * 1024
+
+# 失败的任务的断点清单保留的时间,超过后创建新任务时删除
+CFT_CKPT_KEEP_TIME = 7 * 24 * 3600
+
+# 断点清单中保存的任务参数,续传时用这些参数重新创建任务
+CFT_CKPT_KEYS = ['cft_id', 'src_dir', 'dst_host', 'dst_dir', 'task_id', 'big_file_size', 'trans_block_size',
+                 'stream_count', 'range_size', 'delta_mode', 'window_size', 'skip_unchanged', 'delete_extra']
+
+# 比较文件清单时,修改时间相差小于此值(秒)时认为相同,设置修改时间时浮点数的精度会有损失
+CFT_MTIME_TOLERANCE = 0.001
+
+# trans_dir中任务失败后从断点续传的次数
+CFT_RESUME_TIMES = 3
+
+# trans_dir中与源端agent的连接断开后(如agent重启了),重新连接的最长时间,单位秒
+CFT_RECONNECT_TIMEOUT = 120
+
+__open_file_lock = threading.Lock()
+# 正在写的块数减为0时通知等待关闭文件的线程
+__open_file_cond = threading.Condition(__open_file_lock)
+__open_file_dict = dict()  # handle -> [fd, file_path, 最后使用时间, 正在写的块数]
+__open_file_seq = 0
+
 
 def set_cft_dict(cft_dict, state, err_msg, end_time=None):
     __lock.acquire()
@@ -48,10 +88,228 @@ def set_cft_dict(cft_dict, state, err_msg, end_time=None):
         __lock.release()
 
 
-def create_cft(src_dir, dst_host, dst_dir, task_id=None, big_file_size=768 * 1024, trans_block_size=512 * 1024):
+def get_ckpt_file(cft_id):
+    return os.path.join(config.get_data_path(), 'cft', f'{cft_id}.ckpt')
+
+
+class CftCheckpoint():
+    """源端的断点清单,每行是一个json:
+    第一行是任务的参数,之后每行是一条记录:
+        {"done": [[path, size], ...]}  这些文件已传输完成,符号链接的size为null
+        {"pos": [path, start, pos]}     大文件从start开始的范围已确认写到了pos
+    只追加写,任务异常退出时最后一行可能不完整,加载时忽略
+    """
+    def __init__(self, ckpt_file):
+        self.ckpt_file = ckpt_file
+        self.lock = threading.Lock()
+        self.fp = None
+        self.done_dict = {}  # path -> size
+        self.pos_dict = {}  # (path, start) -> pos
+
+    def create(self, params):
+        try:
+            os.makedirs(os.path.dirname(self.ckpt_file), exist_ok=True)
+            self.fp = open(self.ckpt_file, 'w')
+            self.fp.write(json.dumps(params) + '\n')
+            self.fp.flush()
+            return 0, ''
+        except Exception as e:
+            return -1, f"create checkpoint file {self.ckpt_file} failed: {repr(e)}"
+
+    def load(self):
+        """
+        :return: (err_code, params)
+        """
+        try:
+            with open(self.ckpt_file) as fp:
+                line_list = fp.read().split('\n')
+            params = json.loads(line_list[0])
+        except Exception as e:
+            return -1, f"load checkpoint file {self.ckpt_file} failed: {repr(e)}"
+        for line in line_list[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if 'done' in record:
+                for path, size in record['done']:
+                    self.done_dict[path] = size
+            elif 'pos' in record:
+                path, start, pos = record['pos']
+                self.pos_dict[(path, start)] = pos
+        try:
+            self.fp = open(self.ckpt_file, 'a')
+        except Exception as e:
+            return -1, f"open checkpoint file {self.ckpt_file} failed: {repr(e)}"
+        return 0, params
+
+    def _write(self, record):
+        """
+        需要在持有锁时调用,写失败时只记录日志,不影响传输,只是不能再续传
+        """
+        if self.fp is None:
+            return
+        try:
+            self.fp.write(json.dumps(record) + '\n')
+            self.fp.flush()
+        except Exception as e:
+            logging.error(f"write checkpoint file {self.ckpt_file} failed: {repr(e)}")
+            self.fp.close()
+            self.fp = None
+
+    def is_done(self, path):
+        self.lock.acquire()
+        try:
+            return path in self.done_dict
+        finally:
+            self.lock.release()
+
+    def get_pos(self, path, start):
+        """
+        :return: 大文件从start开始的范围已确认写入的位置,没有记录时返回start
+        """
+        self.lock.acquire()
+        try:
+            return self.pos_dict.get((path, start), start)
+        finally:
+            self.lock.release()
+
+    def save_done(self, item_list):
+        """
+        :param item_list: [(path, size), ...]
+        """
+        if not item_list:
+            return
+        self.lock.acquire()
+        try:
+            for path, size in item_list:
+                self.done_dict[path] = size
+            self._write({"done": item_list})
+        finally:
+            self.lock.release()
+
+    def save_pos(self, path, start, pos, force=False):
+        """
+        :param force: 为False时每隔CFT_CKPT_POS_INTERVAL才记录一次,范围传输完时需要强制记录
+        """
+        self.lock.acquire()
+        try:
+            if not force and pos - self.pos_dict.get((path, start), start) < CFT_CKPT_POS_INTERVAL:
+                return
+            self.pos_dict[(path, start)] = pos
+            self._write({"pos": [path, start, pos]})
+        finally:
+            self.lock.release()
+
+    def drop(self, path):
+        """
+        目标端的文件与断点清单不符时调用,此文件重新传输
+        """
+        self.lock.acquire()
+        try:
+            self.done_dict.pop(path, None)
+            for key in [key for key in self.pos_dict if key[0] == path]:
+                del self.pos_dict[key]
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+        finally:
+            self.lock.release()
+
+    def remove(self):
+        self.close()
+        try:
+            os.unlink(self.ckpt_file)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"remove checkpoint file {self.ckpt_file} failed: {repr(e)}")
+
+
+def remove_old_ckpt_files():
+    """
+    删除超过CFT_CKPT_KEEP_TIME没有续传的任务的断点清单
+    """
+    ckpt_dir = os.path.join(config.get_data_path(), 'cft')
+    if not os.path.isdir(ckpt_dir):
+        return
+    curr_time = time.time()
+    for file_name in os.listdir(ckpt_dir):
+        ckpt_file = os.path.join(ckpt_dir, file_name)
+        try:
+            if curr_time - os.path.getmtime(ckpt_file) > CFT_CKPT_KEEP_TIME:
+                os.unlink(ckpt_file)
+        except Exception as e:
+            logging.error(f"remove old checkpoint file {ckpt_file} failed: {repr(e)}")
+
+
+def check_dst_sizes(dst_host, ckpt):
+    """
+    续传前批量检查目标端文件的大小,与断点清单不符的文件重新传输
+    """
+    size_dict = {}
+    for path, size in ckpt.done_dict.items():
+        if size is not None:
+            size_dict[path] = size
+    for (path, _start), pos in ckpt.pos_dict.items():
+        if path not in size_dict:
+            size_dict[path] = -pos  # 负数表示目标文件至少要有这么大
+    if not size_dict:
+        return 0, ''
+
+    err_code, rpc = rpc_utils.get_rpc_connect(dst_host)
+    if err_code != 0:
+        return err_code, rpc
+    try:
+        path_list = list(size_dict)
+        drop_count = 0
+        for i in range(0, len(path_list), 1000):
+            batch = rpc.batch()
+            for path in path_list[i:i + 1000]:
+                batch.get_file_size(path)
+            ret_list = batch.run()
+            for path, (ret_code, dst_size) in zip(path_list[i:i + 1000], ret_list):
+                size = size_dict[path]
+                if ret_code != 0 or (size >= 0 and dst_size != size) or (size < 0 and dst_size < -size):
+                    ckpt.drop(path)
+                    drop_count += 1
+        if drop_count:
+            logging.info(f"{drop_count} files in checkpoint {ckpt.ckpt_file} mismatch on {dst_host}, resend them.")
+        return 0, ''
+    except Exception as e:
+        return -1, f"check file size on {dst_host} failed: {repr(e)}"
+    finally:
+        rpc.close()
+
+
+def create_cft(src_dir, dst_host, dst_dir, task_id=None, big_file_size=768 * 1024, trans_block_size=512 * 1024,
+               stream_count=None, range_size=CFT_RANGE_SIZE, delta_mode=False, skip_unchanged=False,
+               delete_extra=False):
+    """
+    创建一个把本机目录传输到远程机器的后台任务
+    :param stream_count: 并行传输大文件的流数,小文件的批量请求另外使用一个流,为1时在一个线程中依次传输,
+        为None时使用配置文件中的cft_stream_count
+    :param range_size: 并行传输时,超过此大小的文件切分成多个范围同时传输
+    :param delta_mode: 增量模式,目标端已有的大文件只传输内容有变化的块,用于重新同步备库
+    :param skip_unchanged: 先获取目标端的文件清单,类型、大小、权限、修改时间都相同的文件不再传输
+    :param delete_extra: 删除目标端有而源端没有的文件和目录
+    :return: cft_id
+    """
     global __lock
     global __running_cft_dict
 
+    if stream_count is None:
+        str_stream_count = str(config.get('cft_stream_count', '')).strip()
+        stream_count = int(str_stream_count) if str_stream_count.isdigit() else 1
+    str_window_size = str(config.get('cft_window_size', '')).strip()
+    window_size = int(str_window_size) if str_window_size.isdigit() else CFT_WINDOW_SIZE
+
     cft_id = int(time.time() * 10000000)
     cft_dict = {}
     cft_dict['cft_id'] = cft_id
@@ -64,8 +322,35 @@ def create_cft(src_dir, dst_host, dst_dir, task_id=None, big_file_size=768 * 102
     cft_dict['task_id'] = task_id
     cft_dict['big_file_size'] = big_file_size
     cft_dict['trans_block_size'] = trans_block_size
+    cft_dict['stream_count'] = max(stream_count, 1)
+    # 范围的大小取块大小的整数倍,增量模式下各范围的块与目标端计算校验和的块是对齐的
+    cft_dict['range_size'] = max(range_size // trans_block_size, 1) * trans_block_size
+    cft_dict['delta_mode'] = delta_mode
+    cft_dict['skip_unchanged'] = skip_unchanged
+    cft_dict['delete_extra'] = delete_extra
+    cft_dict['window_size'] = window_size
+
+    try:
+        remove_old_ckpt_files()
+    except Exception as e:
+        logging.error(f"remove old checkpoint files failed: {repr(e)}")
+    ckpt = CftCheckpoint(get_ckpt_file(cft_id))
+    err_code, err_msg = ckpt.create({key: cft_dict[key] for key in CFT_CKPT_KEYS})
+    if err_code != 0:
+        # 不能保存断点时照常传输,只是不能续传
+        logging.error(err_msg)
+        ckpt = None
+    cft_dict['ckpt'] = ckpt
+
+    start_cft(cft_dict)
+    return cft_id
+
 
+def start_cft(cft_dict):
+    global __lock
+    global __running_cft_dict
 
+    cft_id = cft_dict['cft_id']
     __lock.acquire()
     try:
         # 先清除过期的pipe_cmd
@@ -86,16 +371,81 @@ def create_cft(src_dir, dst_host, dst_dir, task_id=None, big_file_size=768 * 102
     t.setDaemon(True)  # 设置线程为后台线程
     cft_dict['thread'] = t
     t.start()
-    return cft_id
+
+
+def resume_cft(cft_id):
+    """
+    从断点清单续传失败的任务,agent重启后也可以续传。已传输完成的文件和大文件已确认写入的部分不再传输,
+    续传前会检查目标端文件的大小,与断点清单不符的文件重新传输
+    :return: (err_code, err_msg)
+    """
+    global __lock
+    global __running_cft_dict
+
+    __lock.acquire()
+    try:
+        cft_dict = __running_cft_dict.get(cft_id)
+        if cft_dict is not None and cft_dict['state'] == 0:
+            return -1, f"async copy cmd({cft_id}) is running!"
+    finally:
+        __lock.release()
+
+    ckpt = CftCheckpoint(get_ckpt_file(cft_id))
+    err_code, params = ckpt.load()
+    if err_code != 0:
+        return err_code, params
+    cft_dict = dict(params)
+    cft_dict['src_host'] = config.get('my_ip')
+    cft_dict['queue'] = queue.Queue(1)
+    cft_dict['state'] = 0
+    cft_dict['ckpt'] = ckpt
+    cft_dict['resume'] = True
+    start_cft(cft_dict)
+    return 0, ''
+
+
+def remove_path(path):
+    """
+    删除文件、符号链接或整个目录
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def remove_other_type(path, file_type):
+    """
+    目标端已存在的路径与要创建的类型不同时先删除,如源端的文件在目标端是一个目录
+    :param file_type: 'dir'、'link'或'file'
+    """
+    if not os.path.lexists(path):
+        return
+    if os.path.islink(path):
+        # 符号链接总是重建,也不能通过符号链接写到其它地方
+        os.unlink(path)
+    elif os.path.isdir(path):
+        if file_type != 'dir':
+            shutil.rmtree(path)
+    elif file_type != 'file':
+        os.unlink(path)
 
 
 def cft_batch_cmd(req_list):
     try:
         for req in req_list:
+            if req['type'] == 'delete':
+                remove_path(req['path'])
+                continue
             attr = req['attr']
             mode = attr['mode'] & 0b111111111111
+            remove_other_type(req['path'], req['type'])
             if req['type'] == "dir":
-                os.mkdir(req['path'], mode)
+                # 增量模式下目标端的目录可能已存在
+                if not os.path.isdir(req['path']):
+                    os.mkdir(req['path'], mode)
+                else:
+                    os.chmod(req['path'], mode)
                 os.utime(req['path'], (attr['atime'], attr['mtime']))
             elif req['type'] == 'link':
                 os.symlink(req['linkto'], req['path'])
@@ -124,6 +474,223 @@ def set_file_attr(file_path, attr):
         return -1, err_msg
 
 
+def cft_open_file(file_path):
+    """
+    打开文件用于流水线写入,后续的cft_write_block不用每次都打开和关闭文件
+    :return: (err_code, handle)
+    """
+    global __open_file_seq
+
+    try:
+        remove_other_type(file_path, 'file')
+        fd = os.open(file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except Exception as e:
+        return -1, f"open {file_path} failed: {repr(e)}"
+
+    close_list = []
+    curr_time = time.time()
+    __open_file_lock.acquire()
+    try:
+        for tmp_handle in list(__open_file_dict):
+            item = __open_file_dict[tmp_handle]
+            # 还有块在写的文件不是空闲的
+            if curr_time - item[2] > CFT_FILE_IDLE_TIMEOUT and item[3] == 0:
+                close_list.append(item)
+                del __open_file_dict[tmp_handle]
+        __open_file_seq += 1
+        handle = __open_file_seq
+        __open_file_dict[handle] = [fd, file_path, curr_time, 0]
+    finally:
+        __open_file_lock.release()
+
+    for item in close_list:
+        logging.warning(f"close idle file {item[1]} opened by cft_open_file.")
+        os.close(item[0])
+    return 0, handle
+
+
+def cft_write_block(handle, offset, data):
+    """
+    把数据块写到cft_open_file打开的文件的offset处,同一个文件的多个块可以同时写。
+    写的过程中文件不会被cft_close_file或空闲超时关闭,避免写到已关闭或被重新使用的文件描述符上
+    :return: (err_code, 写完后的偏移), 源端用返回的偏移确认此块已写入
+    """
+    __open_file_lock.acquire()
+    try:
+        item = __open_file_dict.get(handle)
+        if item is not None:
+            item[2] = time.time()
+            item[3] += 1
+    finally:
+        __open_file_lock.release()
+    if item is None:
+        return -1, f"file handle({handle}) not exists"
+
+    try:
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            pos += os.pwrite(item[0], data[pos:], offset + pos)
+    except Exception as e:
+        return -1, f"write {item[1]} failed: {repr(e)}"
+    finally:
+        __open_file_lock.acquire()
+        try:
+            item[3] -= 1
+            if item[3] == 0:
+                __open_file_cond.notify_all()
+        finally:
+            __open_file_lock.release()
+    return 0, offset + len(data)
+
+
+def cft_close_file(handle, attr=None, file_size=None):
+    """
+    关闭cft_open_file打开的文件
+    :param attr: 不为空时关闭后设置文件属性
+    :param file_size: 不为None时先把文件截断到此大小,增量模式下目标端原有的文件可能比源文件大
+    """
+    __open_file_lock.acquire()
+    try:
+        item = __open_file_dict.pop(handle, None)
+        # 等待正在写的块写完后再关闭
+        while item is not None and item[3] > 0:
+            __open_file_cond.wait()
+    finally:
+        __open_file_lock.release()
+    if item is None:
+        return -1, f"file handle({handle}) not exists"
+
+    try:
+        if file_size is not None:
+            os.ftruncate(item[0], file_size)
+        os.close(item[0])
+    except Exception as e:
+        return -1, f"close {item[1]} failed: {repr(e)}"
+    if attr:
+        return set_file_attr(item[1], attr)
+    return 0, ''
+
+
+def calc_block_sum(data):
+    """
+    计算一个块的弱校验和(adler32)与强校验和(sha256),弱校验和不同时不需要再计算强校验和
+    """
+    return zlib.adler32(data), hashlib.sha256(data).digest()
+
+
+def cft_file_checksums(file_path, block_size, offset=0, length=-1):
+    """
+    增量传输时计算目标端已有文件各块的校验和,源端据此只传输有变化的块
+    :param offset: 从此位置开始按block_size分块,需要是block_size的整数倍
+    :param length: 计算的长度,小于0时一直到文件末尾
+    :return: (err_code, [(adler32, sha256), ...]), 文件不存在或不是普通文件时返回(0, None),源端全量传输
+    """
+    if os.path.islink(file_path) or not os.path.isfile(file_path):
+        return 0, None
+    sum_list = []
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except Exception as e:
+        return -1, f"open {file_path} failed: {repr(e)}"
+    try:
+        while length != 0:
+            data = os.pread(fd, block_size if length < 0 else min(block_size, length), offset)
+            if not data:
+                break
+            sum_list.append(calc_block_sum(data))
+            offset += len(data)
+            if length > 0:
+                length -= len(data)
+    except Exception as e:
+        return -1, f"read {file_path} failed: {repr(e)}"
+    finally:
+        os.close(fd)
+    return 0, sum_list
+
+
+def make_manifest_entry(path, st):
+    """
+    生成文件清单中的一项,源端和目标端使用相同的格式
+    :param st: 不跟随符号链接的stat结果
+    """
+    if stat.S_ISLNK(st.st_mode):
+        return ('link', os.readlink(path))
+    if stat.S_ISDIR(st.st_mode):
+        return ('dir', st.st_mode & 0o7777, st.st_mtime)
+    if stat.S_ISREG(st.st_mode):
+        return ('file', st.st_mode & 0o7777, st.st_mtime, st.st_size)
+    return ('other',)
+
+
+def manifest_entry_equal(src_entry, dst_entry):
+    if src_entry[0] != dst_entry[0] or len(src_entry) != len(dst_entry):
+        return False
+    if src_entry[0] == 'link':
+        return src_entry[1] == dst_entry[1]
+    if src_entry[0] == 'other':
+        return False
+    if abs(src_entry[2] - dst_entry[2]) >= CFT_MTIME_TOLERANCE:
+        return False
+    return src_entry[1] == dst_entry[1] and src_entry[3:] == dst_entry[3:]
+
+
+def cft_get_manifest(dir_path):
+    """
+    获得目录下所有文件和目录的清单,源端据此只传输缺少或有变化的文件,一次调用获得整个目录,不用每个文件调用一次os_stat
+    :return: (err_code, {相对路径: 清单项}), 相对路径以/开头,目录不存在时返回空清单
+    """
+    manifest = {}
+    if not os.path.isdir(dir_path):
+        return 0, manifest
+    try:
+        dir_list = [dir_path]
+        while dir_list:
+            curr_dir = dir_list.pop()
+            for item in os.scandir(curr_dir):
+                st = item.stat(follow_symlinks=False)
+                manifest[item.path[len(dir_path):]] = make_manifest_entry(item.path, st)
+                if stat.S_ISDIR(st.st_mode):
+                    dir_list.append(item.path)
+    except Exception as e:
+        return -1, f"get manifest of {dir_path} failed: {repr(e)}"
+    return 0, manifest
+
+
+def get_dst_manifest(dst_host, dst_dir):
+    err_code, err_msg = rpc_utils.get_rpc_connect(dst_host)
+    if err_code != 0:
+        return err_code, err_msg
+    rpc = err_msg
+    try:
+        err_code, err_msg = rpc.cft_get_manifest(dst_dir)
+    except Exception as e:
+        err_code = -1
+        err_msg = f"rpc.cft_get_manifest failed: {repr(e)}"
+    finally:
+        rpc.close()
+    return err_code, err_msg
+
+
+def delete_extra_paths(dst_host, dst_dir, path_list):
+    """
+    删除目标端有而源端没有的路径,目录被删除时不再单独删除其下的文件
+    :param path_list: 相对于dst_dir的路径
+    """
+    req_list = []
+    deleted_dir = None
+    for path in sorted(path_list):
+        if deleted_dir is not None and path.startswith(deleted_dir + '/'):
+            continue
+        deleted_dir = path
+        req_list.append({"type": "delete", "path": dst_dir + path})
+    for i in range(0, len(req_list), 1000):
+        err_code, err_msg = send_batch_req(dst_host, req_list[i:i + 1000])
+        if err_code != 0:
+            return err_code, err_msg
+    return 0, ''
+
+
 def send_batch_req(dst_host, req_list):
     err_code, err_msg = rpc_utils.get_rpc_connect(dst_host)
     if err_code != 0:
@@ -139,7 +706,259 @@ def send_batch_req(dst_host, req_list):
     return err_code, err_msg
 
 
-def send_big_file(dst_host, local_file, req, trans_block_size, notify_handler=None):
+def send_file_attr(dst_host, file_path, attr):
+    err_code, err_msg = rpc_utils.get_rpc_connect(dst_host)
+    if err_code != 0:
+        return err_code, err_msg
+    rpc = err_msg
+    try:
+        err_code, err_msg = rpc.set_file_attr(file_path, attr)
+    except Exception as e:
+        err_code = -1
+        err_msg = f"rpc.set_file_attr failed: {repr(e)}"
+    finally:
+        rpc.close()
+    return err_code, err_msg
+
+
+def write_file_blocks(rpc, fd, local_file, file_path, offset, length, trans_block_size, notify_handler=None):
+    """
+    把本地文件中从offset开始的length个字节按块写到远程文件的相同位置
+    :param fd: 已打开的本地文件
+    :return: (err_code, err_msg)
+    """
+    end_pos = offset + length
+    while offset < end_pos:
+        try:
+            data = os.pread(fd, min(trans_block_size, end_pos - offset), offset)
+        except Exception as e:
+            err_msg = f"读文件{local_file}是发生错误：{repr(e)}"
+            return -1, err_msg
+        if not data:
+            # 传输过程中文件变小了
+            break
+        err_code, err_msg = rpc.os_write_file(file_path, offset, data)
+        if err_code != 0:
+            return err_code, err_msg
+        offset += len(data)
+        if notify_handler:
+            notify_handler.add_trans_size(len(data))
+            notify_handler.save_file_pos(file_path, offset)
+    return 0, ''
+
+
+def _put_block(block_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            block_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def block_unchanged(data, offset, sum_dict):
+    """
+    增量模式下判断块的内容与目标端相同,先比较弱校验和,相同时再比较强校验和
+    :param sum_dict: 目标端各块的校验和, offset -> (adler32, sha256)
+    """
+    if not sum_dict:
+        return False
+    remote_sum = sum_dict.get(offset)
+    if remote_sum is None or zlib.adler32(data) != remote_sum[0]:
+        return False
+    return hashlib.sha256(data).digest() == remote_sum[1]
+
+
+def read_blocks_ahead(fd, local_file, offset, length, block_size, block_queue, stop_event, sum_dict=None):
+    """
+    预读线程: 把文件按块读出后放到block_queue中,读完或出错时放入data为None的项
+    block_queue中的项为(offset, data, err_msg)
+    :param sum_dict: 增量模式下目标端各块的校验和,内容相同的块不放入队列
+    """
+    end_pos = offset + length
+    try:
+        while offset < end_pos:
+            data = os.pread(fd, min(block_size, end_pos - offset), offset)
+            if not data:
+                # 传输过程中文件变小了
+                break
+            if block_unchanged(data, offset, sum_dict):
+                offset += len(data)
+                continue
+            if not _put_block(block_queue, (offset, data, ''), stop_event):
+                return
+            offset += len(data)
+        _put_block(block_queue, (offset, None, ''), stop_event)
+    except Exception as e:
+        _put_block(block_queue, (offset, None, f"读文件{local_file}是发生错误：{repr(e)}"), stop_event)
+
+
+def _wait_block_ack(ack_item, timeout, notify_handler, file_path):
+    end_pos, size, future = ack_item
+    try:
+        err_code, ret = future.get(timeout)
+    except Exception as e:
+        return -1, f"rpc.cft_write_block failed: {repr(e)}"
+    if err_code != 0:
+        return err_code, ret
+    if ret != end_pos:
+        return -1, f"cft_write_block acked offset {ret}, expect {end_pos}"
+    if notify_handler:
+        notify_handler.add_trans_size(size)
+        # 按发送顺序检查确认,所以end_pos之前的块都已写入
+        notify_handler.save_file_pos(file_path, end_pos)
+    return 0, ''
+
+
+def pipe_file_blocks(rpc, handle, file_path, fd, local_file, offset, length, trans_block_size, window_size,
+                     notify_handler=None, sum_dict=None):
+    """
+    流水线方式写入: 预读线程读出数据块,同时有window_size个块在传输中,
+    目标端对每个块的确认带有写完后的偏移,按发送顺序检查确认
+    :param handle: cft_open_file返回的文件句柄
+    :param file_path: 目标端的文件,用于记录断点
+    :param sum_dict: 增量模式下目标端各块的校验和,内容相同的块不传输
+    :return: (err_code, err_msg)
+    """
+    block_queue = queue.Queue(window_size)
+    stop_event = threading.Event()
+    t = threading.Thread(target=read_blocks_ahead,
+                         args=(fd, local_file, offset, length, trans_block_size, block_queue, stop_event, sum_dict))
+    t.setDaemon(True)
+    t.start()
+
+    timeout = rpc.trans.call_timeout
+    inflight = collections.deque()  # [(确认时应返回的偏移, 块大小, future), ...]
+    err_code, err_msg = 0, ''
+    try:
+        while True:
+            block_offset, data, read_err = block_queue.get()
+            if data is None:
+                if read_err:
+                    err_code, err_msg = -1, read_err
+                break
+            future = rpc.cft_write_block(handle, block_offset, data, async_mode=True)
+            inflight.append((block_offset + len(data), len(data), future))
+            if len(inflight) >= window_size:
+                err_code, err_msg = _wait_block_ack(inflight.popleft(), timeout, notify_handler, file_path)
+                if err_code != 0:
+                    break
+        while inflight and err_code == 0:
+            err_code, err_msg = _wait_block_ack(inflight.popleft(), timeout, notify_handler, file_path)
+    finally:
+        stop_event.set()
+        # 出错时也要等还在传输中的块结束,连接才能放回连接池
+        for _end_pos, _size, future in inflight:
+            try:
+                future.get(timeout)
+            except Exception:
+                pass
+        t.join()
+    return err_code, err_msg
+
+
+def get_remote_checksums(rpc, file_path, offset, length, block_size):
+    """
+    增量模式下获得目标端已有文件各块的校验和
+    :return: (err_code, sum_dict), 目标端没有此文件、不支持增量传输时sum_dict为None
+    """
+    if not rpc.trans.mux:
+        return 0, None
+    try:
+        sum_func = rpc.cft_file_checksums
+    except Exception:
+        # 老版本的agent没有此函数
+        return 0, None
+    err_code, sum_list = sum_func(file_path, block_size, offset, length)
+    if err_code != 0:
+        return err_code, sum_list
+    if sum_list is None:
+        return 0, None
+    return 0, {offset + i * block_size: block_sum for i, block_sum in enumerate(sum_list)}
+
+
+def send_file_data(rpc, fd, local_file, file_path, offset, length, trans_block_size, window_size=CFT_WINDOW_SIZE,
+                   notify_handler=None, attr=None, delta_mode=False, file_size=None):
+    """
+    把本地文件中从offset开始的length个字节写到远程文件的相同位置,attr不为空时写完后设置文件属性。
+    对端支持多路复用并且有cft_open_file函数时使用流水线方式,否则逐块停等写入
+    :param delta_mode: 增量模式,先取目标端已有文件各块的校验和,只传输有变化的块
+    :param file_size: 源文件的大小,不为None时写完后把目标文件截断到此大小。目标端原有的文件可能比源文件大,
+                      而cft_open_file和os_write_file都不会截断文件,不截断时目标文件的尾部会残留旧的数据
+    """
+    sum_dict = None
+    if delta_mode:
+        err_code, sum_dict = get_remote_checksums(rpc, file_path, offset, length, trans_block_size)
+        if err_code != 0:
+            return err_code, sum_dict
+
+    try:
+        open_func = rpc.cft_open_file
+    except Exception:
+        # 老版本的agent没有此函数,也就无法截断目标文件
+        open_func = None
+
+    if open_func is None or not rpc.trans.mux or (window_size <= 1 and sum_dict is None):
+        err_code, err_msg = write_file_blocks(rpc, fd, local_file, file_path, offset, length, trans_block_size,
+                                              notify_handler)
+        if err_code != 0:
+            return err_code, err_msg
+        if file_size is not None and open_func is not None:
+            err_code, handle = open_func(file_path)
+            if err_code != 0:
+                return err_code, handle
+            return rpc.cft_close_file(handle, attr, file_size)
+        if attr:
+            err_code, err_msg = rpc.set_file_attr(file_path, attr)
+        return err_code, err_msg
+
+    err_code, handle = open_func(file_path)
+    if err_code != 0:
+        return err_code, handle
+    err_code, err_msg = pipe_file_blocks(rpc, handle, file_path, fd, local_file, offset, length, trans_block_size,
+                                         max(window_size, 1), notify_handler, sum_dict)
+    if err_code != 0:
+        try:
+            rpc.cft_close_file(handle)
+        except Exception:
+            pass
+        return err_code, err_msg
+    return rpc.cft_close_file(handle, attr, file_size)
+
+
+def send_file_range(dst_host, local_file, file_path, offset, length, trans_block_size, notify_handler=None,
+                    window_size=CFT_WINDOW_SIZE, delta_mode=False, file_size=None):
+    """
+    传输大文件中的一个范围,不设置文件属性
+    :param file_size: 整个源文件的大小,写完后把目标文件截断到此大小,见send_file_data()
+    """
+    err_code, rpc = rpc_utils.get_rpc_connect(dst_host)
+    if err_code != 0:
+        return err_code, rpc
+
+    try:
+        fd = os.open(local_file, os.O_RDONLY)
+    except Exception as e:
+        rpc.close()
+        return -1, repr(e)
+    try:
+        return send_file_data(rpc, fd, local_file, file_path, offset, length, trans_block_size, window_size,
+                              notify_handler, None, delta_mode, file_size)
+    except Exception:
+        exc_msg = traceback.format_exc()
+        err_msg = f"send_file_range函数处发生未知错误: {exc_msg}"
+        return -1, err_msg
+    finally:
+        os.close(fd)
+        rpc.close()
+
+
+def send_big_file(dst_host, local_file, req, trans_block_size, notify_handler=None, window_size=CFT_WINDOW_SIZE,
+                  delta_mode=False, offset=0):
+    """
+    :param offset: 续传时从此位置开始传输
+    """
     file_path = req['path']
     file_size = req['size']
     attr = req['attr']
@@ -154,28 +973,10 @@ def send_big_file(dst_host, local_file, req, trans_block_size, notify_handler=No
         rpc.close()
         return -1, repr(e)
     try:
-        block_size = trans_block_size
-        block_cnt = (file_size + block_size - 1) // block_size
-        for i in range(block_cnt):
-            offset = i * block_size
-            try:
-                data = os.read(fd, block_size)
-            except Exception as e:
-                err_msg = f"读文件{local_file}是发生错误：{repr(e)}"
-                return -1, err_msg
-            err_code, err_msg = rpc.os_write_file(file_path, offset, data)
-            if err_code != 0:
-                return err_code, err_msg
-            read_size = len(data)
-            offset += read_size
-            if notify_handler:
-                notify_handler.need_trans_size += read_size
-                notify_handler.transed_size += read_size
-                if notify_handler.need_trans_size > 5 * 1024 * 1024:
-                    notify_handler.need_trans_size = 0
-                    notify_handler.np.notify(notify_handler.transed_file_count, notify_handler.transed_size)
-        err_code, err_msg = rpc.set_file_attr(file_path, attr)
-    except Exception as e:
+        err_code, err_msg = send_file_data(rpc, fd, local_file, file_path, offset, file_size - offset,
+                                           trans_block_size, window_size, notify_handler, attr, delta_mode,
+                                           file_size)
+    except Exception:
         exc_msg = traceback.format_exc()
         err_msg = f"send_big_file函数处发生未知错误: {exc_msg}"
         return -1, err_msg
@@ -192,16 +993,23 @@ class NotifyProgress():
         self.task_id = task_id
         self.interval = interval
         self.trans_time = time.time()
+        self.lock = threading.Lock()
 
     def notify(self, file_count, transed_size):
         try:
             curr_time = time.time()
-            if curr_time - self.trans_time >= self.interval:
+            # 并行传输时多个线程都会通知进度,只让一个线程去记录日志
+            self.lock.acquire()
+            try:
+                if curr_time - self.trans_time < self.interval:
+                    return
                 self.trans_time = curr_time
-                if self.task_id:
-                    rpc_utils.task_insert_log(task_id=self.task_id, task_state=0,
-                        msg=f"{file_count} files , {transed_size//(1024*1024)} MB has been transmitted.",
-                        task_type='general')
+            finally:
+                self.lock.release()
+            if self.task_id:
+                rpc_utils.task_insert_log(task_id=self.task_id, task_state=0,
+                    msg=f"{file_count} files , {transed_size//(1024*1024)} MB has been transmitted.",
+                    task_type='general')
         except Exception as e:
             logging.error(f"notice progress failed: {repr(e)}")
 
@@ -217,14 +1025,99 @@ class WalkHandler():
         self.dst_dir = dst_dir
         self.big_file_size = big_file_size
         self.trans_block_size = trans_block_size
+        self.window_size = CFT_WINDOW_SIZE
+        self.delta_mode = False
+        self.ckpt = None
+        # 目标端的文件清单,遍历时把源端有的路径从中删除,遍历完后剩下的是目标端多出来的
+        self.dst_manifest = None
+        self.skip_unchanged = False
+        self.skipped_file_count = 0
 
         self.transed_size = 0
         self.transed_file_count = 0
         self.req_list = []
         self.need_trans_size = 0
         self.np = NotifyProgress(task_id, interval)
+        self.lock = threading.Lock()
 
-    def process(self, item):
+    def add_trans_size(self, size):
+        """
+        大文件每传输一块后调用,累计传输的数据量,每传输5MB通知一次进度
+        """
+        self.lock.acquire()
+        try:
+            self.need_trans_size += size
+            self.transed_size += size
+            if self.need_trans_size <= 5 * 1024 * 1024:
+                return
+            self.need_trans_size = 0
+            file_count, transed_size = self.transed_file_count, self.transed_size
+        finally:
+            self.lock.release()
+        self.np.notify(file_count, transed_size)
+
+    def get_range_start(self, pos):
+        return 0
+
+    def save_file_pos(self, file_path, pos):
+        """
+        大文件的块确认写入后调用,记录到断点清单中
+        """
+        if self.ckpt is not None:
+            self.ckpt.save_pos(file_path, self.get_range_start(pos), pos)
+
+    def save_done(self, req_list):
+        """
+        文件和符号链接传输完成后调用,记录到断点清单中,目录每次续传时都重新发送
+        """
+        if self.ckpt is None:
+            return
+        self.ckpt.save_done([(req['path'], req.get('size')) for req in req_list if req['type'] != 'dir'])
+
+    def skip_same(self, item):
+        """
+        与目标端的文件清单比较,类型、大小、权限、修改时间都相同时不再传输
+        """
+        if self.dst_manifest is None:
+            return False
+        dst_entry = self.dst_manifest.pop(item.path[len(self.src_dir):], None)
+        if not self.skip_unchanged or dst_entry is None:
+            return False
+        src_entry = make_manifest_entry(item.path, item.stat(follow_symlinks=False))
+        if not manifest_entry_equal(src_entry, dst_entry):
+            return False
+        if src_entry[0] == 'file':
+            self.lock.acquire()
+            self.skipped_file_count += 1
+            self.lock.release()
+        return True
+
+    def skip_done(self, item, req):
+        """
+        续传时跳过断点清单中已传输完成的文件和符号链接
+        """
+        if self.ckpt is None or (item.is_dir() and not item.is_symlink()):
+            return False
+        if not self.ckpt.is_done(req['path']):
+            return False
+        if not item.is_symlink():
+            self.lock.acquire()
+            self.transed_file_count += 1
+            self.lock.release()
+        return True
+
+    def send_req_list(self):
+        err_code, err_msg = send_batch_req(self.dst_host, self.req_list)
+        if err_code != 0:
+            return err_code, err_msg
+        self.save_done(self.req_list)
+        self.need_trans_size = 0
+        self.req_list = []
+        # 通知进度
+        self.np.notify(self.transed_file_count, self.transed_size)
+        return 0, ''
+
+    def make_req(self, item):
         stat_result = item.stat()
         attr = {
             "mode": stat_result.st_mode,
@@ -233,12 +1126,18 @@ class WalkHandler():
             "atime": stat_result.st_atime,
             "mtime": stat_result.st_mtime
         }
-        local_file = item.path
-        remote_file = self.dst_dir + local_file[len(self.src_dir):]
+        remote_file = self.dst_dir + item.path[len(self.src_dir):]
         req = {
             "path": remote_file,
             "attr": attr
         }
+        return stat_result, req
+
+    def process(self, item):
+        stat_result, req = self.make_req(item)
+        local_file = item.path
+        if self.skip_same(item) or self.skip_done(item, req):
+            return 0, ''
 
         if item.is_symlink():  # 注意需要先处理symlink，因为一个链接，使用item.is_dir()时也会为真
             req['type'] = 'link'
@@ -248,13 +1147,7 @@ class WalkHandler():
             req['type'] = 'dir'
             self.req_list.append(req)
             if len(self.req_list) > 100:
-                err_code, err_msg = send_batch_req(self.dst_host, self.req_list)
-                if err_code != 0:
-                    return err_code, err_msg
-                self.need_trans_size = 0
-                self.req_list = []
-                # 通知进度
-                self.np.notify(self.transed_file_count, self.transed_size)
+                return self.send_req_list()
         elif item.is_file():
             req['type'] = 'file'
             req['size'] = stat_result.st_size
@@ -263,16 +1156,15 @@ class WalkHandler():
             if stat_result.st_size >= self.big_file_size:
                 # 单独发生之前，把之前积累的都发送出去
                 if len(self.req_list) > 0:
-                    err_code, err_msg = send_batch_req(self.dst_host, self.req_list)
+                    err_code, err_msg = self.send_req_list()
                     if err_code != 0:
                         return err_code, err_msg
-                    self.need_trans_size = 0
-                    self.req_list = []
-                    # 通知进度
-                    self.np.notify(self.transed_file_count, self.transed_size)
-                err_code, err_msg = send_big_file(self.dst_host, local_file, req, self.trans_block_size, self)
+                offset = self.ckpt.get_pos(req['path'], 0) if self.ckpt is not None else 0
+                err_code, err_msg = send_big_file(self.dst_host, local_file, req, self.trans_block_size, self,
+                                                  self.window_size, self.delta_mode, offset)
                 if err_code != 0:
                     return err_code, err_msg
+                self.save_done([req])
                 # 通知进度
                 self.np.notify(self.transed_file_count, self.transed_size)
                 return 0, ''
@@ -284,23 +1176,215 @@ class WalkHandler():
             self.req_list.append(req)
             self.need_trans_size += stat_result.st_size
             if self.need_trans_size >= self.big_file_size:
-                err_code, err_msg = send_batch_req(self.dst_host, self.req_list)
-                if err_code != 0:
-                    return err_code, err_msg
-                self.need_trans_size = 0
-                self.req_list = []
-                # 通知进度
-                self.np.notify(self.transed_file_count, self.transed_size)
+                return self.send_req_list()
             return 0, ''
         return 0, ''
 
     def flush(self):
         if len(self.req_list) > 0:
-            err_code, err_msg = send_batch_req(self.dst_host, self.req_list)
+            return self.send_req_list()
+        return 0, ''
+
+    def stop(self):
+        pass
+
+
+class ParallelWalkHandler(WalkHandler):
+    """并行传输时遍历到某个文件或目录的处理函数:
+    目录由遍历线程直接创建,保证传输文件时上级目录已存在;小文件和符号链接积累成批量请求后交给单独的一个流传输;
+    大文件交给多个流并行传输,超过range_size的文件切分成多个范围,由多个流同时传输,最后一个范围传输完后再设置文件属性
+    """
+    def __init__(self, task_id, interval, src_dir, dst_host, dst_dir, big_file_size, trans_block_size,
+                 stream_count, range_size):
+        super().__init__(task_id, interval, src_dir, dst_host, dst_dir, big_file_size, trans_block_size)
+        self.stream_count = stream_count
+        self.range_size = range_size
+        self.dir_req_list = []
+        self.err_code = 0
+        self.err_msg = ''
+        # 队列长度有限,遍历比传输快时遍历线程等待,避免读入太多的小文件数据
+        self.big_queue = queue.Queue(stream_count * 2)
+        self.batch_queue = queue.Queue(2)
+        self.thread_list = []
+
+    def start(self):
+        for _i in range(self.stream_count):
+            t = threading.Thread(target=self.big_file_worker)
+            t.setDaemon(True)
+            self.thread_list.append(t)
+        t = threading.Thread(target=self.batch_worker)
+        t.setDaemon(True)
+        self.thread_list.append(t)
+        for t in self.thread_list:
+            t.start()
+
+    def get_range_start(self, pos):
+        return (pos - 1) // self.range_size * self.range_size
+
+    def set_error(self, err_code, err_msg):
+        self.lock.acquire()
+        try:
+            if self.err_code == 0:
+                self.err_code = err_code
+                self.err_msg = err_msg
+        finally:
+            self.lock.release()
+
+    def batch_worker(self):
+        while True:
+            req_list = self.batch_queue.get()
+            if req_list is None:
+                break
+            # 出错后继续从队列中取,不让遍历线程卡在put上
+            if self.err_code != 0:
+                continue
+            try:
+                err_code, err_msg = send_batch_req(self.dst_host, req_list)
+            except Exception:
+                err_code, err_msg = -1, f"batch_worker发生未知错误: {traceback.format_exc()}"
+            if err_code != 0:
+                self.set_error(err_code, err_msg)
+                continue
+            self.save_done(req_list)
+            self.np.notify(self.transed_file_count, self.transed_size)
+
+    def big_file_worker(self):
+        while True:
+            job = self.big_queue.get()
+            if job is None:
+                break
+            if self.err_code != 0:
+                continue
+            local_file, req, offset, length, file_state = job
+            try:
+                err_code, err_msg = send_file_range(self.dst_host, local_file, req['path'], offset, length,
+                                                    self.trans_block_size, self, self.window_size,
+                                                    self.delta_mode, req['size'])
+                if err_code == 0:
+                    if self.ckpt is not None:
+                        end_pos = offset + length
+                        self.ckpt.save_pos(req['path'], self.get_range_start(end_pos), end_pos, True)
+                    self.lock.acquire()
+                    file_state[0] -= 1
+                    is_last = file_state[0] == 0
+                    self.lock.release()
+                    if is_last:
+                        err_code, err_msg = send_file_attr(self.dst_host, req['path'], req['attr'])
+                        if err_code == 0:
+                            self.save_done([req])
+            except Exception:
+                err_code, err_msg = -1, f"big_file_worker发生未知错误: {traceback.format_exc()}"
+            if err_code != 0:
+                self.set_error(err_code, err_msg)
+                continue
+            self.np.notify(self.transed_file_count, self.transed_size)
+
+    def flush_dir(self):
+        if len(self.dir_req_list) > 0:
+            err_code, err_msg = send_batch_req(self.dst_host, self.dir_req_list)
             if err_code != 0:
                 return err_code, err_msg
+            self.dir_req_list = []
+        return 0, ''
+
+    def dispatch_batch(self):
+        if len(self.req_list) == 0:
+            return 0, ''
+        err_code, err_msg = self.flush_dir()
+        if err_code != 0:
+            return err_code, err_msg
+        self.batch_queue.put(self.req_list)
+        self.need_trans_size = 0
+        self.req_list = []
+        return 0, ''
+
+    def dispatch_big_file(self, local_file, req):
+        err_code, err_msg = self.flush_dir()
+        if err_code != 0:
+            return err_code, err_msg
+        file_size = req['size']
+        job_list = []
+        for start in range(0, file_size, self.range_size):
+            end_pos = min(start + self.range_size, file_size)
+            # 续传时从断点清单中记录的位置开始
+            offset = self.ckpt.get_pos(req['path'], start) if self.ckpt is not None else start
+            if offset < end_pos:
+                job_list.append((local_file, req, offset, end_pos - offset))
+        if not job_list:
+            # 上次各个范围都已传输完,只是还没有设置文件属性
+            err_code, err_msg = send_file_attr(self.dst_host, req['path'], req['attr'])
+            if err_code == 0:
+                self.save_done([req])
+            return err_code, err_msg
+        file_state = [len(job_list)]  # 未完成的范围个数
+        for job in job_list:
+            self.big_queue.put(job + (file_state,))
+        return 0, ''
+
+    def process(self, item):
+        if self.err_code != 0:
+            return self.err_code, self.err_msg
+        stat_result, req = self.make_req(item)
+        local_file = item.path
+        if self.skip_same(item) or self.skip_done(item, req):
+            return 0, ''
+
+        if item.is_symlink():  # 注意需要先处理symlink，因为一个链接，使用item.is_dir()时也会为真
+            req['type'] = 'link'
+            req['linkto'] = os.readlink(item.path)
+            self.req_list.append(req)
+        elif item.is_dir():
+            req['type'] = 'dir'
+            self.dir_req_list.append(req)
+            if len(self.dir_req_list) > 100:
+                return self.flush_dir()
+            return 0, ''
+        elif item.is_file():
+            req['type'] = 'file'
+            req['size'] = stat_result.st_size
+            self.lock.acquire()
+            self.transed_file_count += 1
+            self.lock.release()
+            if stat_result.st_size >= self.big_file_size:
+                return self.dispatch_big_file(local_file, req)
+            with open(local_file, 'rb') as fp:
+                data = fp.read()
+            req['data'] = data
+            self.req_list.append(req)
+            self.lock.acquire()
+            self.transed_size += stat_result.st_size
+            self.lock.release()
+            self.need_trans_size += stat_result.st_size
+        else:
+            return 0, ''
+        if self.need_trans_size >= self.big_file_size or len(self.req_list) > 100:
+            return self.dispatch_batch()
         return 0, ''
 
+    def flush(self):
+        """
+        把剩余的请求发出去,并等待所有的流传输完成
+        """
+        err_code, err_msg = 0, ''
+        if self.err_code == 0:
+            err_code, err_msg = self.dispatch_batch()
+        if err_code == 0 and self.err_code == 0:
+            err_code, err_msg = self.flush_dir()
+        self.stop()
+        if self.err_code != 0:
+            return self.err_code, self.err_msg
+        return err_code, err_msg
+
+    def stop(self):
+        if not self.thread_list:
+            return
+        for _i in range(self.stream_count):
+            self.big_queue.put(None)
+        self.batch_queue.put(None)
+        for t in self.thread_list:
+            t.join()
+        self.thread_list = []
+
 
 def scandir(path, processFunc):
     err_code = 0
@@ -323,6 +1407,7 @@ def scandir(path, processFunc):
 
 def cft_run(cft_dict):
 
+    ckpt = cft_dict.get('ckpt')
     try:
         src_dir = cft_dict['src_dir']
         dst_host = cft_dict['dst_host']
@@ -330,23 +1415,61 @@ def cft_run(cft_dict):
         log_interval = cft_dict.get('log_interval', 10)
         big_file_size = cft_dict.get('big_file_size', 768 * 1024)
         trans_block_size = cft_dict.get('trans_block_size', 512 * 1024)
+        stream_count = cft_dict.get('stream_count', 1)
         task_id = cft_dict['task_id']
 
-        handler = WalkHandler(task_id, log_interval, src_dir, dst_host, dst_dir, big_file_size, trans_block_size)
-        err_code, err_msg = scandir(src_dir, handler.process)
-        if err_code != 0:
-            set_cft_dict(cft_dict, -1, err_msg, int(time.time()))
-            return
-        # 把还缓存在hanlder中而文件发送出去
-        err_code, err_msg = handler.flush()
+        if ckpt is not None and cft_dict.get('resume'):
+            err_code, err_msg = check_dst_sizes(dst_host, ckpt)
+            if err_code != 0:
+                set_cft_dict(cft_dict, -1, err_msg, int(time.time()))
+                return
+
+        dst_manifest = None
+        delete_extra = cft_dict.get('delete_extra', False)
+        if cft_dict.get('skip_unchanged', False) or delete_extra:
+            err_code, dst_manifest = get_dst_manifest(dst_host, dst_dir)
+            if err_code != 0:
+                set_cft_dict(cft_dict, -1, dst_manifest, int(time.time()))
+                return
+
+        if stream_count > 1:
+            handler = ParallelWalkHandler(task_id, log_interval, src_dir, dst_host, dst_dir, big_file_size,
+                                          trans_block_size, stream_count, cft_dict.get('range_size', CFT_RANGE_SIZE))
+            handler.start()
+        else:
+            handler = WalkHandler(task_id, log_interval, src_dir, dst_host, dst_dir, big_file_size, trans_block_size)
+        handler.window_size = cft_dict.get('window_size', CFT_WINDOW_SIZE)
+        handler.delta_mode = cft_dict.get('delta_mode', False)
+        handler.ckpt = ckpt
+        handler.dst_manifest = dst_manifest
+        handler.skip_unchanged = cft_dict.get('skip_unchanged', False)
+        try:
+            err_code, err_msg = scandir(src_dir, handler.process)
+            if err_code == 0:
+                # 把还缓存在hanlder中而文件发送出去
+                err_code, err_msg = handler.flush()
+        finally:
+            handler.stop()
+        if err_code == 0 and delete_extra and handler.dst_manifest:
+            err_code, err_msg = delete_extra_paths(dst_host, dst_dir, list(handler.dst_manifest))
         if err_code != 0:
             set_cft_dict(cft_dict, -1, err_msg, int(time.time()))
             return
+        if dst_manifest is not None:
+            logging.info(f"cft({cft_dict['cft_id']}) {src_dir} to {dst_host}:{dst_dir}: "
+                         f"{handler.skipped_file_count} unchanged files skipped, "
+                         f"{len(handler.dst_manifest) if delete_extra else 0} extra paths deleted.")
+        # 成功后不再需要断点清单,失败时保留,可以用resume_cft续传
+        if ckpt is not None:
+            ckpt.remove()
         set_cft_dict(cft_dict, 1, 'success', int(time.time()))
     except Exception:
         exc_msg = traceback.format_exc()
         err_msg = f"发生未知错误：{exc_msg}"
         set_cft_dict(cft_dict, -1, err_msg, end_time=int(time.time()))
+    finally:
+        if ckpt is not None:
+            ckpt.close()
 
 
 def get_cft_state(cft_id):
@@ -388,7 +1511,24 @@ def remove_cft(cft_id):
         __lock.release()
 
 
-def trans_dir(rpc, src_dir, dst_ip, dst_dir, task_id):
+def _reconnect_src(connect_func, cft_id):
+    """
+    与源端agent的连接断开后重新连接,agent重启需要一些时间,最多重试CFT_RECONNECT_TIMEOUT秒
+    :return: (err_code, rpc或err_msg)
+    """
+    start_time = time.time()
+    while True:
+        err_code, rpc = connect_func()
+        if err_code == 0:
+            return 0, rpc
+        if time.time() - start_time >= CFT_RECONNECT_TIMEOUT:
+            return err_code, rpc
+        logging.info(f"cft({cft_id}): reconnect source agent failed: {rpc}, retry later.")
+        time.sleep(5)
+
+
+def trans_dir(rpc, src_dir, dst_ip, dst_dir, task_id, stream_count=None, delta_mode=False,
+              resume_times=CFT_RESUME_TIMES, skip_unchanged=False, delete_extra=False, connect_func=None):
     """把rpc所在机器src_dir下的文件传输到dst_ip机器的dst_dir目录下
     Args:
         rpc ([type]): [description]
@@ -396,6 +1536,14 @@ def trans_dir(rpc, src_dir, dst_ip, dst_dir, task_id):
         dst_ip ([type]): [description]
         dst_dir ([type]): [description]
         task_id ([type]): [description]
+        stream_count ([int]): 并行传输的流数,为None时使用源端agent配置的cft_stream_count
+        delta_mode ([bool]): 增量模式,目标端已有的大文件只传输有变化的块
+        resume_times ([int]): 任务失败(包括源端agent重启后任务不存在了)后从断点续传的次数
+        skip_unchanged ([bool]): 与目标端的文件清单比较,只传输缺少或有变化的文件
+        delete_extra ([bool]): 删除目标端有而源端没有的文件和目录
+        connect_func ([callable]): 重新连接源端agent的函数,返回(err_code, rpc或err_msg),
+            如lambda: rpc_utils.get_rpc_connect(src_ip)。源端agent重启后rpc不能再用,用它重新连接后再续传,
+            为None时不重新连接,连接断开后任务失败
 
     Returns:
         [int]: [err_code]
@@ -404,16 +1552,63 @@ def trans_dir(rpc, src_dir, dst_ip, dst_dir, task_id):
 
     err_code = 0
     err_msg = ''
-    cft_id = rpc.create_cft(src_dir, dst_ip, dst_dir, task_id)
+    # 只在用到新参数时才传递,老版本的agent也可以使用
+    if stream_count is None and not (delta_mode or skip_unchanged or delete_extra):
+        cft_id = rpc.create_cft(src_dir, dst_ip, dst_dir, task_id)
+    elif not (delta_mode or skip_unchanged or delete_extra):
+        cft_id = rpc.create_cft(src_dir, dst_ip, dst_dir, task_id, 768 * 1024, 512 * 1024, stream_count)
+    elif not (skip_unchanged or delete_extra):
+        cft_id = rpc.create_cft(src_dir, dst_ip, dst_dir, task_id, 768 * 1024, 512 * 1024, stream_count,
+                                CFT_RANGE_SIZE, True)
+    else:
+        cft_id = rpc.create_cft(src_dir, dst_ip, dst_dir, task_id, 768 * 1024, 512 * 1024, stream_count,
+                                CFT_RANGE_SIZE, delta_mode, skip_unchanged, delete_extra)
+    resumed_times = 0
+    reconnect_times = 0
+    new_rpc_list = []  # 重新连接得到的连接,结束时关闭
     while True:
-        err_code, err_msg, state = rpc.get_cft_state(cft_id)
-        if err_code != 0:
-            rpc.remove_cft(cft_id)
-            return err_code, err_msg
-        if state != 0:
+        try:
+            ret = rpc.get_cft_state(cft_id)
+        except Exception as e:
+            ret = (-1, f"get_cft_state failed: {repr(e)}")
+            if connect_func is not None and reconnect_times < resume_times:
+                # 连接断了,一般是源端agent重启了。重新连接后再查询,agent重启后任务不存在了,下面会从断点续传
+                reconnect_times += 1
+                logging.info(f"cft({cft_id}): {ret[1]}, reconnect source agent.")
+                err_code, new_rpc = _reconnect_src(connect_func, cft_id)
+                if err_code == 0:
+                    new_rpc_list.append(new_rpc)
+                    rpc = new_rpc
+                    continue
+                ret = (-1, f"reconnect source agent failed: {new_rpc}")
+        # 出错时get_cft_state只返回(err_code, err_msg)
+        err_code, err_msg = ret[0], ret[1]
+        state = ret[2] if err_code == 0 else -1
+        if state == 0:
+            time.sleep(5)
+            continue
+        if state == 1 or resumed_times >= resume_times:
             break
+        resumed_times += 1
+        logging.info(f"cft({cft_id}) failed: {err_msg}, resume it ({resumed_times}/{resume_times}).")
         time.sleep(5)
-    rpc.remove_cft(cft_id)
+        try:
+            resume_code, resume_msg = rpc.resume_cft(cft_id)
+        except Exception as e:
+            resume_code, resume_msg = -1, repr(e)
+            if connect_func is not None:
+                # 连接断了,下次查询状态时重新连接
+                err_msg = f"resume_cft failed: {resume_msg}"
+                continue
+        if resume_code != 0:
+            logging.error(f"resume cft({cft_id}) failed: {resume_msg}")
+            break
+    try:
+        rpc.remove_cft(cft_id)
+    except Exception as e:
+        logging.error(f"remove cft({cft_id}) failed: {repr(e)}")
+    for new_rpc in new_rpc_list:
+        new_rpc.close()
     if state != 1:
         err_code = -1
         return -1, err_msg
@@ -25,15 +25,24 @@
 import os
 import sys
 import queue
-import errno
 import fcntl
+import hashlib
+import inspect
+import json
+import bisect
 import pickle
+import collections
+import collections.abc
 import select
 import socket
+import stat
 import struct
 import logging
+import selectors
 import threading
+import time
 import traceback
+import zlib
 
 import cs_low_trans
 
@@ -43,97 +52,424 @@ logger = logging.getLogger('csurpc')
 # 列出服务端的各个服务名
 CMD_FUNC_LIST = 100
 
+# 带调用ID的CMD_FUNC_LIST,mux模式下使用
+CMD_FUNC_LIST_EX = 101
+
 # 调用服务端的某个服务
 CMD_CALL_FUNC = 200
 
+# 带调用ID的调用,同一个连接上可以同时发起多个调用,响应可以乱序返回,只有服务端在验证时声明支持"mux"时才能使用
+CMD_CALL_FUNC_EX = 201
+
+# 一次执行多个调用,包体为[parallel, stop_on_error, [(func_name, args, kwargs), ...]],
+# 返回与调用一一对应的[(ret_code, ret), ...],只有服务端在验证时声明支持"batch"时才能使用
+CMD_CALL_BATCH = 202
+
+# 流式响应的流控,包体是4字节的额度(可以再发送的数据块个数),扩展头中带FLAG_STREAM_END时表示取消这个流
+CMD_STREAM_CREDIT = 203
+
+# 验证成功时服务端回复的数据,事件循环模式的服务端会在后面加上"\n"和json格式的服务端支持的功能
+AUTH_SUCCESS_MSG = b'Authentication success'
+
 #
 DEBUG_LOG_MAX_LEN = 8192
 
+# 大于等于此长度的bytes/bytearray作为带外数据段发送(需要服务端支持"oob")
+OOB_MIN_SIZE = 64 * 1024
+
+# 查找大的bytes/bytearray时,在list、tuple、dict中嵌套的最大深度
+OOB_MAX_DEPTH = 6
+
+# 批量调用并行执行时,最多同时使用的线程数
+BATCH_MAX_PARALLEL = 16
+
+# 流式响应的窗口: 服务端最多可以领先客户端发送的数据块个数,客户端每消费一半窗口就补充一次额度
+STREAM_WINDOW = 16
+
+stream_credit_fmt = "!I"
+
+# 启用压缩时,大于等于此长度的数据才压缩
+COMPRESS_MIN_SIZE = 4096
+
+# 压缩级别,传输时压缩使用最快的级别
+COMPRESS_LEVEL = 1
+
+# 压缩后的长度大于原长度的这个比例时,认为数据已经是压缩过的(如.gz文件),直接发送原始数据
+COMPRESS_MAX_RATIO = 0.9
+
+# 线程池最少保留的线程数
+THREAD_POOL_MIN_SIZE = 2
+
+# 线程池中等待执行的任务数的上限
+THREAD_POOL_QUEUE_SIZE = 1000
+
+# 线程池中多余的线程空闲多长时间后退出,单位秒
+THREAD_POOL_IDLE_TIMEOUT = 60
 
-# 线程池中的线程
-class _WorkThread(threading.Thread):
+# 调用的类别(lane),每个类别有自己的线程池,HA相关的控制类调用不会排在大数据量传输的调用后面。
+# 没有指定类别的函数属于LANE_QUERY
+LANE_CONTROL = 'control'
+LANE_QUERY = 'query'
+LANE_BULK = 'bulk'
+
+# 类别的优先级,批量调用中的函数属于多个类别时,使用优先级最高的类别
+LANE_PRIORITY = {LANE_CONTROL: 0, LANE_QUERY: 1, LANE_BULK: 2}
+
+# 客户端没有在请求中带函数名(FLAG_FUNC_NAME)时,只按包的大小决定调用的类别:
+# 超过此长度或带有带外数据段的包作为LANE_BULK,其它的作为LANE_QUERY。事件循环线程不解包pickle数据
+LANE_BULK_MIN_SIZE = 16 * 1024
+
+# 事件循环模式下,一个连接上等待发送的验证结果、函数列表等应答的个数上限,超过时说明对端不读数据,关闭连接
+CONN_REPLY_QUEUE_SIZE = 64
+
+# 事件循环模式下,发送验证结果、函数列表、服务忙等应答的线程数。这些应答不放在执行调用的线程池中,
+# 线程池满了拒绝调用时,服务忙的应答也能及时发出
+REPLY_THREAD_COUNT = 4
+
+# 会话票据的有效期,单位秒。票据在验证成功时发给客户端,客户端重连时用票据代替验证挑战
+TICKET_TTL = 600
+
+# 带扩展头的命令
+_EXT_CMD_SET = {cs_low_trans.CMD_RESUME, CMD_FUNC_LIST_EX, CMD_CALL_FUNC_EX, CMD_CALL_BATCH, CMD_STREAM_CREDIT}
+
+
+class _FlightCall:
+    def __init__(self):
+        self.event = threading.Event()
+        self.ret = (1, 'coalesced call failed')
+
+
+class _SingleFlight:
     """
-    线程池中的工作线程
+    合并相同的并发调用: 同一个key同时只执行一次,执行期间到达的相同调用等待并共享其结果
     """
-    def __init__(self, thread_pool, thread_name):
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.call_dict = {}  # key -> _FlightCall
+
+    def do(self, key, func):
         """
-        :param thread_pool: 线程池对象
+        执行func,如果相同key的调用正在执行,则等待它的结果
+        :return: (is_shared, ret), is_shared为True表示结果来自其它线程的执行
         """
-        threading.Thread.__init__(self, name=thread_name)
-        self.thread_pool = thread_pool
-        # is_exit: 是一个函数,在每次循环时,调用此函数,如果此函数返回为趁,则此线程结束
-        self.is_exit = thread_pool.is_exit
-        self.setDaemon(True)
-        self.work_queue = thread_pool.work_queue
-        self.start()
+        self.mutex.acquire()
+        call = self.call_dict.get(key)
+        if call is not None:
+            self.mutex.release()
+            call.event.wait()
+            return True, call.ret
+        call = _FlightCall()
+        self.call_dict[key] = call
+        self.mutex.release()
+        try:
+            call.ret = func()
+        finally:
+            self.mutex.acquire()
+            del self.call_dict[key]
+            self.mutex.release()
+            call.event.set()
+        return False, call.ret
 
-    def run(self):
-        while not self.is_exit():
-            try:
-                work_func, args, kwargs = self.work_queue.get(timeout=0.1)
-            except queue.Empty:  # 任务队列为空,继续循环
-                continue
-            try:
-                # 执行任务
-                self.thread_pool.inc_busy()
-                work_func(*args, **kwargs)
-                self.thread_pool.dec_busy()
-            except Exception:
-                self.thread_pool.dec_busy()
-                logger.error(f"RPC ERROR: {traceback.format_exc()}.")
+
+class PoolFullError(Exception):
+    """
+    线程池的任务队列已满,拒绝新的任务
+    """
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
 
 
 class _ThreadPool:
     """
-    线程池对象
+    线程池对象: 线程数在min_size和max_size之间自动伸缩,有任务等待且没有空闲线程时增加线程,
+    线程空闲超过idle_timeout秒后退出(保留min_size个)。空闲线程阻塞在条件变量上,不需要定时醒来。
     """
-    def __init__(self, name, is_exit_func, pool_size=10):
+    def __init__(self, name, is_exit_func, pool_size=10, stats=None, min_size=None, queue_size=None,
+                 idle_timeout=None):
         """
-        :param pool_size: 线程池启动的线程数
+        :param pool_size: 线程池最多的线程数
+        :param stats: RpcStats对象,用于记录任务在队列中的等待时间
+        :param min_size: 线程池最少保留的线程数,默认为THREAD_POOL_MIN_SIZE
+        :param queue_size: 等待执行的任务数的上限,超过时add_job()抛出PoolFullError,默认为THREAD_POOL_QUEUE_SIZE
+        :param idle_timeout: 多余的线程空闲多长时间后退出
         """
         self.name = name
-        self.mutex = threading.Lock()
+        self.stats = stats
+        # 不再轮询is_exit,由服务停止时调用shutdown()结束线程
         self.is_exit = is_exit_func
-        self.busy_count = 0   # 繁忙的线程数
-        self.work_queue = queue.Queue()
-        self.threads = []
-        self.__create_thread(pool_size)
-
-    def inc_busy(self):
-        self.mutex.acquire()
-        self.busy_count += 1
-        self.mutex.release()
-
-    def dec_busy(self):
-        self.mutex.acquire()
-        self.busy_count -= 1
-        self.mutex.release()
+        self.max_size = max(pool_size, 1)
+        if min_size is None:
+            min_size = THREAD_POOL_MIN_SIZE
+        self.min_size = min(min_size, self.max_size)
+        self.queue_size = THREAD_POOL_QUEUE_SIZE if queue_size is None else queue_size
+        self.idle_timeout = THREAD_POOL_IDLE_TIMEOUT if idle_timeout is None else idle_timeout
+        # 任务队列、线程数、空闲线程数都由cond保护,线程池的状态只需要这一把锁
+        self.cond = threading.Condition()
+        self.job_queue = collections.deque()
+        self.threads = set()
+        self.idle_count = 0
+        self.starting_count = 0  # 已创建但还没有开始取任务的线程数
+        self.thread_seq = 0
+        self.is_shutdown = False
+        self.cond.acquire()
+        try:
+            for _i in range(self.min_size):
+                self.__create_thread()
+        finally:
+            self.cond.release()
 
     def get_busy_threads_count(self):
-        self.mutex.acquire()
-        busy_count = self.busy_count
-        self.mutex.release()
+        self.cond.acquire()
+        busy_count = len(self.threads) - self.idle_count
+        self.cond.release()
         return busy_count
 
-    def __create_thread(self, num_of_threads):
-        for i in range(num_of_threads):
-            thread = _WorkThread(self, "%s-%d" % (self.name, i))
-            self.threads.append(thread)
+    def get_threads_count(self):
+        return len(self.threads)
+
+    def get_queue_depth(self):
+        return len(self.job_queue)
+
+    def __create_thread(self):
+        """
+        创建一个工作线程,调用者需要持有self.cond
+        """
+        self.thread_seq += 1
+        self.starting_count += 1
+        thread = threading.Thread(target=self.__worker_run, name="%s-%d" % (self.name, self.thread_seq))
+        thread.daemon = True
+        self.threads.add(thread)
+        thread.start()
+
+    def __worker_run(self):
+        curr_thread = threading.current_thread()
+        self.cond.acquire()
+        self.starting_count -= 1
+        self.cond.release()
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.job_queue and not self.is_shutdown:
+                    self.idle_count += 1
+                    notified = self.cond.wait(self.idle_timeout)
+                    self.idle_count -= 1
+                    if not notified and not self.job_queue and len(self.threads) > self.min_size:
+                        self.threads.discard(curr_thread)  # 空闲超时,线程退出
+                        return
+                if self.is_shutdown:
+                    self.threads.discard(curr_thread)
+                    return
+                work_func, args, kwargs, put_time = self.job_queue.popleft()
+            finally:
+                self.cond.release()
+
+            if self.stats is not None:
+                self.stats.record_queue_wait(time.time() - put_time)
+            try:
+                work_func(*args, **kwargs)
+            except Exception:
+                logger.error(f"RPC ERROR: {traceback.format_exc()}.")
 
     def wait_for_complete(self):
         """
         等待所有线程完成。
         """
-        for thread in self.threads:
-            # 等待线程结束
-            if thread.isAlive():  # 判断线程是否还存活来决定是否调用join
+        for thread in list(self.threads):
+            if thread is not threading.current_thread():
                 thread.join()
 
+    def shutdown(self):
+        """
+        停止线程池,还没有开始执行的任务不再执行
+        """
+        self.cond.acquire()
+        self.is_shutdown = True
+        self.job_queue.clear()
+        self.cond.notify_all()
+        self.cond.release()
+
     def add_job(self, work_func, *args, **kwargs):
         """
         把工作任务加到任务队列中
+        :raise PoolFullError: 等待执行的任务太多或者线程池已停止
+        """
+        self.cond.acquire()
+        try:
+            if self.is_shutdown:
+                raise PoolFullError(f"thread pool {self.name} is shut down")
+            # 空闲的线程和刚创建的线程马上会取走任务,这些任务不算在等待的任务中
+            ready_count = self.idle_count + self.starting_count
+            wait_count = len(self.job_queue) - ready_count
+            if wait_count >= self.queue_size:
+                raise PoolFullError(f"thread pool {self.name} is full: {wait_count} jobs are waiting")
+            self.job_queue.append((work_func, args, kwargs, time.time()))
+            # 已被唤醒但还没有取走任务的线程仍计在idle_count中,所以要与队列长度比较
+            if ready_count < len(self.job_queue) and len(self.threads) < self.max_size:
+                self.__create_thread()
+            else:
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+
+# 耗时直方图各个桶的上界(毫秒),从0.05ms开始,每个桶比前一个大25%,最大约10分钟
+_LATENCY_BUCKETS = [0.05 * (1.25 ** i) for i in range(74)]
+
+
+class _FuncStats:
+    """
+    一个函数的调用统计
+    """
+    __slots__ = ('count', 'errors', 'req_bytes', 'resp_bytes', 'total_ms', 'max_ms', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.req_bytes = 0
+        self.resp_bytes = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(_LATENCY_BUCKETS) + 1)
+
+    def percentile(self, pct):
+        """
+        从直方图中估算百分位数,返回所在桶的上界
+        """
+        if not self.count:
+            return 0.0
+        need = self.count * pct / 100.0
+        total = 0
+        for i, num in enumerate(self.buckets):
+            total += num
+            if total >= need:
+                if i >= len(_LATENCY_BUCKETS):
+                    return round(self.max_ms, 3)
+                return round(min(_LATENCY_BUCKETS[i], self.max_ms), 3)
+        return round(self.max_ms, 3)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "req_bytes": self.req_bytes,
+            "resp_bytes": self.resp_bytes,
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+        }
+
+
+class RpcStats:
+    """
+    RPC的统计信息: 每个函数的调用次数、出错次数、耗时直方图、请求和响应的字节数,以及连接相关的计数
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.active_conns = 0  # 当前的连接数,重置统计时不清零
+        self.func_dict = {}
+        self.counter_dict = {}
+        self.wait_stats = _FuncStats()  # 任务在线程池队列中的等待时间
+        self.start_time = time.time()
+
+    def record_queue_wait(self, elapsed):
+        """
+        记录一个任务在线程池队列中等待的时间
+        :param elapsed: 等待时间,单位秒
+        """
+        elapsed_ms = elapsed * 1000.0
+        idx = bisect.bisect_left(_LATENCY_BUCKETS, elapsed_ms)
+        self.mutex.acquire()
+        try:
+            fs = self.wait_stats
+            fs.count += 1
+            fs.total_ms += elapsed_ms
+            if elapsed_ms > fs.max_ms:
+                fs.max_ms = elapsed_ms
+            fs.buckets[idx] += 1
+        finally:
+            self.mutex.release()
+
+    def record_call(self, func_name, elapsed, is_err, req_bytes, resp_bytes):
+        """
+        记录一次调用
+        :param elapsed: 耗时,单位秒
         """
-        self.work_queue.put((work_func, args, kwargs))
+        elapsed_ms = elapsed * 1000.0
+        idx = bisect.bisect_left(_LATENCY_BUCKETS, elapsed_ms)
+        self.mutex.acquire()
+        try:
+            fs = self.func_dict.get(func_name)
+            if fs is None:
+                fs = _FuncStats()
+                self.func_dict[func_name] = fs
+            fs.count += 1
+            if is_err:
+                fs.errors += 1
+            fs.req_bytes += req_bytes
+            fs.resp_bytes += resp_bytes
+            fs.total_ms += elapsed_ms
+            if elapsed_ms > fs.max_ms:
+                fs.max_ms = elapsed_ms
+            fs.buckets[idx] += 1
+        finally:
+            self.mutex.release()
+
+    def incr(self, name, num=1):
+        self.mutex.acquire()
+        self.counter_dict[name] = self.counter_dict.get(name, 0) + num
+        self.mutex.release()
+
+    def conn_opened(self):
+        self.mutex.acquire()
+        self.active_conns += 1
+        self.counter_dict['accept_count'] = self.counter_dict.get('accept_count', 0) + 1
+        self.mutex.release()
+
+    def conn_closed(self):
+        self.mutex.acquire()
+        self.active_conns -= 1
+        self.mutex.release()
+
+    def snapshot(self, reset=False):
+        """
+        获得统计信息
+        :param reset: 获取后是否清零
+        :return: dict
+        """
+        self.mutex.acquire()
+        try:
+            curr_time = time.time()
+            elapsed = max(curr_time - self.start_time, 0.001)
+            stats = dict(self.counter_dict)
+            stats['active_conns'] = self.active_conns
+            stats['accept_rate'] = round(stats.get('accept_count', 0) / elapsed, 3)
+            stats['elapsed'] = round(elapsed, 3)
+            stats['funcs'] = {func_name: fs.to_dict() for func_name, fs in self.func_dict.items()}
+            wait_dict = self.wait_stats.to_dict()
+            stats['queue_wait'] = {k: wait_dict[k] for k in ('count', 'avg_ms', 'max_ms', 'p50_ms', 'p95_ms', 'p99_ms')}
+            if reset:
+                self.func_dict = {}
+                self.counter_dict = {}
+                self.wait_stats = _FuncStats()
+                self.start_time = curr_time
+        finally:
+            self.mutex.release()
+        return stats
+
+
+# 客户端(call_remote_func)的调用统计,对端是谁不区分
+client_stats = RpcStats()
+
+
+def get_client_stats(reset=False):
+    """
+    获得本进程作为客户端调用远程函数的统计信息
+    """
+    return client_stats.snapshot(reset)
 
 
 def _get_member_func(obj):
@@ -149,25 +485,374 @@ def _get_member_func(obj):
     return func_list
 
 
+def _get_coalesce_funcs(obj, func_name_list):
+    """
+    获得可以合并并发调用的函数,生成器函数(流式返回)的结果只能被迭代一次,不能共享,在注册时就排除掉
+    :param obj: 服务类的实例
+    :param func_name_list: 配置的需要合并并发调用的函数名列表
+    :return: frozenset, 函数名的集合
+    """
+    func_set = set()
+    for func_name in func_name_list:
+        func = getattr(obj, func_name, None)
+        if inspect.isgeneratorfunction(func) or inspect.isasyncgenfunction(func):
+            logger.warning(f"{func_name} is a generator function, concurrent calls of it can not be coalesced")
+            continue
+        func_set.add(func_name)
+    return frozenset(func_set)
+
+
+class _OobBytes:
+    """
+    包装一个大的bytes/bytearray,pickle时作为带外(out-of-band)数据段单独发送,不拷贝到pickle数据中
+    """
+    __slots__ = ('buf',)
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __reduce_ex__(self, protocol):
+        return _rebuild_oob_bytes, (pickle.PickleBuffer(self.buf),)
+
+
+def _rebuild_oob_bytes(buf):
+    """
+    接收端重建带外数据: 每个数据段是单独接收的bytearray,直接返回这个bytearray,不再拷贝
+    """
+    if isinstance(buf, memoryview):
+        if isinstance(buf.obj, bytearray) and buf.nbytes == len(buf.obj):
+            return buf.obj
+        return bytearray(buf)
+    return buf
+
+
+def _wrap_oob(obj, depth=0):
+    """
+    把对象中大的bytes/bytearray替换成_OobBytes,只处理list、tuple、dict中嵌套的数据
+    """
+    obj_type = type(obj)
+    if obj_type is bytes or obj_type is bytearray:
+        if len(obj) >= OOB_MIN_SIZE:
+            return _OobBytes(obj)
+        return obj
+    if depth >= OOB_MAX_DEPTH:
+        return obj
+    if obj_type is tuple or obj_type is list:
+        new_items = [_wrap_oob(item, depth + 1) for item in obj]
+        if all(new is old for new, old in zip(new_items, obj)):
+            return obj
+        return obj_type(new_items)
+    if obj_type is dict:
+        new_dict = None
+        for k, v in obj.items():
+            new_v = _wrap_oob(v, depth + 1)
+            if new_v is not v:
+                if new_dict is None:
+                    new_dict = dict(obj)
+                new_dict[k] = new_v
+        return obj if new_dict is None else new_dict
+    return obj
+
+
+def _encode_payload(obj, use_oob, use_zlib=False):
+    """
+    打包调用的参数或返回值
+    :param obj: 要打包的对象
+    :param use_oob: 是否把大的bytes作为带外数据段发送
+    :param use_zlib: 是否压缩
+    :return: (flags, data, raw_len), data是bytes或者是数据段的列表, raw_len是压缩前的长度
+    """
+    if use_zlib:
+        pickle_data = pickle.dumps(obj)
+        raw_len = len(pickle_data)
+        if raw_len >= COMPRESS_MIN_SIZE:
+            zip_data = zlib.compress(pickle_data, COMPRESS_LEVEL)
+            if len(zip_data) <= raw_len * COMPRESS_MAX_RATIO:
+                return cs_low_trans.FLAG_ZLIB, zip_data, raw_len
+        # 数据太小或者压缩效果不好时,不压缩
+        if not use_oob or raw_len < OOB_MIN_SIZE:
+            return 0, pickle_data, raw_len
+
+    if not use_oob:
+        pickle_data = pickle.dumps(obj)
+        return 0, pickle_data, len(pickle_data)
+    seg_list = []
+    pickle_data = pickle.dumps(_wrap_oob(obj), protocol=5, buffer_callback=seg_list.append)
+    if not seg_list:
+        return 0, pickle_data, len(pickle_data)
+    seg_list = [seg.raw() for seg in seg_list]
+    data = cs_low_trans.pack_oob_segments(pickle_data, seg_list)
+    return cs_low_trans.FLAG_OOB, data, sum([memoryview(buf).nbytes for buf in data])
+
+
+def _decode_payload(data, seg_list=None, flags=0):
+    """
+    解包调用的参数或返回值
+    """
+    if flags & cs_low_trans.FLAG_ZLIB:
+        data = zlib.decompress(data)
+    if seg_list:
+        return pickle.loads(data, buffers=seg_list)
+    return pickle.loads(data)
+
+
+# 当前线程正在执行的调用的上下文
+_call_ctx = threading.local()
+
+
+def get_call_remaining():
+    """
+    在服务端函数中调用,获得当前调用剩余的时间,长时间的循环中可以据此提前结束
+    :return: 剩余的秒数,小于等于0表示客户端已经不再等待结果; 客户端没有传调用的剩余时间时返回None
+    """
+    deadline = getattr(_call_ctx, 'deadline', None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def _invoke_srv_func(srv_obj, func_name, func_args, func_kwargs, deadline=None):
+    """
+    执行服务类中的一个函数
+    :param srv_obj: 服务类的一个实例
+    :param deadline: 调用的截止时间(time.monotonic()),执行期间可以通过get_call_remaining()获得
+    :return: (ret_code, ret), ret_code为0时ret是函数的返回值,否则ret是错误信息
+    """
+    global DEBUG_LOG_MAX_LEN
+
+    if logger.isEnabledFor(logging.DEBUG):
+        str_args = repr(func_args)
+        if len(str_args) > DEBUG_LOG_MAX_LEN:
+            str_args = str_args[:DEBUG_LOG_MAX_LEN] + " ... "
+        str_kwargs = repr(func_kwargs)
+        if len(str_kwargs) > DEBUG_LOG_MAX_LEN:
+            str_kwargs = str_kwargs[:DEBUG_LOG_MAX_LEN] + " ... "
+        rpc_info = f"RECV RPC: {func_name} :\nargs={str_args}"
+        if func_kwargs:
+            rpc_info += f"\nkwargs={str_kwargs}"
+        logger.debug(rpc_info)
+
+    if func_name not in srv_obj.srv_func_list:
+        return 1, "Function(%s) does not exist" % func_name
+
+    if func_name in srv_obj.coalesce_func_set:
+        try:
+            key = pickle.dumps((func_name, func_args, sorted(func_kwargs.items())), protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            key = None  # 参数不能pickle时不合并
+        if key is not None:
+            is_shared, (ret_code, ret) = srv_obj.single_flight.do(
+                key, lambda: _exec_srv_func(srv_obj, func_name, func_args, func_kwargs, deadline))
+            if not is_shared:
+                return ret_code, ret
+            if not ret_code and _is_stream_ret(ret):
+                # 生成器函数在注册时已经排除了,这里是返回迭代器的普通函数,迭代器不能共享,自己再执行一次
+                return _exec_srv_func(srv_obj, func_name, func_args, func_kwargs, deadline)
+            srv_obj.stats.incr('coalesced_calls')
+            return ret_code, ret
+    return _exec_srv_func(srv_obj, func_name, func_args, func_kwargs, deadline)
+
+
+def _exec_srv_func(srv_obj, func_name, func_args, func_kwargs, deadline):
+    """
+    执行服务类中的一个函数,参数和返回值见_invoke_srv_func()
+    """
+    global DEBUG_LOG_MAX_LEN
+
+    call_func = getattr(srv_obj.handler, func_name)
+    _call_ctx.deadline = deadline
+    try:
+        ret = call_func(*func_args, **func_kwargs)
+        if logger.isEnabledFor(logging.DEBUG):
+            str_ret = repr(ret)
+            if len(str_ret) > DEBUG_LOG_MAX_LEN:
+                str_ret = str_ret[:DEBUG_LOG_MAX_LEN]
+            rpc_info = f"RETURN RECV RPC: {func_name} :\nreturn={str_ret}"
+            logger.debug(rpc_info)
+        return 0, ret
+    except Exception as e:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"call {func_name} failed:\n{traceback.format_exc()}")
+
+        exc_type, _, exc_tb = sys.exc_info()
+        fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
+        err_msg = '%s: %s in %s:%d' % (exc_type.__name__, str(e), fname, exc_tb.tb_lineno)
+        return 1, err_msg
+    finally:
+        _call_ctx.deadline = None
+
+
+def _payload_len(data, seg_list=None):
+    """
+    获得包体的长度
+    :param data: bytes或者是数据段的列表
+    :param seg_list: 带外数据段的列表
+    """
+    if isinstance(data, (list, tuple)):
+        data_len = sum([memoryview(buf).nbytes for buf in data])
+    else:
+        data_len = len(data)
+    if seg_list:
+        data_len += sum([len(seg) for seg in seg_list])
+    return data_len
+
+
+def _is_stream_ret(ret):
+    """
+    服务端函数的返回值是否为生成器或迭代器,这时可以流式返回
+    """
+    return isinstance(ret, collections.abc.Iterator)
+
+
+def _encode_reply(ret, flags):
+    """
+    按请求的标志位打包返回值
+    :return: (ret_code, flags, ret_data)
+    """
+    try:
+        if _is_stream_ret(ret):
+            # 对方不能接收流式响应时,把生成器的结果全部取出来一次返回
+            ret = list(ret)
+        ret_flags, ret_data, _raw_len = _encode_payload(ret, bool(flags & cs_low_trans.FLAG_ACCEPT_OOB),
+                                                        bool(flags & cs_low_trans.FLAG_ACCEPT_ZLIB))
+    except Exception as e:
+        return 1, 0, f"encode return value failed: {repr(e)}".encode('utf-8')
+    return 0, ret_flags, ret_data
+
+
+def _call_srv_func(srv_obj, data, seg_list=None, flags=0, deadline=None):
+    """
+    执行一个CMD_CALL_FUNC命令
+    :param srv_obj: 服务类的一个实例
+    :param data:    CMD_CALL_FUNC命令的数据
+    :param seg_list: 带外数据段的列表
+    :param flags: 请求的扩展头中的标志位,决定了参数的解包方式和返回值可以使用的打包方式
+    :param deadline: 调用的截止时间(time.monotonic())
+    :return: (ret_code, flags, ret_data), ret_data是bytes或者是数据段的列表,
+             如果flags中有FLAG_STREAM,ret_data是服务端函数返回的生成器
+    """
+    start_time = time.time()
+    try:
+        func_name, func_args, func_kwargs = _decode_payload(data, seg_list, flags)
+    except Exception as e:
+        srv_obj.stats.incr('decode_errors')
+        return 1, 0, f"decode func args failed: {str(e)}".encode('utf-8')
+
+    ret_code, ret = _invoke_srv_func(srv_obj, func_name, func_args, func_kwargs, deadline)
+    resp_bytes = 0
+    if ret_code:
+        ret_flags = 0
+        ret_data = ret.encode('utf-8')
+    elif flags & cs_low_trans.FLAG_ACCEPT_STREAM and _is_stream_ret(ret):
+        # 由调用者分块发送,见Server._send_stream(),统计中不包括分块发送的数据
+        ret_flags = cs_low_trans.FLAG_STREAM
+        ret_data = ret
+    else:
+        ret_code, ret_flags, ret_data = _encode_reply(ret, flags)
+    if not ret_flags & cs_low_trans.FLAG_STREAM:
+        resp_bytes = _payload_len(ret_data)
+    srv_obj.stats.record_call(func_name, time.time() - start_time, ret_code != 0, _payload_len(data, seg_list),
+                              resp_bytes)
+    return ret_code, ret_flags, ret_data
+
+
+def _call_srv_batch(srv_obj, data, seg_list=None, flags=0, deadline=None):
+    """
+    执行一个CMD_CALL_BATCH命令
+    :param srv_obj: 服务类的一个实例
+    :param data:    CMD_CALL_BATCH命令的数据
+    :return: (ret_code, flags, ret_data), 各个调用的结果是[(ret_code, ret), ...],没有执行的调用的结果为None
+    """
+    global BATCH_MAX_PARALLEL
+
+    try:
+        parallel, stop_on_error, call_list = _decode_payload(data, seg_list, flags)
+    except Exception as e:
+        return 1, 0, f"decode batch args failed: {str(e)}".encode('utf-8')
+
+    ret_list = [None] * len(call_list)
+
+    def _run_batch_item(i):
+        if deadline is not None and time.monotonic() >= deadline:
+            ret_list[i] = (1, 'call expired before execution')
+            return
+        start_time = time.time()
+        ret_code, ret = _invoke_srv_func(srv_obj, *call_list[i], deadline)
+        if not ret_code and _is_stream_ret(ret):
+            # 批量调用不支持流式返回,把生成器的结果全部取出来
+            try:
+                ret = list(ret)
+            except Exception as e:
+                ret_code, ret = 1, f"{type(e).__name__}: {str(e)}"
+        # 批量调用中的各个调用不单独统计字节数
+        srv_obj.stats.record_call(call_list[i][0], time.time() - start_time, ret_code != 0, 0, 0)
+        ret_list[i] = (ret_code, ret)
+
+    if parallel and len(call_list) > 1:
+        # 并行执行时不占用服务的线程池,避免批量调用把线程池占满后互相等待
+        index_queue = queue.Queue()
+        for i in range(len(call_list)):
+            index_queue.put(i)
+
+        def _run_batch_items():
+            while True:
+                try:
+                    i = index_queue.get_nowait()
+                except queue.Empty:
+                    return
+                _run_batch_item(i)
+
+        thread_list = []
+        for _i in range(min(len(call_list), BATCH_MAX_PARALLEL)):
+            t = threading.Thread(target=_run_batch_items, daemon=True)
+            t.start()
+            thread_list.append(t)
+        for t in thread_list:
+            t.join()
+    else:
+        for i in range(len(call_list)):
+            _run_batch_item(i)
+            if stop_on_error and ret_list[i][0]:
+                break
+    return _encode_reply(ret_list, flags)
+
+
 def _handler_connect(sock, srv_obj):
     """
     :param sock:    新连接的socket句柄
     :param srv_obj: 服务类的一个实例
     :return: 无返回值
     """
-    global DEBUG_LOG_MAX_LEN
 
+    srv_obj.stats.conn_opened()
+    try:
+        _handle_conn_cmds(sock, srv_obj)
+    finally:
+        srv_obj.stats.conn_closed()
+
+
+def _handle_conn_cmds(sock, srv_obj):
+    """
+    验证连接,然后循环处理连接上的命令
+    """
     try:
-        err, _msg = cs_low_trans.auth_connect(sock, srv_obj.password, srv_obj.timeout)
+        if sock.family == socket.AF_UNIX:
+            err, _msg = cs_low_trans.auth_unix_connect(sock, srv_obj.unix_allow_uids, srv_obj.timeout)
+        else:
+            err, _msg = cs_low_trans.auth_connect(sock, srv_obj.password, srv_obj.timeout)
+        if err == 1:
+            srv_obj.stats.incr('auth_failures')
         if err:
+            sock.close()
             return  # 验证失败或socket错误,直接返回
     except Exception:
         traceback.print_exc()
+        sock.close()
         return
 
     while True:
         try:
-            err, _msg, cmd, data = cs_low_trans.recv_cmd(sock, srv_obj.timeout)
+            err, _msg, cmd, data = cs_low_trans.recv_cmd(sock, srv_obj.timeout, srv_obj.max_frame_len)
             if err:
                 break
             if cmd == CMD_FUNC_LIST:  # 客户端请求handler中有哪些函数可以调用
@@ -176,53 +861,7 @@ def _handler_connect(sock, srv_obj):
                 if err:
                     break
             elif cmd == CMD_CALL_FUNC:
-                try:
-                    func_name, func_args, func_kwargs = pickle.loads(data)
-                    if logger.level <= logging.DEBUG:
-                        str_args = repr(func_args)
-                        if len(str_args) > DEBUG_LOG_MAX_LEN:
-                            str_args = str_args[:DEBUG_LOG_MAX_LEN] + " ... "
-                        str_kwargs = repr(func_kwargs)
-                        if len(str_kwargs) > DEBUG_LOG_MAX_LEN:
-                            str_kwargs = str_kwargs[:DEBUG_LOG_MAX_LEN] + " ... "
-                        rpc_info = f"RECV RPC: {func_name} :\nargs={str_args}"
-                        if func_kwargs:
-                            rpc_info += f"\nkwargs={str_kwargs}"
-                        logger.debug(rpc_info)
-                except Exception as e:
-                    err, _msg = cs_low_trans.reply_cmd(sock, 1,
-                                f"decode func args failed: {str(e)}".encode('utf-8'), srv_obj.timeout)
-                    if err:
-                        break
-                    continue
-
-                if func_name not in srv_obj.srv_func_list:
-                    err, _msg = cs_low_trans.reply_cmd(sock, 1,
-                            ("Function(%s) does not exist" % func_name).encode('utf-8'), srv_obj.timeout)
-                    if err:
-                        break
-                    continue
-
-                call_func = getattr(srv_obj.handler, func_name)
-                try:
-                    ret = call_func(*func_args, **func_kwargs)
-                    ret_data = pickle.dumps(ret)
-                    ret_code = 0
-                    if logger.level <= logging.DEBUG:
-                        str_ret = repr(ret)
-                        if len(str_ret) > DEBUG_LOG_MAX_LEN:
-                            str_ret = str_ret[:DEBUG_LOG_MAX_LEN]
-                        rpc_info = f"RETURN RECV RPC: {func_name} :\nreturn={str_ret}"
-                        logger.debug(rpc_info)
-                except Exception as e:
-                    if logger.level <= logging.DEBUG:
-                        logger.debug(f"call {func_name} failed:\n{traceback.format_exc()}")
-
-                    exc_type, _, exc_tb = sys.exc_info()
-                    fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
-                    err_msg = '%s: %s in %s:%d' % (exc_type.__name__, str(e), fname, exc_tb.tb_lineno)
-                    ret_code = 1
-                    ret_data = err_msg.encode()
+                ret_code, _flags, ret_data = _call_srv_func(srv_obj, data)
                 err, _msg = cs_low_trans.reply_cmd(sock, ret_code, ret_data, srv_obj.timeout)
                 if err:
                     break
@@ -236,18 +875,307 @@ def _handler_connect(sock, srv_obj):
         pass
 
 
+class _StreamState:
+    """
+    服务端一个流式响应的流控状态
+    """
+
+    def __init__(self, credit):
+        self.cond = threading.Condition()
+        self.credit = credit
+        self.cancelled = False
+
+    def add_credit(self, credit):
+        with self.cond:
+            self.credit += credit
+            self.cond.notify()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify()
+
+    def take_credit(self, timeout):
+        """
+        取一个发送额度,没有额度时等待客户端补充
+        :return: True表示可以发送下一个数据块,False表示流已取消或等待超时
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.credit > 0 or self.cancelled, timeout):
+                return False
+            if self.cancelled:
+                return False
+            self.credit -= 1
+            return True
+
+
+class _Conn:
+    """
+    事件循环(epoll)模式下的一个客户端连接。连接空闲时只登记在epoll中,不占用线程,
+    只有在执行CMD_CALL_FUNC时才从线程池中取一个线程来执行。
+    """
+
+    HEADER_LEN = cs_low_trans.header_len
+
+    def __init__(self, sock, address, max_frame_len=cs_low_trans.MAX_FRAME_LEN):
+        self.sock = sock
+        self.address = address
+        self.max_frame_len = max_frame_len
+        self.random_bytes = b''
+        self.authed = False
+        self.last_active = time.time()
+        # 正在接收的包分几部分接收: 包头、扩展头、带外数据段的长度表、包体、各个带外数据段
+        self.part = None
+        self.part_view = None
+        self.recv_pos = 0
+        self.step = ''
+        self.frame = None
+        self.left_len = 0
+        self.seg_len_list = []
+        self._expect('header', self.HEADER_LEN)
+        # 多个工作线程可能同时在这个连接上返回结果,发送时需要加锁
+        self.send_mutex = threading.Lock()
+        # 正在发送的流式响应: call_id -> _StreamState
+        self.stream_mutex = threading.Lock()
+        self.stream_dict = {}
+        # 正在执行的调用数,有调用在执行时连接不算空闲
+        self.call_mutex = threading.Lock()
+        self.call_count = 0
+        # 等待工作线程发送的应答: [(ret_code, ret_data, call_id, close_after), ...],也由call_mutex保护
+        self.reply_list = []
+
+    def begin_call(self):
+        self.call_mutex.acquire()
+        self.call_count += 1
+        self.call_mutex.release()
+
+    def end_call(self):
+        self.call_mutex.acquire()
+        self.call_count -= 1
+        self.call_mutex.release()
+        # 空闲时间从最后一个调用返回结果后开始算
+        self.last_active = time.time()
+
+    def reply(self, ret_code, ret_data, timeout):
+        self.send_mutex.acquire()
+        try:
+            if self.sock.fileno() < 0:
+                return -1, 'connection closed'
+            return cs_low_trans.reply_cmd(self.sock, ret_code, ret_data, timeout)
+        finally:
+            self.send_mutex.release()
+
+    def reply_ex(self, ret_code, call_id, flags, ret_data, timeout):
+        self.send_mutex.acquire()
+        try:
+            # 调用执行期间连接可能已经被事件循环线程关闭了
+            if self.sock.fileno() < 0:
+                return -1, 'connection closed'
+            return cs_low_trans.send_cmd_ex(self.sock, ret_code, call_id, flags, ret_data, timeout)
+        finally:
+            self.send_mutex.release()
+
+    def _expect(self, step, length):
+        self.step = step
+        self.part = bytearray(length)
+        self.part_view = memoryview(self.part)
+        self.recv_pos = 0
+
+    def _next_data_part(self):
+        """
+        扩展头和长度表之后,接着接收包体和各个带外数据段,都接收完后返回True
+        """
+        if self.step in ('ext', 'deadline', 'name_len', 'name', 'oob_table') and self.left_len > 0:
+            self._expect('body', self.left_len)
+            return False
+        if self.step == 'body':
+            self.frame[3] = self.part
+        elif self.step == 'seg':
+            self.frame[4].append(self.part)
+        if len(self.frame[4]) < len(self.seg_len_list):
+            self._expect('seg', self.seg_len_list[len(self.frame[4])])
+            return False
+        return True
+
+    def _start_payload(self):
+        """
+        扩展头(以及调用剩余时间)接收完后,开始接收函数名、带外数据段的长度表或包体,包已完整时返回True
+        """
+        if self.frame[2] & cs_low_trans.FLAG_FUNC_NAME and self.frame[6] is None:
+            self.left_len -= cs_low_trans.func_name_len_len
+            if self.left_len < 0:
+                raise ValueError('Invalid packet format: packet too short!')
+            self._expect('name_len', cs_low_trans.func_name_len_len)
+            return False
+        if self.frame[2] & cs_low_trans.FLAG_OOB:
+            self.left_len -= cs_low_trans.oob_count_len
+            if self.left_len < 0:
+                raise ValueError('Invalid packet format: packet too short!')
+            self._expect('oob_count', cs_low_trans.oob_count_len)
+            return False
+        return self._next_data_part()
+
+    def _part_done(self):
+        """
+        当前部分接收完成,返回完整的包或None
+        """
+        if self.step == 'header':
+            recv_magic, cmd, len_data = struct.unpack(cs_low_trans.header_fmt, self.part)
+            if recv_magic != cs_low_trans.magic:
+                raise ValueError('Invalid packet format!')
+            # 验证之前只接收验证包大小的包,不按对端发来的长度分配内存
+            max_len = self.max_frame_len if self.authed else cs_low_trans.AUTH_MAX_LEN
+            if len_data > max_len:
+                raise ValueError(f'Invalid packet format: packet length {len_data} exceeds {max_len}!')
+            # frame: [cmd, call_id, flags, data, seg_list, deadline, func_name],
+            # deadline是按本地time.monotonic()换算后的截止时间,func_name是客户端带过来的函数名,没有带时为None
+            self.frame = [cmd, 0, 0, b'', [], None, None]
+            self.seg_len_list = []
+            if cmd in _EXT_CMD_SET:
+                if len_data < cs_low_trans.ext_header_len:
+                    raise ValueError('Invalid packet format: ext header too short!')
+                self.left_len = len_data - cs_low_trans.ext_header_len
+                self._expect('ext', cs_low_trans.ext_header_len)
+                return None
+            if len_data > 0:
+                self._expect('body', len_data)
+                return None
+        elif self.step == 'ext':
+            self.frame[1], self.frame[2] = struct.unpack(cs_low_trans.ext_header_fmt, self.part)
+            if self.frame[2] & cs_low_trans.FLAG_DEADLINE:
+                self.left_len -= cs_low_trans.deadline_len
+                if self.left_len < 0:
+                    raise ValueError('Invalid packet format: packet too short!')
+                self._expect('deadline', cs_low_trans.deadline_len)
+                return None
+            if not self._start_payload():
+                return None
+        elif self.step == 'deadline':
+            remain_ms, = struct.unpack(cs_low_trans.deadline_fmt, self.part)
+            self.frame[5] = time.monotonic() + remain_ms / 1000.0
+            if not self._start_payload():
+                return None
+        elif self.step == 'name_len':
+            name_len, = struct.unpack(cs_low_trans.func_name_len_fmt, self.part)
+            self.left_len -= name_len
+            if self.left_len < 0:
+                raise ValueError('Invalid packet format: bad function name length!')
+            if name_len > 0:
+                self._expect('name', name_len)
+                return None
+            self.frame[6] = ''
+            if not self._start_payload():
+                return None
+        elif self.step == 'name':
+            self.frame[6] = self.part.decode('utf-8')
+            if not self._start_payload():
+                return None
+        elif self.step == 'oob_count':
+            count, = struct.unpack(cs_low_trans.oob_count_fmt, self.part)
+            self.left_len -= count * cs_low_trans.oob_seg_len_len
+            if self.left_len < 0:
+                raise ValueError('Invalid packet format: bad oob segment count!')
+            self.seg_len_list = [0] * count
+            self._expect('oob_table', count * cs_low_trans.oob_seg_len_len)
+            if count > 0:
+                return None
+            self.left_len, self.seg_len_list = cs_low_trans.parse_oob_table(b'', 0, self.left_len)
+            if not self._next_data_part():
+                return None
+        elif self.step == 'oob_table':
+            self.left_len, self.seg_len_list = cs_low_trans.parse_oob_table(
+                self.part, len(self.seg_len_list), self.left_len)
+            if not self._next_data_part():
+                return None
+        elif not self._next_data_part():
+            return None
+
+        frame = tuple(self.frame)
+        self.frame = None
+        self._expect('header', self.HEADER_LEN)
+        return frame
+
+    def read_frames(self):
+        """
+        从socket中读取当前可读的数据,返回已经完整收到的包
+        :return: (err, frame_list), err!=0表示连接已关闭或包格式错误,
+                 frame_list中的元素为(cmd, call_id, flags, data, seg_list, deadline, func_name)
+        """
+        frame_list = []
+        while True:
+            if self.recv_pos < len(self.part):
+                try:
+                    n = self.sock.recv_into(self.part_view[self.recv_pos:])
+                except (BlockingIOError, InterruptedError):
+                    return 0, frame_list
+                except OSError:
+                    return -1, frame_list
+                if n == 0:  # 对方关闭了连接
+                    return -1, frame_list
+                self.last_active = time.time()
+                self.recv_pos += n
+                if self.recv_pos < len(self.part):
+                    return 0, frame_list
+
+            # 当前部分已收完整
+            try:
+                frame = self._part_done()
+            except (ValueError, struct.error, MemoryError):
+                return -2, frame_list
+            if frame is not None:
+                frame_list.append(frame)
+                if not self.authed:
+                    # 先处理验证包,验证通过后再按正常的长度上限接收后面的包
+                    return 0, frame_list
+
+    def add_stream(self, call_id):
+        state = _StreamState(STREAM_WINDOW)
+        self.stream_mutex.acquire()
+        self.stream_dict[call_id] = state
+        self.stream_mutex.release()
+        return state
+
+    def get_stream(self, call_id):
+        self.stream_mutex.acquire()
+        state = self.stream_dict.get(call_id)
+        self.stream_mutex.release()
+        return state
+
+    def remove_stream(self, call_id):
+        self.stream_mutex.acquire()
+        self.stream_dict.pop(call_id, None)
+        self.stream_mutex.release()
+
+    def close(self):
+        # 连接关闭后,正在等待发送额度的流式响应不需要再等了
+        self.stream_mutex.acquire()
+        state_list = list(self.stream_dict.values())
+        self.stream_dict = {}
+        self.stream_mutex.release()
+        for state in state_list:
+            state.cancel()
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
 def parse_connect_url(conn_url):
     """
-    解析连接字符串
+    解析连接字符串,支持tcp://ip:port和unix:///path
     :param conn_url:
-    :return: (protocol, ip, port)
+    :return: (protocol, ip, port), unix协议时ip为套接字的路径,port为0
     """
 
     cells = conn_url.split('://')
     if len(cells) != 2:
         raise Exception("Invalid connect url:%s" % conn_url)
     protocol = cells[0].lower()
-    if protocol != 'tcp':  # 注意目前只支持tcp协议
+    if protocol == 'unix':
+        if not cells[1].startswith('/'):
+            raise Exception("Invalid unix socket path in connect url:%s" % conn_url)
+        return protocol, cells[1], 0
+    if protocol != 'tcp':
         raise Exception("Unsupported protocol:%s" % cells[0])
     ipport = cells[1]
     cells = ipport.split(':')
@@ -266,6 +1194,27 @@ def parse_connect_url(conn_url):
     return protocol, ip, port
 
 
+def _remove_stale_unix_socket(path):
+    """
+    删除上次运行时留下的unix套接字文件,如果还有服务在此路径上监听,则报错
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise Exception(f"{path} exists and is not a unix socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise Exception(f"unix socket {path} is in use")
+
+
 class Server:
     """
         使用方法:
@@ -274,17 +1223,87 @@ class Server:
         s.run()
     """
 
-    def __init__(self, name, handler, is_exit_func, password='cstechRpc', thread_count=30, timeout=300, debug=0):
+    def __init__(self, name, handler, is_exit_func, password='cstechRpc', thread_count=30, timeout=300, debug=0,
+                 use_epoll=False, version='', min_thread_count=None, queue_size=None, lanes=None,
+                 ticket_ttl=TICKET_TTL, unix_allow_uids=None, coalesce_funcs=None,
+                 max_frame_len=cs_low_trans.MAX_FRAME_LEN):
+        """
+        :param thread_count: 线程池最多的线程数,使用lanes时是LANE_QUERY类别的线程池最多的线程数
+        :param min_thread_count: 线程池最少保留的线程数,不设置时为THREAD_POOL_MIN_SIZE
+        :param queue_size: 线程池中等待执行的任务数的上限,超过时拒绝新的调用,不设置时为THREAD_POOL_QUEUE_SIZE
+        :param use_epoll: 为True时使用事件循环(epoll)模式,空闲的连接不占用线程,只有在执行调用时才占用线程池中的线程
+        :param version: 服务的版本号,客户端按对端和版本号缓存服务端的函数列表
+        :param lanes: 调用的类别,格式为[(lane, thread_count, func_name_list), ...],每个类别有自己的线程池,
+                      没有列出的函数属于LANE_QUERY。只在事件循环模式下有效
+        :param ticket_ttl: 会话票据的有效期,为0时不发会话票据。只在事件循环模式下有效
+        :param unix_allow_uids: 监听unix套接字时允许连接的用户id列表,用SO_PEERCRED验证,不需要密码。
+                                不设置时只允许root和运行服务的用户
+        :param coalesce_funcs: 需要合并并发调用的函数名列表,函数名和参数都相同的并发调用只执行一次,共享执行的结果。
+                               只能用于只读且幂等的函数,其中的生成器函数(流式返回)会被忽略
+        :param max_frame_len: 一个请求包的最大长度,超过时关闭连接
+        """
         self.name = name
         self.handler = handler
         self.thread_count = thread_count
+        self.min_thread_count = min_thread_count
+        self.queue_size = queue_size
         self.timeout = timeout
-        self.ss = None
+        self.ss = None  # 第一个监听的套接字
+        self.ss_list = []  # 所有监听的套接字,bind()可以调用多次,同时监听多个地址
+        self.unix_path_list = []  # 监听unix套接字时的路径,退出时删除
         self.is_exit = is_exit_func
-        self.thread_pool = None
+        self.thread_pool = None  # LANE_QUERY类别的线程池,不使用lanes时所有调用都在这个线程池中执行
+        # 各个类别: lane -> 线程池的最大线程数
+        self.lane_size_dict = {LANE_QUERY: thread_count}
+        self.func_lane_dict = {}
+        for lane, lane_thread_count, func_name_list in lanes or []:
+            self.lane_size_dict[lane] = lane_thread_count
+            for func_name in func_name_list:
+                self.func_lane_dict[func_name] = lane
+        self.lane_pool_dict = {}
+        self.reply_pool = None  # 事件循环模式下发送应答的线程池
+        self.coalesce_func_set = _get_coalesce_funcs(handler, coalesce_funcs or [])
+        self.single_flight = _SingleFlight()
         self.srv_func_list = _get_member_func(handler)
+        # 函数列表的hash值,在验证成功时返回给客户端,客户端据此判断缓存的函数列表是否还有效
+        self.catalog_hash = hashlib.sha256('\n'.join(sorted(self.srv_func_list)).encode('utf-8')).hexdigest()[:16]
+        self.version = version
         self.password = password
+        self.ticket_ttl = ticket_ttl
+        if unix_allow_uids is None:
+            unix_allow_uids = [0, os.getuid()]
+        self.unix_allow_uids = set(unix_allow_uids)
         self.debug = debug
+        self.use_epoll = use_epoll
+        self.max_frame_len = max_frame_len
+        self.stats = RpcStats()
+
+        # 下面是事件循环模式下使用的变量
+        self.selector = None
+        self.conn_dict = {}
+        # 工作线程执行完调用后,把连接放到此列表中,由事件循环线程重新登记到epoll中
+        self.resume_mutex = threading.Lock()
+        self.resume_list = []
+        self.wakeup_r = None
+        self.wakeup_w = None
+
+    def get_caps(self):
+        """
+        获得服务端支持的功能,在验证成功时返回给客户端
+        :return: dict
+        """
+        return {"mux": 1, "oob": 1, "zlib": 1, "batch": 1, "stream": 1, "deadline": 1, "func_name": 1, "catalog": self.catalog_hash, "version": self.version}
+
+    def _make_auth_reply(self, conn):
+        """
+        生成验证成功时回复的数据,带上服务端支持的功能和给这个客户端的会话票据
+        """
+        caps = self.get_caps()
+        if self.ticket_ttl and conn.sock.family != socket.AF_UNIX:
+            ticket = cs_low_trans.make_session_ticket(self.password, conn.address[0], self.ticket_ttl)
+            caps['ticket'] = ticket.hex()
+            caps['ticket_ttl'] = self.ticket_ttl
+        return AUTH_SUCCESS_MSG + b'\n' + json.dumps(caps).encode('utf-8')
 
     def get_busy_threads_count(self):
         """
@@ -292,27 +1311,73 @@ class Server:
         :return: int, 返回正在执行任务的线程数
         """
 
-        if not self.thread_pool:
+        if not self.lane_pool_dict:
             return 0
-        return self.thread_pool.get_busy_threads_count()
+        return sum([pool.get_busy_threads_count() for pool in self.lane_pool_dict.values()])
+
+    def get_stats(self, reset=False):
+        """
+        获得服务端的统计信息,包括每个函数的调用次数、出错次数、耗时的p50/p95/p99、请求和响应的字节数,
+        以及接收连接的速率、当前连接数、验证失败次数、线程池的队列长度和等待时间
+        :param reset: 获取后是否清零
+        :return: dict
+        """
+        stats = self.stats.snapshot(reset)
+        if self.use_epoll:
+            stats['active_conns'] = len(self.conn_dict)
+        stats['busy_threads'] = self.get_busy_threads_count()
+        lane_stats = {}
+        for lane, pool in self.lane_pool_dict.items():
+            lane_stats[lane] = {
+                "max_threads": pool.max_size,
+                "threads": pool.get_threads_count(),
+                "busy_threads": pool.get_busy_threads_count(),
+                "queue_depth": pool.get_queue_depth()
+            }
+        stats['threads'] = sum([item['threads'] for item in lane_stats.values()])
+        stats['queue_depth'] = sum([item['queue_depth'] for item in lane_stats.values()])
+        stats['lanes'] = lane_stats
+        return stats
 
     def bind(self, conn_url):
         """
-        :param conn_url: 连接url,格式为: 'protocol://ip:port',目前protocol只支持tcp。
+        :param conn_url: 连接url,格式为: 'tcp://ip:port'或'unix:///path'。
+                         unix套接字只能本机连接,用SO_PEERCRED验证对端进程的用户,见unix_allow_uids
         :return: 无返回值
         使用例子: s.bind('tcp://0.0.0.0:4242')
+        可以调用多次同时监听多个地址,如再调用s.bind('unix:///run/csurpc.sock'),本机的客户端可以通过unix套接字连接
         """
 
         protocol, ip, port = parse_connect_url(conn_url)
-        if protocol != 'tcp':
-            raise Exception("Unsupported protocol:%s" % protocol)
-
-        self.ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        fcntl.fcntl(self.ss.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
-
-        self.ss.settimeout(self.timeout)
-        self.ss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.ss.bind((ip, port))
+        if protocol == 'unix':
+            _remove_stale_unix_socket(ip)
+            ss = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            fcntl.fcntl(ss.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            ss.settimeout(self.timeout)
+            ss.bind(ip)
+            # 是否允许连接由SO_PEERCRED决定,所以套接字文件对所有用户可写
+            os.chmod(ip, 0o666)
+            self.unix_path_list.append(ip)
+        else:
+            ss = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            fcntl.fcntl(ss.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+            ss.settimeout(self.timeout)
+            ss.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            ss.bind((ip, port))
+        if self.ss is None:
+            self.ss = ss
+        self.ss_list.append(ss)
+
+    def _close_listen_sock(self):
+        for ss in self.ss_list:
+            ss.close()
+        for unix_path in self.unix_path_list:
+            try:
+                os.unlink(unix_path)
+            except OSError:
+                pass
+        self.unix_path_list = []
 
     def run(self):
         """
@@ -320,32 +1385,447 @@ class Server:
         :return: 无返回值
         """
 
-        self.thread_pool = _ThreadPool(self.name, self.is_exit, self.thread_count)
-        self.ss.listen(10)
+        if self.use_epoll:
+            self._run_epoll()
+            return
+
+        # 每个连接占用一个线程,不区分调用的类别
+        self.thread_pool = self._create_thread_pool(LANE_QUERY, self.thread_count)
+        self.lane_pool_dict = {LANE_QUERY: self.thread_pool}
+        # 用poll()而不是select(),文件描述符大于等于1024时也可以使用
+        poller = select.poll()
+        ss_dict = {}  # fd -> 监听的套接字
+        for ss in self.ss_list:
+            ss.listen(10)
+            poller.register(ss, select.POLLIN)
+            ss_dict[ss.fileno()] = ss
         while not self.is_exit():
 
             # if self.debug:
             #    print "Busy threads count: %s" % self.get_busy_threads_count()
 
+            event_list = poller.poll(1000)
+            if not event_list:
+                # logger.debug("poll timeout.")
+                continue
+            for fd, _event in event_list:
+                (client, _address) = ss_dict[fd].accept()
+                # if self.debug:
+                #    print("Accept connection from %s" % str(address))
+                linger = struct.pack('ii', 1, 1)
+                r = client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+                if r:
+                    raise Exception("Set socket SO_LINGER failed!")
+                cs_low_trans.set_nodelay(client)
+                client.settimeout(self.timeout)
+                try:
+                    self.thread_pool.add_job(_handler_connect, client, self)
+                except PoolFullError as e:
+                    logger.error(f"reject connection: {str(e)}")
+                    client.close()
+        self._shutdown_pools()
+        self._close_listen_sock()
+
+    def _create_thread_pool(self, lane, thread_count):
+        name = self.name if lane == LANE_QUERY else f"{self.name}-{lane}"
+        return _ThreadPool(name, self.is_exit, thread_count, self.stats, min_size=self.min_thread_count,
+                           queue_size=self.queue_size)
+
+    def _shutdown_pools(self):
+        for pool in self.lane_pool_dict.values():
+            pool.shutdown()
+        if self.reply_pool is not None:
+            self.reply_pool.shutdown()
+
+    def _get_call_pool(self, func_name, data, seg_list):
+        """
+        根据调用的函数名找到执行此调用的线程池
+        :param func_name: 客户端在请求中带过来的函数名,批量调用时是用逗号分隔的多个函数名,没有带时为None
+        """
+        if len(self.lane_pool_dict) == 1:
+            return self.thread_pool
+        if func_name is None:
+            if seg_list or len(data) > LANE_BULK_MIN_SIZE:
+                return self.lane_pool_dict.get(LANE_BULK, self.thread_pool)
+            return self.thread_pool
+        # 批量调用按其中优先级最高的函数决定类别
+        lane_list = [self.func_lane_dict.get(item, LANE_QUERY) for item in func_name.split(',')]
+        lane = min(lane_list, key=lambda item: LANE_PRIORITY.get(item, len(LANE_PRIORITY)), default=LANE_QUERY)
+        return self.lane_pool_dict.get(lane, self.thread_pool)
+
+    def _run_epoll(self):
+        """
+        事件循环模式: 由本线程通过epoll监听所有的连接,完成连接验证和命令包的接收,
+        收到CMD_CALL_FUNC时,才把连接交给线程池中的线程去执行,执行完后再放回epoll中。
+        """
+
+        for lane, lane_thread_count in self.lane_size_dict.items():
+            self.lane_pool_dict[lane] = self._create_thread_pool(lane, lane_thread_count)
+        self.thread_pool = self.lane_pool_dict[LANE_QUERY]
+        # 每个连接同时最多只有一个发送应答的任务,任务数不会超过连接数
+        self.reply_pool = _ThreadPool(f"{self.name}-reply", self.is_exit, REPLY_THREAD_COUNT, min_size=1,
+                                      queue_size=max(THREAD_POOL_QUEUE_SIZE, self.queue_size or 0))
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+        for ss in self.ss_list:
+            ss.setblocking(False)
+            ss.listen(128)
+            self.selector.register(ss, selectors.EVENT_READ, None)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ, None)
+
+        check_idle_time = time.time()
+        try:
+            while not self.is_exit():
+                events = self.selector.select(1)
+                for key, _mask in events:
+                    if key.fileobj in self.ss_list:
+                        self._accept_conn(key.fileobj)
+                    elif key.fileobj is self.wakeup_r:
+                        self._resume_conns()
+                    else:
+                        self._process_conn(key.data)
+                curr_time = time.time()
+                if curr_time - check_idle_time >= 1:
+                    check_idle_time = curr_time
+                    self._close_idle_conns(curr_time)
+        finally:
+            for conn in list(self.conn_dict.values()):
+                conn.close()
+            self.conn_dict.clear()
+            self._shutdown_pools()
+            self.selector.close()
+            self.wakeup_r.close()
+            self.wakeup_w.close()
+            self._close_listen_sock()
+
+    def _accept_conn(self, ss):
+        while True:
+            try:
+                client, address = ss.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.error(f"accept connection failed: {repr(e)}")
+                return
+            try:
+                fcntl.fcntl(client.fileno(), fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+                linger = struct.pack('ii', 1, 1)
+                client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
+                cs_low_trans.set_nodelay(client)
+                client.setblocking(False)
+                conn = _Conn(client, address, self.max_frame_len)
+                if client.family == socket.AF_UNIX:
+                    # 本机的unix套接字用SO_PEERCRED验证,不需要验证挑战,直接回复验证结果
+                    err, _msg = cs_low_trans.check_peer_cred(client, self.unix_allow_uids)
+                    if err:
+                        self.stats.incr('auth_failures')
+                        conn.reply(-1, b'Authentication failed', self.timeout)
+                        conn.close()
+                        continue
+                    err, _msg = conn.reply(0, self._make_auth_reply(conn), self.timeout)
+                    conn.authed = True
+                else:
+                    raw, conn.random_bytes = cs_low_trans.make_auth_challenge()
+                    err, _msg = cs_low_trans.send_data(client, raw, self.timeout)
+                if err:
+                    conn.close()
+                    continue
+            except Exception:
+                logger.error(f"RPC ERROR: {traceback.format_exc()}.")
+                client.close()
+                continue
+            self.conn_dict[client.fileno()] = conn
+            self.selector.register(client, selectors.EVENT_READ, conn)
+            self.stats.incr('accept_count')
+
+    def _detach_conn(self, conn):
+        """
+        不再监听此连接,之后由调用者负责关闭
+        """
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        self.conn_dict.pop(conn.sock.fileno(), None)
+
+    def _remove_conn(self, conn):
+        self._detach_conn(conn)
+        conn.close()
+
+    def _queue_reply(self, conn, ret_code, ret_data, call_id=None, close_after=False):
+        """
+        验证结果、函数列表、服务忙等应答交给发送应答的线程池发送,对端不读数据时不会阻塞事件循环线程。
+        一个连接同时只占用一个工作线程,按顺序发送此连接上的应答
+        :param call_id: 为None时按老的包格式应答,否则按扩展包格式应答
+        :param close_after: 为True时发送后关闭连接,事件循环不再监听此连接
+        :return: False表示连接已被关闭,调用者不能再处理此连接
+        """
+        if close_after:
+            self._detach_conn(conn)
+        conn.call_mutex.acquire()
+        try:
+            if len(conn.reply_list) >= CONN_REPLY_QUEUE_SIZE:
+                is_full = True
+            else:
+                is_full = False
+                conn.reply_list.append((ret_code, ret_data, call_id, close_after))
+                conn.call_count += 1
+                need_job = len(conn.reply_list) == 1
+        finally:
+            conn.call_mutex.release()
+        if is_full:
+            logger.error(f"close connection from {conn.address}: too many replies are waiting to be sent")
+            self._remove_conn(conn)
+            return False
+        if not need_job:
+            return not close_after
+        try:
+            self.reply_pool.add_job(self._run_replies, conn)
+        except PoolFullError as e:
+            logger.error(f"close connection from {conn.address}: {str(e)}")
+            self._remove_conn(conn)
+            return False
+        return not close_after
+
+    def _run_replies(self, conn):
+        """
+        在工作线程中发送连接上排队的应答,直到队列为空
+        """
+        while True:
+            conn.call_mutex.acquire()
+            ret_code, ret_data, call_id, close_after = conn.reply_list[0]
+            conn.call_mutex.release()
             try:
-                readable, _writeable, _exceptional = select.select([self.ss], [], [], 1)
-                if not readable:
-                    # logger.debug("select timeout.")
+                if call_id is None:
+                    err, _msg = conn.reply(ret_code, ret_data, self.timeout)
+                else:
+                    err, _msg = conn.reply_ex(ret_code, call_id, 0, ret_data, self.timeout)
+            except (OSError, ValueError):  # 连接已被事件循环线程关闭
+                err = -1
+            if close_after:
+                conn.close()
+                return
+            if err:
+                # 与_run_call_ex()相同,由事件循环线程收到连接关闭的事件后清理此连接
+                try:
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            conn.call_mutex.acquire()
+            conn.reply_list.pop(0)
+            is_empty = not conn.reply_list
+            conn.call_mutex.release()
+            conn.end_call()
+            if is_empty:
+                return
+
+    def _close_idle_conns(self, curr_time):
+        for conn in list(self.conn_dict.values()):
+            # 执行时间很长的调用不能当作空闲关闭
+            if conn.call_count > 0:
+                continue
+            if curr_time - conn.last_active > self.timeout:
+                self._remove_conn(conn)
+
+    def _resume_conns(self):
+        try:
+            while self.wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        self.resume_mutex.acquire()
+        resume_list = self.resume_list
+        self.resume_list = []
+        self.resume_mutex.release()
+        for conn, is_ok in resume_list:
+            if not is_ok:
+                self.conn_dict.pop(conn.sock.fileno(), None)
+                conn.close()
+                continue
+            conn.last_active = time.time()
+            self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+            # 在执行调用期间,可能已经有数据到达了
+            self._process_conn(conn)
+
+    def _put_back_conn(self, conn, is_ok):
+        """
+        工作线程执行完后,把连接交回给事件循环线程
+        """
+        self.resume_mutex.acquire()
+        self.resume_list.append((conn, is_ok))
+        self.resume_mutex.release()
+        try:
+            self.wakeup_w.send(b'x')
+        except (BlockingIOError, InterruptedError):
+            pass  # 缓冲区满说明已经有未处理的唤醒了
+
+    def _process_conn(self, conn):
+        """
+        处理连接上收到的数据,出现任何异常(如内存不足)时只关闭这个连接,不影响事件循环
+        """
+        try:
+            self._process_conn_frames(conn)
+        except Exception:
+            logger.error(f"RPC ERROR: process connection from {conn.address} failed: {traceback.format_exc()}.")
+            self._remove_conn(conn)
+
+    def _process_conn_frames(self, conn):
+        err, frame_list = conn.read_frames()
+        for i, (cmd, call_id, flags, data, seg_list, deadline, func_name) in enumerate(frame_list):
+            if not conn.authed:
+                if cmd == cs_low_trans.CMD_RESUME:
+                    # 客户端用会话票据代替验证挑战,后面的调用可能已经跟着一起到了
+                    ticket_err, ticket_msg = cs_low_trans.check_session_ticket(data, self.password, conn.address[0],
+                                                                               conn.random_bytes)
+                    if ticket_err:
+                        self.stats.incr('ticket_rejects')
+                        self._queue_reply(conn, 1, ticket_msg.encode('utf-8'), call_id, close_after=True)
+                        return
+                    self.stats.incr('ticket_resumes')
+                    if not self._queue_reply(conn, 0, self._make_auth_reply(conn), call_id):
+                        return
+                    conn.authed = True
+                    continue
+                if cmd != cs_low_trans.CMD_AUTH:
+                    self._remove_conn(conn)
+                    return
+                auth_err, _msg = cs_low_trans.check_auth_data(data, self.password, conn.random_bytes)
+                if auth_err:
+                    self.stats.incr('auth_failures')
+                    self._queue_reply(conn, -1, b'Authentication failed', close_after=True)
+                    return
+                if not self._queue_reply(conn, 0, self._make_auth_reply(conn)):
+                    return
+                conn.authed = True
+            elif cmd == CMD_FUNC_LIST:
+                if not self._queue_reply(conn, 0, pickle.dumps(self.srv_func_list)):
+                    return
+            elif cmd == CMD_FUNC_LIST_EX:
+                if not self._queue_reply(conn, 0, pickle.dumps(self.srv_func_list), call_id):
+                    return
+            elif cmd in (CMD_CALL_FUNC_EX, CMD_CALL_BATCH):
+                # 不停止监听此连接,同一个连接上的多个调用可以由多个工作线程同时执行
+                run_func = _call_srv_func if cmd == CMD_CALL_FUNC_EX else _call_srv_batch
+                pool = self._get_call_pool(func_name, data, seg_list)
+                conn.begin_call()
+                try:
+                    pool.add_job(self._run_call_ex, run_func, conn, call_id, flags, data, seg_list, deadline)
+                except PoolFullError as e:
+                    conn.end_call()
+                    self.stats.incr('rejected_calls')
+                    if not self._queue_reply(conn, 1, f"server busy: {str(e)}".encode('utf-8'), call_id):
+                        return
+            elif cmd == CMD_STREAM_CREDIT:
+                state = conn.get_stream(call_id)
+                if state is None:  # 流已经结束了
                     continue
-            except select.error as e:
-                if e.args[0] == errno.EINTR:  # 这是收到信号打断了select函数
+                if flags & cs_low_trans.FLAG_STREAM_END:
+                    state.cancel()
+                elif len(data) == struct.calcsize(stream_credit_fmt):
+                    state.add_credit(struct.unpack(stream_credit_fmt, data)[0])
+            elif cmd == CMD_CALL_FUNC:
+                # 客户端在收到结果之前不会再发请求,所以后面不应该再有包
+                if i != len(frame_list) - 1:
+                    self._remove_conn(conn)
+                    return
+                pool = self._get_call_pool(None, data, seg_list)
+                conn.begin_call()
+                try:
+                    pool.add_job(self._run_call, conn, data)
+                except PoolFullError as e:
+                    conn.end_call()
+                    self.stats.incr('rejected_calls')
+                    # 连接仍在监听中,应答交给工作线程发送
+                    if not self._queue_reply(conn, 1, f"server busy: {str(e)}".encode('utf-8')):
+                        return
                     continue
-                raise Exception("call select() failed: %s" % repr(e))
-            (client, _address) = self.ss.accept()
-            # if self.debug:
-            #    print("Accept connection from %s" % str(address))
-            linger = struct.pack('ii', 1, 1)
-            r = client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, linger)
-            if r:
-                raise Exception("Set socket SO_LINGER failed!")
-            client.settimeout(self.timeout)
-            self.thread_pool.add_job(_handler_connect, client, self)
-        self.ss.close()
+                # 执行期间不再监听此连接,由工作线程执行完后再放回。
+                # 工作线程放回的连接由本线程在_resume_conns()中处理,所以在加入任务之后取消监听也不会有竞争
+                self.selector.unregister(conn.sock)
+                return
+        if err:
+            self._remove_conn(conn)
+
+    def _run_call(self, conn, data):
+        is_ok = False
+        try:
+            ret_code, _flags, ret_data = _call_srv_func(self, data)
+            err, _msg = conn.reply(ret_code, ret_data, self.timeout)
+            is_ok = (err == 0)
+        finally:
+            conn.end_call()
+            self._put_back_conn(conn, is_ok)
+
+    def _run_call_ex(self, run_func, conn, call_id, flags, data, seg_list, deadline):
+        try:
+            if deadline is not None and time.monotonic() >= deadline:
+                # 在队列中等待时已经超时了,客户端已经不再等待结果,不需要再执行
+                self.stats.incr('expired_calls')
+                ret_code, ret_flags, ret_data = 1, 0, b'call expired before execution'
+            else:
+                ret_code, ret_flags, ret_data = run_func(self, data, seg_list, flags, deadline)
+            if ret_flags & cs_low_trans.FLAG_STREAM:
+                err = self._send_stream(conn, call_id, flags, ret_data)
+            else:
+                err, _msg = conn.reply_ex(ret_code, call_id, ret_flags, ret_data, self.timeout)
+        finally:
+            conn.end_call()
+        if err:
+            # 发送失败时,关闭socket,事件循环线程会收到连接关闭的事件,从而清理此连接
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+    def _send_stream(self, conn, call_id, flags, ret_iter):
+        """
+        把服务端函数返回的生成器分块发送给客户端,每块一个响应包,最后发送一个带FLAG_STREAM_END的包。
+        发送的块数超过客户端给的额度时,等待客户端的CMD_STREAM_CREDIT,这期间会占用一个工作线程
+        :return: err, 不为0表示发送失败,需要关闭连接
+        """
+        accept_oob = bool(flags & cs_low_trans.FLAG_ACCEPT_OOB)
+        accept_zlib = bool(flags & cs_low_trans.FLAG_ACCEPT_ZLIB)
+        state = conn.add_stream(call_id)
+        ret_code = 0
+        end_data = b''
+        try:
+            while True:
+                try:
+                    item = next(ret_iter)
+                except StopIteration:
+                    break
+                except Exception as e:
+                    ret_code = 1
+                    end_data = f"{type(e).__name__}: {str(e)}".encode('utf-8')
+                    logger.debug(f"stream {call_id} failed:\n{traceback.format_exc()}")
+                    break
+                if not state.take_credit(self.timeout):
+                    if state.cancelled:  # 客户端取消了,或者连接已关闭
+                        return 0
+                    ret_code = 1
+                    end_data = b'stream timeout: client did not consume the data'
+                    break
+                try:
+                    item_flags, item_data, _raw_len = _encode_payload(item, accept_oob, accept_zlib)
+                except Exception as e:
+                    ret_code = 1
+                    end_data = f"encode stream item failed: {repr(e)}".encode('utf-8')
+                    break
+                err, _msg = conn.reply_ex(0, call_id, item_flags | cs_low_trans.FLAG_STREAM, item_data, self.timeout)
+                if err:
+                    return err
+            end_flags = cs_low_trans.FLAG_STREAM | cs_low_trans.FLAG_STREAM_END
+            err, _msg = conn.reply_ex(ret_code, call_id, end_flags, end_data, self.timeout)
+            return err
+        finally:
+            conn.remove_stream(call_id)
+            close_func = getattr(ret_iter, 'close', None)
+            if close_func is not None:
+                close_func()
 
 
 class CsuTimeoutError(Exception):
@@ -384,6 +1864,392 @@ class _Trans:
         self.port = port
         self.pending = False  # pending==True时,表示在异步模式下正在处理异步任务,这时不能再发起异步请求
         self.msg_callback = msg_callback
+        self.data_timeout = 300
+
+        # 下面是多路复用(mux)模式下使用的变量,服务端支持mux时,同一个连接上可以同时有多个调用
+        self.mux = False
+        self.oob = False  # 服务端是否支持带外数据段
+        self.zlib = False  # 是否压缩传输的数据,需要客户端要求并且服务端支持
+        self.stream = False  # 服务端是否支持流式响应
+        self.deadline = False  # 服务端是否支持在请求中传调用的剩余时间
+        self.func_name = False  # 服务端是否支持在请求中带函数名,用于决定由哪个线程池执行
+        # 传输的统计信息,用于计算压缩率
+        self.stats_mutex = threading.Lock()
+        self.stats = {"call_count": 0, "raw_send_bytes": 0, "send_bytes": 0, "raw_recv_bytes": 0, "recv_bytes": 0}
+        self.mux_mutex = threading.Lock()
+        self.send_mutex = threading.Lock()
+        self.next_call_id = 0
+        self.call_dict = {}  # call_id -> _CallFuture
+        self.reader = None   # 接收响应的线程,第一次调用时才启动
+        self.broken_msg = ''
+
+        # 下面是用会话票据恢复验证时使用的变量: 发出CMD_RESUME后不等应答就发调用,
+        # 票据被拒绝时resume_failed为True,下次调用前由resume_fallback重新做完整的验证
+        self.ticket_key = None
+        self.resume_pending = False
+        self.resume_failed = False
+        self.resume_fallback = None
+        self.resume_mutex = threading.Lock()
+
+    def reset_mux(self):
+        """
+        重新连接后,清除上一个连接上mux模式的状态
+        """
+        self.mux_mutex.acquire()
+        try:
+            self.next_call_id = 0
+            self.call_dict = {}
+            self.reader = None
+            self.broken_msg = ''
+            self.resume_pending = False
+            self.resume_failed = False
+        finally:
+            self.mux_mutex.release()
+
+    def start_reader(self):
+        """
+        启动接收响应的线程,需要在持有mux_mutex时调用
+        """
+        if self.reader is None:
+            self.reader = threading.Thread(target=self._reader_run, name=f"csurpc-reader-{self.ip}:{self.port}")
+            self.reader.daemon = True
+            self.reader.start()
+
+    def submit_call(self, func_name, data, cmd=CMD_CALL_FUNC_EX, flags=0, timeout=None, route_name=None):
+        """
+        mux模式下发起一个调用,不等待结果
+        :param func_name: 远程的函数名
+        :param data: 已打包好的调用数据,是bytes或者是数据段的列表
+        :param cmd: 命令类型
+        :param flags: 扩展头中的标志位
+        :param timeout: 调用的超时时间,服务端支持时会传给服务端,超时后服务端不再执行还在排队的调用
+        :param route_name: 服务端支持时在请求中带上的函数名,服务端据此决定由哪个线程池执行,为None时不带
+        :return: _CallFuture对象
+        """
+        if self.resume_failed and self.resume_fallback:
+            self.resume_fallback()
+        resubmit = (data, cmd, flags, timeout, route_name)
+        if route_name is not None and self.func_name:
+            name_data = cs_low_trans.pack_func_name(data, route_name)
+            if name_data is not None:
+                flags |= cs_low_trans.FLAG_FUNC_NAME
+                data = name_data
+        if timeout and self.deadline:
+            flags |= cs_low_trans.FLAG_DEADLINE
+            data = cs_low_trans.pack_deadline(data, timeout)
+        self.mux_mutex.acquire()
+        try:
+            if self.broken_msg:
+                if not self.resume_failed or not self.resume_fallback:
+                    raise UserWarning(f"socket error: {self.broken_msg}")
+                # 票据刚被拒绝,等待结果时会重新验证后再发此调用
+                future = _CallFuture(self, 0, func_name)
+                future.resubmit = resubmit
+                future.resume_rejected = True
+                future.set_result(-1, self.broken_msg, 0, b'', None, 0)
+                return future
+            self.next_call_id += 1
+            call_id = self.next_call_id
+            future = _CallFuture(self, call_id, func_name)
+            if self.resume_pending:
+                # 票据还没有被服务端确认,被拒绝时需要重发此调用
+                future.resubmit = resubmit
+            self.call_dict[call_id] = future
+            self.start_reader()
+        finally:
+            self.mux_mutex.release()
+
+        self.send_ex(cmd, call_id, flags, data)
+        return future
+
+    def send_ex(self, cmd, call_id, flags, data):
+        """
+        mux模式下发送一个带扩展头的包,发送失败时连接置为断开状态
+        """
+        self.send_mutex.acquire()
+        try:
+            err, msg = cs_low_trans.send_cmd_ex(self.sock, cmd, call_id, flags, data, self.call_timeout)
+        finally:
+            self.send_mutex.release()
+        if err:
+            self._set_broken(f"send request failed: {msg}")
+
+    def forget_call(self, call_id):
+        """
+        不再接收某个调用的响应,后面收到的响应会被丢弃
+        """
+        self.mux_mutex.acquire()
+        self.call_dict.pop(call_id, None)
+        self.mux_mutex.release()
+
+    def add_stats(self, raw_send_bytes, send_bytes, raw_recv_bytes, recv_bytes):
+        self.stats_mutex.acquire()
+        try:
+            self.stats['call_count'] += 1
+            self.stats['raw_send_bytes'] += raw_send_bytes
+            self.stats['send_bytes'] += send_bytes
+            self.stats['raw_recv_bytes'] += raw_recv_bytes
+            self.stats['recv_bytes'] += recv_bytes
+        finally:
+            self.stats_mutex.release()
+
+    def get_stats(self):
+        """
+        获得连接的统计信息
+        :return: dict, 其中compress_ratio是压缩后的字节数与原始字节数之比
+        """
+        self.stats_mutex.acquire()
+        try:
+            stats = dict(self.stats)
+        finally:
+            self.stats_mutex.release()
+        raw_bytes = stats['raw_send_bytes'] + stats['raw_recv_bytes']
+        wire_bytes = stats['send_bytes'] + stats['recv_bytes']
+        stats['compress'] = self.zlib
+        stats['compress_ratio'] = round(wire_bytes / raw_bytes, 4) if raw_bytes else 1.0
+        return stats
+
+    def _set_broken(self, msg):
+        """
+        连接出错后,所有还在等待结果的调用都返回错误
+        """
+        self.mux_mutex.acquire()
+        try:
+            if not self.broken_msg:
+                self.broken_msg = msg
+            if self.resume_pending:
+                # 在收到CMD_RESUME的应答前连接就断开了(如老版本的服务端不认识此命令),也按票据被拒绝处理
+                self.resume_pending = False
+                self.resume_failed = True
+                _drop_ticket(self.ticket_key)
+            resume_failed = self.resume_failed
+            call_dict = self.call_dict
+            self.call_dict = {}
+        finally:
+            self.mux_mutex.release()
+        for future in call_dict.values():
+            future.resume_rejected = resume_failed and future.resubmit is not None
+            future.set_result(-1, msg, 0, b'', None, 0)
+
+    def _reader_run(self):
+        """
+        接收响应的线程,按响应中的call_id把结果交给对应的_CallFuture
+        """
+        sock = self.sock
+        # 整个连接使用同一个poll对象等待响应,没有select()对文件描述符不能大于等于1024的限制
+        poller = select.poll()
+        try:
+            poller.register(sock, select.POLLIN)
+        except (OSError, ValueError):  # socket已被关闭
+            self._set_broken('connection closed')
+            return
+        while True:
+            try:
+                # 等待响应到达,连接关闭时会shutdown此socket,这里会马上返回
+                poller.poll()
+            except OSError as e:
+                self._set_broken(repr(e))
+                return
+            try:
+                err, msg, ret_code, call_id, flags, data, seg_list = cs_low_trans.recv_cmd_ex(sock, self.data_timeout)
+            except (OSError, ValueError):  # socket在其它线程中被关闭了
+                err, msg = -1, 'connection closed'
+            if err:
+                self._set_broken(msg if msg else 'connection closed')
+                return
+            if call_id == 0 and self.resume_pending:
+                # CMD_RESUME的应答,成功时带有新的票据,失败时服务端会马上关闭连接
+                self.mux_mutex.acquire()
+                self.resume_pending = False
+                self.resume_failed = bool(ret_code)
+                self.mux_mutex.release()
+                if ret_code:
+                    _drop_ticket(self.ticket_key)
+                else:
+                    _save_ticket(self.ticket_key, _parse_server_caps(data))
+                continue
+            is_stream = bool(flags & cs_low_trans.FLAG_STREAM)
+            self.mux_mutex.acquire()
+            if is_stream and not flags & cs_low_trans.FLAG_STREAM_END:
+                # 流式响应还有后续的数据块
+                future = self.call_dict.get(call_id)
+            else:
+                future = self.call_dict.pop(call_id, None)
+            self.mux_mutex.release()
+            if future is None:
+                continue
+            if is_stream:
+                future.add_chunk(ret_code, data, seg_list, flags)
+            else:
+                future.set_result(0, '', ret_code, data, seg_list, flags)
+
+    def close(self):
+        if self.sock is None:
+            return
+        if self.reader is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.sock.close()
+        self.sock = None
+
+
+class _CallFuture:
+    """
+    mux模式下一个调用的结果,通过get()获得结果,与_AsyncCallTask的用法相同
+    """
+
+    def __init__(self, trans, call_id, func_name):
+        self.trans = trans
+        self.call_id = call_id
+        self.func_name = func_name
+        self.event = threading.Event()
+        self.err = 0
+        self.msg = ''
+        self.ret_code = 0
+        self.ret_data = b''
+        self.seg_list = None
+        self.flags = 0
+        self.stream = None  # 服务端流式返回时,收到第一个数据块后创建
+        self.resubmit = None  # 在会话票据被确认前发出的调用,保存重发需要的参数
+        self.resume_rejected = False  # 会话票据被拒绝了,服务端没有执行此调用
+
+    def add_chunk(self, ret_code, data, seg_list, flags):
+        """
+        收到流式响应的一个数据块
+        """
+        if self.stream is None:
+            self.stream = _RpcStream(self.trans, self.call_id, self.func_name)
+            self.event.set()
+        self.stream.put(0, '', ret_code, data, seg_list, flags)
+
+    def set_result(self, err, msg, ret_code, ret_data, seg_list, flags):
+        if self.stream is not None:  # 流式响应的过程中连接断开了
+            self.stream.put(err, msg, ret_code, ret_data, seg_list, flags)
+            return
+        self.err = err
+        self.msg = msg
+        self.ret_code = ret_code
+        self.ret_data = ret_data
+        self.seg_list = seg_list
+        self.flags = flags
+        self.event.set()
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        等待调用结束,超时后不再接收此调用的响应
+        :return: (err, msg, ret_code, ret_data), 与cs_low_trans.send_cmd()的返回值相同,超时时err为1
+        """
+        if not self.event.wait(timeout):
+            self.trans.forget_call(self.call_id)
+            return 1, 'timeout', 0, b''
+        if self.resume_rejected:
+            self._resubmit(timeout)
+        return self.err, self.msg, self.ret_code, self.ret_data
+
+    def _resubmit(self, timeout):
+        """
+        会话票据被服务端拒绝时,重新做完整的验证后再发一次此调用,结果放到当前对象中
+        """
+        self.resume_rejected = False
+        data, cmd, flags, call_timeout, route_name = self.resubmit
+        try:
+            self.trans.resume_fallback()
+            if not self.trans.mux:
+                raise UserWarning("server does not support mux after reconnect")
+            future = self.trans.submit_call(self.func_name, data, cmd, flags, call_timeout, route_name)
+        except Exception as e:
+            self.err, self.msg = -1, str(e)
+            return
+        self.err, self.msg, self.ret_code, self.ret_data = future.wait(timeout)
+        self.seg_list = future.seg_list
+        self.flags = future.flags
+        self.stream = future.stream
+
+    def get(self, timeout=None):
+        """
+        获得调用的结果
+        :param timeout: 如果不设置,则一直等到用户端返回
+        :return: result, result是远程函数的返回值
+        """
+        if not self.event.wait(timeout):
+            raise CsuTimeoutError("Timeout: unable to obtain results within %s seconds" % timeout)
+        if self.resume_rejected:
+            self._resubmit(timeout)
+            if self.err == 1:
+                raise CsuTimeoutError("Timeout: unable to obtain results within %s seconds" % timeout)
+        if self.stream is not None:
+            return self.stream
+        if self.err:
+            raise RunError(self.msg)
+        if self.ret_code:
+            raise RunError(bytes(self.ret_data))
+        return _decode_payload(self.ret_data, self.seg_list, self.flags)
+
+
+class _RpcStream:
+    """
+    服务端函数返回生成器时,客户端得到的结果,可以像迭代器一样使用:
+    for item in c.read_file_iter(path):
+        ...
+    没有读完就不再需要时,需要调用close()通知服务端停止发送
+    """
+
+    def __init__(self, trans, call_id, func_name):
+        self.trans = trans
+        self.call_id = call_id
+        self.func_name = func_name
+        self.chunk_queue = queue.Queue()
+        self.consumed = 0  # 上次补充额度后消费的数据块个数
+        self.finished = False
+
+    def put(self, err, msg, ret_code, data, seg_list, flags):
+        self.chunk_queue.put((err, msg, ret_code, data, seg_list, flags))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        try:
+            err, msg, ret_code, data, seg_list, flags = self.chunk_queue.get(timeout=self.trans.call_timeout)
+        except queue.Empty:
+            self.close()
+            raise CsuTimeoutError(f"Timeout: no data of stream {self.func_name} within {self.trans.call_timeout} seconds")
+        if err:
+            self.finished = True
+            raise UserWarning(f"socket error: {msg}")
+        if flags & cs_low_trans.FLAG_STREAM_END:
+            self.finished = True
+            if ret_code:
+                raise UserWarning(bytes(data).decode())
+            raise StopIteration
+
+        self.consumed += 1
+        if self.consumed >= STREAM_WINDOW // 2:
+            self.trans.send_ex(CMD_STREAM_CREDIT, self.call_id, 0, struct.pack(stream_credit_fmt, self.consumed))
+            self.consumed = 0
+        return _decode_payload(data, seg_list, flags)
+
+    def close(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.trans.forget_call(self.call_id)
+        if not self.trans.broken_msg and self.trans.sock is not None:
+            self.trans.send_ex(CMD_STREAM_CREDIT, self.call_id, cs_low_trans.FLAG_STREAM_END, b'')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+        return False
 
 
 # 客户端异步调用时使用的线程
@@ -417,7 +2283,7 @@ class _AsyncCallTask(threading.Thread):
             self.result_queue.put((err, msg))
             return
         if ret_code:
-            self.result_queue.put((ret_code, ret_data))
+            self.result_queue.put((ret_code, bytes(ret_data)))
             return
         func_ret = pickle.loads(ret_data)
         self.result_queue.put((0, func_ret))
@@ -455,7 +2321,7 @@ def call_remote_func(trans, func_name, *args, **kwargs):
 
     call_timeout = trans.call_timeout
     sock = trans.sock
-    if logger.level <= logging.DEBUG:
+    if logger.isEnabledFor(logging.DEBUG):
         str_args = repr(args)
         if len(str_args) > DEBUG_LOG_MAX_LEN:
             str_args = str_args[:DEBUG_LOG_MAX_LEN] + " ... "
@@ -476,7 +2342,45 @@ def call_remote_func(trans, func_name, *args, **kwargs):
             async_mode = True
         del kwargs['async_mode']
 
-    if async_mode:  # 异步模式
+    # compress_mode=False时,本次调用不压缩,用于传输已经压缩过的数据
+    compress_mode = True
+    if 'compress_mode' in kwargs:
+        compress_mode = bool(kwargs['compress_mode'])
+        del kwargs['compress_mode']
+
+    start_time = time.time()
+    seg_list = None
+    ret_flags = 0
+    if trans.mux:  # 服务端支持多路复用,同一个连接上可以同时发起多个调用
+        use_zlib = trans.zlib and compress_mode
+        try:
+            flags, data, raw_len = _encode_payload([func_name, args, kwargs], trans.oob, use_zlib)
+        except Exception as e:
+            raise UserWarning(f"unsupport args type: {repr(e)}")
+        if trans.oob:
+            flags |= cs_low_trans.FLAG_ACCEPT_OOB
+        if use_zlib:
+            flags |= cs_low_trans.FLAG_ACCEPT_ZLIB
+        if trans.stream:
+            flags |= cs_low_trans.FLAG_ACCEPT_STREAM
+        future = trans.submit_call(func_name, data, flags=flags, timeout=call_timeout, route_name=func_name)
+        if async_mode:
+            return future
+        err, msg, ret_code, ret_data = future.wait(call_timeout)
+        req_len = _payload_len(data)
+        if future.stream is not None:
+            # 服务端函数返回的是生成器,数据块在迭代时才接收
+            client_stats.record_call(func_name, time.time() - start_time, False, req_len, 0)
+            return future.stream
+        seg_list = future.seg_list
+        ret_flags = future.flags
+        if not err:
+            recv_len = _payload_len(ret_data, seg_list)
+            if ret_flags & cs_low_trans.FLAG_ZLIB:
+                ret_data = zlib.decompress(ret_data)
+                ret_flags &= ~cs_low_trans.FLAG_ZLIB
+            trans.add_stats(raw_len, req_len, _payload_len(ret_data, seg_list), recv_len)
+    elif async_mode:  # 异步模式
         async_task = _AsyncCallTask(trans, func_name, *args, **kwargs)
         return async_task
     else:  # 同步模式
@@ -485,21 +2389,219 @@ def call_remote_func(trans, func_name, *args, **kwargs):
         except Exception as e:
             raise UserWarning(f"unsupport args type: {repr(e)}")
         err, msg, ret_code, ret_data = cs_low_trans.send_cmd(sock, CMD_CALL_FUNC, data, call_timeout)
-        if err:
-            raise UserWarning(f"socket error: {msg}")
-        if ret_code:
-            raise UserWarning(ret_data.decode())
-        func_ret = pickle.loads(ret_data)
-        if logger.level <= logging.DEBUG:
-            str_ret = repr(func_ret)
-            if len(str_ret) > DEBUG_LOG_MAX_LEN:
-                str_ret = str_ret[:DEBUG_LOG_MAX_LEN]
-            rpc_info = f"RETURN CALL RPC({trans.ip}:{trans.port}) : {func_name} :\n    return={str_ret}"
-            logger.debug(rpc_info)
-            if trans.msg_callback:
-                trans.msg_callback(rpc_info)
+        req_len = len(data)
+
+    resp_len = 0 if err else _payload_len(ret_data, seg_list)
+    client_stats.record_call(func_name, time.time() - start_time, bool(err or ret_code), req_len, resp_len)
+    if err:
+        raise UserWarning(f"socket error: {msg}")
+    if ret_code:
+        raise UserWarning(bytes(ret_data).decode())
+    func_ret = _decode_payload(ret_data, seg_list, ret_flags)
+    if logger.isEnabledFor(logging.DEBUG):
+        str_ret = repr(func_ret)
+        if len(str_ret) > DEBUG_LOG_MAX_LEN:
+            str_ret = str_ret[:DEBUG_LOG_MAX_LEN]
+        rpc_info = f"RETURN CALL RPC({trans.ip}:{trans.port}) : {func_name} :\n    return={str_ret}"
+        logger.debug(rpc_info)
+        if trans.msg_callback:
+            trans.msg_callback(rpc_info)
+
+    return func_ret
+
+
+def _parse_server_caps(reply_data):
+    """
+    从验证成功的回复中解析出服务端支持的功能,老版本的服务端没有带这些信息,返回空字典
+    :param reply_data: 验证成功时服务端回复的数据
+    :return: dict
+    """
+    pos = reply_data.find(b'\n')
+    if pos < 0:
+        return {}
+    try:
+        caps = json.loads(bytes(reply_data[pos + 1:]).decode('utf-8'))
+    except ValueError:
+        return {}
+    if not isinstance(caps, dict):
+        return {}
+    return caps
+
+
+class _BatchItem:
+    """
+    批量调用中的一个调用,批量调用执行完后通过get()获得结果
+    """
+
+    def __init__(self, func_name):
+        self.func_name = func_name
+        self.executed = False
+        self.ret_code = 0
+        self.ret = None
+
+    def set_result(self, ret_code, ret):
+        self.executed = True
+        self.ret_code = ret_code
+        self.ret = ret
+
+    def get(self):
+        """
+        获得调用的结果
+        :return: 远程函数的返回值,调用失败或者没有执行时抛出RunError
+        """
+        if not self.executed:
+            raise RunError(f"{self.func_name} not executed")
+        if self.ret_code:
+            raise RunError(self.ret)
+        return self.ret
+
+
+class _CallBatch:
+    """
+    批量调用,在一个请求中执行多个调用,使用方法:
+    with client.batch() as b:
+        r1 = b.os_path_exists('/tmp')
+        r2 = b.call('read_config_file_items', '/etc/xx.conf', ['port'])
+    print(r1.get(), r2.get())
+    也可以不用with,调用run()执行,run()返回[(ret_code, ret), ...]
+    """
+
+    def __init__(self, client, parallel=False, stop_on_error=False, call_timeout=None):
+        """
+        :param parallel: 是否在服务端并行执行各个调用
+        :param stop_on_error: 串行执行时,某个调用失败后是否不再执行后面的调用
+        :param call_timeout: 整个批量调用的超时时间,不设置时使用连接上的调用超时
+        """
+        self.client = client
+        self.parallel = parallel
+        self.stop_on_error = stop_on_error
+        self.call_timeout = call_timeout
+        self.call_list = []
+        self.item_list = []
+
+    def call(self, func_name, *args, **kwargs):
+        self.call_list.append((func_name, args, kwargs))
+        item = _BatchItem(func_name)
+        self.item_list.append(item)
+        return item
+
+    def __getattr__(self, method):
+        if method[0] == '_':
+            raise AttributeError(method)
+        return lambda *args, **kwargs: self.call(method, *args, **kwargs)
+
+    def run(self):
+        """
+        执行批量调用,服务端不支持批量调用时,在客户端逐个调用
+        :return: list, 与调用一一对应的(ret_code, ret),ret_code不为0时ret是错误信息
+        """
+        call_list = self.call_list
+        item_list = self.item_list
+        self.call_list = []
+        self.item_list = []
+        if not call_list:
+            return []
+
+        trans = self.client.trans
+        if trans.mux and self.client.server_caps.get('batch'):
+            try:
+                flags, data, _raw_len = _encode_payload([self.parallel, self.stop_on_error, call_list],
+                                                        trans.oob, trans.zlib)
+            except Exception as e:
+                raise UserWarning(f"unsupport args type: {repr(e)}")
+            if trans.oob:
+                flags |= cs_low_trans.FLAG_ACCEPT_OOB
+            if trans.zlib:
+                flags |= cs_low_trans.FLAG_ACCEPT_ZLIB
+            call_timeout = self.call_timeout if self.call_timeout is not None else trans.call_timeout
+            route_name = ','.join([item[0] for item in call_list])
+            future = trans.submit_call('<batch>', data, cmd=CMD_CALL_BATCH, flags=flags, timeout=call_timeout,
+                                       route_name=route_name)
+            err, msg, ret_code, ret_data = future.wait(call_timeout)
+            if err:
+                raise UserWarning(f"socket error: {msg}")
+            if ret_code:
+                raise UserWarning(bytes(ret_data).decode())
+            ret_list = _decode_payload(ret_data, future.seg_list, future.flags)
+        else:
+            ret_list = []
+            for func_name, args, kwargs in call_list:
+                try:
+                    ret_list.append((0, call_remote_func(trans, func_name, *args, **kwargs)))
+                except UserWarning as e:
+                    ret_list.append((1, str(e)))
+                    if self.stop_on_error:
+                        break
+            ret_list += [None] * (len(call_list) - len(ret_list))
+
+        result_list = []
+        for item, ret in zip(item_list, ret_list):
+            if ret is None:
+                result_list.append((-1, f"{item.func_name} not executed"))
+                continue
+            item.set_result(*ret)
+            result_list.append(ret)
+        return result_list
+
+    def __enter__(self):
+        return self
 
-        return func_ret
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.run()
+        return False
+
+
+# 客户端缓存的服务端函数列表: (ip, port, version) -> (catalog_hash, set(函数名))
+_catalog_cache = {}
+_catalog_lock = threading.Lock()
+
+# 客户端缓存的会话票据: (ip, port, 密码的hash) -> (票据, 本地的过期时间, 服务端支持的功能)
+_ticket_cache = {}
+_ticket_lock = threading.Lock()
+
+
+def _save_ticket(ticket_key, caps):
+    """
+    缓存服务端在验证成功时给的会话票据,以及服务端支持的功能,用票据恢复验证时没有这些信息
+    """
+    ticket_hex = caps.pop('ticket', None)
+    ticket_ttl = caps.pop('ticket_ttl', 0)
+    if ticket_key is None or not ticket_hex or not ticket_ttl:
+        return
+    try:
+        ticket = bytes.fromhex(ticket_hex)
+    except (TypeError, ValueError):
+        return
+    # 提前一点过期,避免票据在传输的过程中过期
+    expire_time = time.time() + ticket_ttl * 0.9
+    _ticket_lock.acquire()
+    _ticket_cache[ticket_key] = (ticket, expire_time, dict(caps))
+    _ticket_lock.release()
+
+
+def _get_ticket(ticket_key):
+    """
+    获得还没有过期的会话票据
+    :return: (ticket, caps), 没有时返回(None, None)
+    """
+    _ticket_lock.acquire()
+    try:
+        item = _ticket_cache.get(ticket_key)
+        if item is None:
+            return None, None
+        if item[1] < time.time():
+            del _ticket_cache[ticket_key]
+            return None, None
+        return item[0], dict(item[2])
+    finally:
+        _ticket_lock.release()
+
+
+def _drop_ticket(ticket_key):
+    _ticket_lock.acquire()
+    _ticket_cache.pop(ticket_key, None)
+    _ticket_lock.release()
 
 
 class Client:
@@ -508,10 +2610,17 @@ class Client:
     c = Client():
     c.connect("tcp://127.0.0.1:4242")
     c.my_func()
+    本机的服务也可以通过unix套接字连接,这时不需要密码: c.connect("unix:///run/csurpc.sock")
     异步模式:
     rs = c.hello('hello', 'world', async_mode=True)
     ret = rs.get(10)
-    注意即使在异步模式下,对同一个连接也只能同时发一个请求,不能同时发多个请求,如果需要同时发多个请求,请建多个连接
+    如果服务端支持多路复用(事件循环模式的服务端),同一个连接上可以同时发起多个异步请求,也可以在多个线程中同时调用,
+    否则对同一个连接也只能同时发一个请求,不能同时发多个请求,如果需要同时发多个请求,请建多个连接
+    批量调用,多个调用在一次网络往返中完成:
+    with c.batch() as b:
+        r1 = b.func1('a')
+        r2 = b.func2('b')
+    ret1 = r1.get()
     """
 
     def __init__(self, call_timeout=300, msg_callback=None):
@@ -519,45 +2628,147 @@ class Client:
         self.mutex = threading.Lock()
         self.conn_timeout = 300
         self.msg_callback = msg_callback
+        self.server_caps = {}
+        self.protocol = 'tcp'
+        self.compress = False
+        self.func_set = None  # 服务端的函数名集合,第一次用到时才获取
 
-    def connect(self, conn_url, password='cstechRpc', conn_timeout=10, data_timeout=300):
+    def connect(self, conn_url, password='cstechRpc', conn_timeout=10, data_timeout=300, compress=False):
         """
         s.bind('tcp://127.0.0.1:4242')
-        :param conn_url:
-        :param password:
+        :param conn_url: 如tcp://127.0.0.1:4242或unix:///run/csurpc.sock
+        :param password: 使用unix套接字时服务端用SO_PEERCRED验证,不需要密码
         :param timeout: 注意是连接超时,不是调用超时
+        :param compress: 是否压缩传输的数据,只有服务端支持时才会压缩,单次调用可以用compress_mode=False关闭压缩
         :return:
         """
         self.conn_timeout = conn_timeout
         self.data_timeout = data_timeout
+        self.compress = compress
 
         protocol, ip, port = parse_connect_url(conn_url)
-        if protocol != 'tcp':
-            raise Exception("Unsupported protocol:%s" % protocol)
+        self.protocol = protocol
         self.trans.ip = ip
         self.trans.port = port
-        err, msg, self.trans.sock = cs_low_trans.connect(ip, port, password, conn_timeout, data_timeout)
+        self.trans.data_timeout = data_timeout
+        if protocol == 'unix':
+            self._connect_auth(password)
+            return
+        self.trans.ticket_key = (ip, port, hashlib.sha256(password.encode('utf-8')).hexdigest())
+        self.trans.resume_fallback = lambda: self._reauth(password)
+
+        # 有之前连接时得到的会话票据时,不用等验证结果,发出票据后马上就可以发调用
+        ticket, caps = _get_ticket(self.trans.ticket_key)
+        if ticket is not None:
+            err, _msg, sock = cs_low_trans.connect_resume(ip, port, password, ticket, conn_timeout, data_timeout)
+            if not err:
+                self.trans.sock = sock
+                self._set_server_caps(caps)
+                self.trans.mux_mutex.acquire()
+                self.trans.resume_pending = True
+                self.trans.start_reader()
+                self.trans.mux_mutex.release()
+                return
+        self._connect_auth(password)
+
+    def _connect_auth(self, password):
+        """
+        连接服务端并做完整的验证
+        """
+        trans = self.trans
+        if self.protocol == 'unix':
+            err, msg, trans.sock, reply_data = cs_low_trans.connect_unix(trans.ip, self.conn_timeout, self.data_timeout)
+        else:
+            err, msg, trans.sock, reply_data = cs_low_trans.connect_ex(trans.ip, trans.port, password,
+                                                                       self.conn_timeout, self.data_timeout)
         if err:
             raise Exception(msg)
+        caps = _parse_server_caps(reply_data)
+        _save_ticket(trans.ticket_key, caps)
+        self._set_server_caps(caps)
 
-        err, msg, ret_code, ret_data = cs_low_trans.send_cmd(self.trans.sock, CMD_FUNC_LIST, b'', data_timeout)
+    def _reauth(self, password):
+        """
+        会话票据被服务端拒绝后,关闭原来的连接,重新连接并做完整的验证
+        """
+        trans = self.trans
+        trans.resume_mutex.acquire()
+        try:
+            if not trans.resume_failed:  # 其它线程已经重新连接了
+                return
+            reader = trans.reader
+            trans.close()
+            if reader is not None:
+                reader.join(self.conn_timeout)
+            trans.reset_mux()
+            self._connect_auth(password)
+        finally:
+            trans.resume_mutex.release()
+
+    def _set_server_caps(self, caps):
+        """
+        根据服务端支持的功能设置传输的参数
+        """
+        ip, port, compress = self.trans.ip, self.trans.port, self.compress
+        self.server_caps = caps
+        self.trans.mux = bool(self.server_caps.get('mux'))
+        self.trans.oob = self.trans.mux and bool(self.server_caps.get('oob'))
+        self.trans.zlib = compress and self.trans.mux and bool(self.server_caps.get('zlib'))
+        self.trans.stream = self.trans.mux and bool(self.server_caps.get('stream'))
+        self.trans.deadline = self.trans.mux and bool(self.server_caps.get('deadline'))
+        self.trans.func_name = self.trans.mux and bool(self.server_caps.get('func_name'))
+
+        # 服务端返回的函数列表hash值与本地缓存的一致时,不需要再获取函数列表
+        self.func_set = None
+        catalog_hash = self.server_caps.get('catalog')
+        if catalog_hash:
+            _catalog_lock.acquire()
+            cache_item = _catalog_cache.get((ip, port, self.server_caps.get('version')))
+            _catalog_lock.release()
+            if cache_item and cache_item[0] == catalog_hash:
+                self.func_set = cache_item[1]
+
+    def _load_func_set(self):
+        """
+        从服务端获取函数列表,如果服务端有函数列表的hash值,则缓存起来
+        """
+        if self.trans.mux:
+            future = self.trans.submit_call('', b'', cmd=CMD_FUNC_LIST_EX)
+            err, msg, ret_code, ret_data = future.wait(self.data_timeout)
+        else:
+            err, msg, ret_code, ret_data = cs_low_trans.send_cmd(self.trans.sock, CMD_FUNC_LIST, b'', self.data_timeout)
         if err:
             raise Exception("socket error: %s" % msg)
         if ret_code:
             raise Exception("rpc error: %s" % ret_data)
 
         # 把远程服务中存在的函数名加到本地的类上,这样调用本地类上的函数,相当于调用了远程的函数
-        self.func_list = pickle.loads(ret_data)
+        func_set = frozenset(pickle.loads(ret_data))
+        catalog_hash = self.server_caps.get('catalog')
+        if catalog_hash:
+            _catalog_lock.acquire()
+            _catalog_cache[(self.trans.ip, self.trans.port, self.server_caps.get('version'))] = (catalog_hash, func_set)
+            _catalog_lock.release()
+        self.func_set = func_set
+
+    def get_stats(self):
+        """
+        获得此连接的传输统计信息,包括压缩率
+        """
+        return self.trans.get_stats()
+
+    def batch(self, parallel=False, stop_on_error=False, call_timeout=None):
+        """
+        创建一个批量调用,多个调用只需要一次网络往返,参数见_CallBatch
+        :return: _CallBatch对象
+        """
+        return _CallBatch(self, parallel, stop_on_error, call_timeout)
 
     def close(self):
-        if self.trans.sock is not None:
-            self.trans.sock.close()
-            self.trans.sock = None
+        self.trans.close()
 
     def __del__(self):
-        if self.trans.sock is not None:
-            self.trans.sock.close()
-            self.sock = None
+        self.trans.close()
 
     def __nonzero__(self):
         return True
@@ -566,7 +2777,16 @@ class Client:
         return call_remote_func(self.trans, method, *args, **kwargs)
 
     def __getattr__(self, method):
-        if method not in self.func_list:
+        if method[0] == '_':
+            raise AttributeError(method)
+        if self.func_set is None:
+            self.mutex.acquire()
+            try:
+                if self.func_set is None:
+                    self._load_func_set()
+            finally:
+                self.mutex.release()
+        if method not in self.func_set:
             raise Exception("function not support %s" % method)
         return lambda *args, **kargs: self(method, *args, **kargs)
 
@@ -579,8 +2799,6 @@ class Client:
 # 下面为测试代码                                                              #
 #############################################################################
 
-import time
-
 
 class _TestHandle:
     def __init__(self):
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+@Author: tangcheng
+@description: 基于asyncio的csurpc客户端,与csurpc.Client使用相同的协议,用于同时调用大量的agent
+"""
+
+import asyncio
+import hashlib
+import logging
+import pickle
+import struct
+
+import cs_low_trans
+import csurpc
+
+logger = logging.getLogger('csurpc')
+
+
+class AsyncClient:
+    """
+    使用方法:
+    c = AsyncClient()
+    await c.connect("tcp://127.0.0.1:4242")
+    ret = await c.my_func(1, 2)
+    ret = await c.call('my_func', 1, 2, call_timeout=5)
+    await c.close()
+    如果服务端支持多路复用,同一个连接上可以同时发起多个调用,否则同一个连接上的调用会排队执行
+    """
+
+    def __init__(self, call_timeout=300):
+        self.call_timeout = call_timeout
+        self.data_timeout = 300
+        self.ip = None
+        self.port = None
+        self.protocol = 'tcp'
+        self.reader = None
+        self.writer = None
+        self.server_caps = {}
+        self.mux = False
+        self.oob = False
+        self.zlib = False
+        self.deadline = False
+        self.func_name = False
+        self.next_call_id = 1
+        self.call_dict = {}  # call_id -> asyncio.Future, 等待响应的调用
+        self.reader_task = None
+        self.lock = None  # 不支持多路复用时,同一时间只能有一个调用
+        self.broken_msg = ''
+
+    async def connect(self, conn_url, password='cstechRpc', conn_timeout=10, data_timeout=300, compress=False):
+        """
+        连接服务端并做验证,验证方法与cs_low_trans.connect_ex()相同
+        :param conn_url: 如tcp://127.0.0.1:4242或unix:///run/csurpc.sock
+        :param password: 使用unix套接字时服务端用SO_PEERCRED验证,不需要密码
+        :param conn_timeout: 连接超时,包括验证的时间
+        :param data_timeout: 接收一个数据包的超时时间
+        :param compress: 是否压缩传输的数据,只有服务端支持时才会压缩
+        :return:
+        """
+        protocol, ip, port = csurpc.parse_connect_url(conn_url)
+        self.protocol = protocol
+        self.ip = ip
+        self.port = port
+        self.data_timeout = data_timeout
+        try:
+            reply_data = await asyncio.wait_for(self._connect_and_auth(password), conn_timeout)
+        except asyncio.TimeoutError:
+            self._close_writer()
+            raise Exception(f"connect {ip}:{port} timeout")
+        except Exception:
+            self._close_writer()
+            raise
+
+        self.server_caps = csurpc._parse_server_caps(reply_data)
+        self.mux = bool(self.server_caps.get('mux'))
+        self.oob = self.mux and bool(self.server_caps.get('oob'))
+        self.zlib = compress and self.mux and bool(self.server_caps.get('zlib'))
+        self.deadline = self.mux and bool(self.server_caps.get('deadline'))
+        self.func_name = self.mux and bool(self.server_caps.get('func_name'))
+        if self.mux:
+            self.reader_task = asyncio.ensure_future(self._reader_run())
+        else:
+            self.lock = asyncio.Lock()
+
+    async def _connect_and_auth(self, password):
+        """
+        建立连接并验证,验证成功后返回服务端回复的数据
+        """
+        if self.protocol == 'unix':
+            # 服务端用SO_PEERCRED验证,连接后直接回复验证结果
+            self.reader, self.writer = await asyncio.open_unix_connection(self.ip)
+            ret_code, ret_data = await self._read_legacy()
+            if ret_code:
+                raise Exception(ret_data.decode())
+            return ret_data
+        self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+        raw = await self.reader.readexactly(cs_low_trans.magic_len + 64)
+        if raw[:cs_low_trans.magic_len] != cs_low_trans.magic:
+            raise Exception('Invalid packet format!')
+
+        random_str = raw[cs_low_trans.magic_len:]
+        hash_str = hashlib.sha256(password.encode('utf-8') + random_str).hexdigest()
+        self._write_legacy(cs_low_trans.CMD_AUTH, cs_low_trans.magic + hash_str.encode('utf-8'))
+        ret_code, ret_data = await self._read_legacy()
+        if ret_code:
+            raise Exception(ret_data.decode())
+        return ret_data
+
+    def _write_legacy(self, cmd, data):
+        header = struct.pack(cs_low_trans.header_fmt, cs_low_trans.magic, cmd, len(data))
+        self.writer.writelines([header, data])
+
+    async def _read_header(self):
+        raw = await self.reader.readexactly(cs_low_trans.header_len)
+        recv_magic, cmd, len_data = struct.unpack(cs_low_trans.header_fmt, raw)
+        if recv_magic != cs_low_trans.magic:
+            raise Exception('Invalid packet format!')
+        return cmd, len_data
+
+    async def _read_legacy(self):
+        ret_code, len_data = await asyncio.wait_for(self._read_header(), self.data_timeout)
+        ret_data = await asyncio.wait_for(self.reader.readexactly(len_data), self.data_timeout)
+        return ret_code, ret_data
+
+    async def _read_frame_ex(self):
+        """
+        读取一个带扩展头的响应,格式与cs_low_trans.recv_cmd_ex()相同
+        :return: (ret_code, call_id, flags, data, seg_list)
+        """
+        ret_code, len_data = await self._read_header()
+        if len_data < cs_low_trans.ext_header_len:
+            raise Exception('Invalid packet format: ext header too short!')
+        raw = await self.reader.readexactly(cs_low_trans.ext_header_len)
+        call_id, flags = struct.unpack(cs_low_trans.ext_header_fmt, raw)
+        left_len = len_data - cs_low_trans.ext_header_len
+
+        seg_len_list = []
+        if flags & cs_low_trans.FLAG_OOB:
+            raw = await self.reader.readexactly(cs_low_trans.oob_count_len)
+            count, = struct.unpack(cs_low_trans.oob_count_fmt, raw)
+            left_len -= cs_low_trans.oob_count_len + count * cs_low_trans.oob_seg_len_len
+            raw = await self.reader.readexactly(count * cs_low_trans.oob_seg_len_len)
+            left_len, seg_len_list = cs_low_trans.parse_oob_table(raw, count, left_len)
+        data = b''
+        if left_len > 0:
+            data = await self.reader.readexactly(left_len)
+        seg_list = []
+        for seg_len in seg_len_list:
+            seg_list.append(bytearray(await self.reader.readexactly(seg_len)))
+        return ret_code, call_id, flags, data, seg_list
+
+    async def _reader_run(self):
+        """
+        多路复用模式下,接收响应并按call_id交给等待的调用
+        """
+        try:
+            while True:
+                ret_code, call_id, flags, data, seg_list = await self._read_frame_ex()
+                future = self.call_dict.pop(call_id, None)
+                # 已经超时的调用,响应直接丢弃
+                if future is not None and not future.done():
+                    future.set_result((ret_code, flags, data, seg_list))
+        except asyncio.CancelledError:
+            self._set_broken('connection closed')
+            raise
+        except Exception as e:
+            if isinstance(e, asyncio.IncompleteReadError):
+                msg = 'connection closed by peer'
+            else:
+                msg = str(e)
+            self._set_broken(msg)
+
+    def _set_broken(self, msg):
+        if not self.broken_msg:
+            self.broken_msg = msg
+        call_dict = self.call_dict
+        self.call_dict = {}
+        for future in call_dict.values():
+            if not future.done():
+                future.set_exception(UserWarning(f"socket error: {self.broken_msg}"))
+        self._close_writer()
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def call(self, func_name, *args, call_timeout=None, compress_mode=True, **kwargs):
+        """
+        调用远程的函数
+        :param func_name: 远程的函数名
+        :param call_timeout: 本次调用的超时时间,为None时使用AsyncClient的call_timeout
+        :param compress_mode: 为False时本次调用不压缩
+        :return: 远程函数的返回值
+        """
+        if call_timeout is None:
+            call_timeout = self.call_timeout
+        if self.writer is None:
+            raise UserWarning(f"socket error: {self.broken_msg or 'not connected'}")
+
+        if self.mux:
+            use_zlib = self.zlib and compress_mode
+            try:
+                flags, data, _raw_len = csurpc._encode_payload([func_name, args, kwargs], self.oob, use_zlib)
+            except Exception as e:
+                raise UserWarning(f"unsupport args type: {repr(e)}")
+            if self.oob:
+                flags |= cs_low_trans.FLAG_ACCEPT_OOB
+            if use_zlib:
+                flags |= cs_low_trans.FLAG_ACCEPT_ZLIB
+            buf_list = data if isinstance(data, list) else [data]
+            if self.func_name:
+                name_list = cs_low_trans.pack_func_name(buf_list, func_name)
+                if name_list is not None:
+                    flags |= cs_low_trans.FLAG_FUNC_NAME
+                    buf_list = name_list
+            if self.deadline:
+                flags |= cs_low_trans.FLAG_DEADLINE
+                buf_list = cs_low_trans.pack_deadline(buf_list, call_timeout)
+            data_len = sum([memoryview(buf).nbytes for buf in buf_list])
+
+            call_id = self.next_call_id
+            self.next_call_id += 1
+            future = asyncio.get_running_loop().create_future()
+            self.call_dict[call_id] = future
+            header = struct.pack(cs_low_trans.header_fmt + "QI", cs_low_trans.magic, csurpc.CMD_CALL_FUNC_EX,
+                                 cs_low_trans.ext_header_len + data_len, call_id, flags)
+            self.writer.writelines([header] + buf_list)
+            try:
+                await asyncio.wait_for(self.writer.drain(), call_timeout)
+                ret_code, ret_flags, ret_data, seg_list = await asyncio.wait_for(future, call_timeout)
+            except asyncio.TimeoutError:
+                self.call_dict.pop(call_id, None)
+                raise UserWarning(f"call {func_name} timeout({call_timeout}s)")
+            except (ConnectionError, OSError) as e:
+                self._set_broken(str(e))
+                raise UserWarning(f"socket error: {self.broken_msg}")
+        else:
+            try:
+                data = pickle.dumps([func_name, args, kwargs])
+            except Exception as e:
+                raise UserWarning(f"unsupport args type: {repr(e)}")
+            async with self.lock:
+                if self.writer is None:
+                    raise UserWarning(f"socket error: {self.broken_msg}")
+                try:
+                    self._write_legacy(csurpc.CMD_CALL_FUNC, data)
+                    ret_code, ret_data = await asyncio.wait_for(self._read_legacy(), call_timeout)
+                except asyncio.TimeoutError:
+                    # 老协议中没有call_id,超时后连接上的数据已经对不上了,只能关闭连接
+                    self._set_broken(f"call {func_name} timeout({call_timeout}s)")
+                    raise UserWarning(self.broken_msg)
+                except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+                    self._set_broken(str(e) or 'connection closed by peer')
+                    raise UserWarning(f"socket error: {self.broken_msg}")
+            ret_flags = 0
+            seg_list = None
+
+        if ret_code:
+            raise UserWarning(bytes(ret_data).decode())
+        return csurpc._decode_payload(ret_data, seg_list, ret_flags)
+
+    async def close(self):
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+            self.reader_task = None
+        self._close_writer()
+
+    def __getattr__(self, method):
+        if method[0] == '_':
+            raise AttributeError(method)
+
+        async def _remote_func(*args, **kwargs):
+            return await self.call(method, *args, **kwargs)
+        return _remote_func
+
+    def __str__(self):
+        return f"csurpc_aio({self.ip}:{self.port})"
+
+
+async def broadcast_call(url_list, func_name, *args, password='cstechRpc', conn_timeout=10, call_timeout=60,
+                         max_concurrency=512, **kwargs):
+    """
+    并发的连接多个服务端并调用同一个函数,总耗时约等于最慢的那个服务端的耗时
+    :param url_list: 服务端的地址列表,如['tcp://10.0.0.1:4243', 'tcp://10.0.0.2:4243']
+    :param func_name: 远程的函数名
+    :param password:
+    :param conn_timeout: 连接超时
+    :param call_timeout: 调用超时
+    :param max_concurrency: 同时进行的最大连接数,避免打开的文件句柄过多
+    :return: list, 与url_list一一对应的(err_code, data),err_code不为0时data为错误信息
+    """
+    sem = asyncio.Semaphore(max_concurrency)
+
+    async def _call_one(url):
+        async with sem:
+            client = AsyncClient(call_timeout=call_timeout)
+            try:
+                await client.connect(url, password=password, conn_timeout=conn_timeout, data_timeout=call_timeout)
+                ret = await client.call(func_name, *args, **kwargs)
+                return 0, ret
+            except Exception as e:
+                return -1, f"call {func_name} on {url} failed: {str(e)}"
+            finally:
+                await client.close()
+
+    return await asyncio.gather(*[_call_one(url) for url in url_list])
+
+
+def run_broadcast_call(url_list, func_name, *args, **kwargs):
+    """
+    在非asyncio的代码中调用broadcast_call()
+    :return: 同broadcast_call()
+    """
+    return asyncio.run(broadcast_call(url_list, func_name, *args, **kwargs))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding:UTF-8
+
+# Copyright (c) 2023 CSUDATA.COM and/or its affiliates.  All rights reserved.
+# CLup is licensed under AGPLv3.
+# See the GNU AFFERO GENERAL PUBLIC LICENSE v3 for more details.
+# You can use this software according to the terms and conditions of the AGPLv3.
+#
+# THIS SOFTWARE IS PROVIDED BY CSUDATA.COM "AS IS" AND ANY EXPRESS OR IMPLIED
+# WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, OR NON-INFRINGEMENT, ARE
+# DISCLAIMED.  IN NO EVENT SHALL CSUDATA.COM BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE
+# OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+@Author: tangcheng
+@description: RPC服务函数的结果缓存,用于只读且幂等的函数,如查询操作系统用户、查找pg软件目录等。
+使用方法:
+    class ServiceHandle:
+        @staticmethod
+        @rpc_cache.cached(ttl=10)
+        def pwd_getpwnam(os_user):
+            ...
+"""
+
+import collections
+import functools
+import pickle
+import threading
+import time
+
+# 每个函数最多缓存的结果个数,超过后淘汰最久没有用到的
+CACHE_MAX_SIZE = 256
+
+# 函数名 -> _TtlCache
+_cache_dict = {}
+_cache_dict_lock = threading.Lock()
+
+
+class _TtlCache:
+    """
+    一个函数的结果缓存: 按参数缓存结果,结果超过ttl秒后失效,个数超过max_size时淘汰最久没有用到的
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.mutex = threading.Lock()
+        self.item_dict = collections.OrderedDict()  # key -> (过期时间, 结果)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        :return: (found, ret)
+        """
+        self.mutex.acquire()
+        try:
+            item = self.item_dict.get(key)
+            if item is not None and item[0] < time.time():
+                del self.item_dict[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return False, None
+            self.item_dict.move_to_end(key)
+            self.hits += 1
+            return True, item[1]
+        finally:
+            self.mutex.release()
+
+    def put(self, key, ret):
+        self.mutex.acquire()
+        try:
+            self.item_dict[key] = (time.time() + self.ttl, ret)
+            self.item_dict.move_to_end(key)
+            while len(self.item_dict) > self.max_size:
+                self.item_dict.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self.mutex.release()
+
+    def clear(self):
+        self.mutex.acquire()
+        try:
+            count = len(self.item_dict)
+            self.item_dict.clear()
+        finally:
+            self.mutex.release()
+        return count
+
+    def get_stats(self, reset=False):
+        self.mutex.acquire()
+        try:
+            stats = {
+                "ttl": self.ttl,
+                "size": len(self.item_dict),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+            if reset:
+                self.hits = 0
+                self.misses = 0
+                self.evictions = 0
+        finally:
+            self.mutex.release()
+        return stats
+
+
+def _is_cacheable(ret):
+    """
+    返回(err_code, ...)的函数,只缓存成功的结果,如查询的用户不存在时,用户可能马上就会被创建
+    """
+    if isinstance(ret, tuple) and ret and isinstance(ret[0], int) and ret[0] != 0:
+        return False
+    return True
+
+
+def cached(ttl, max_size=CACHE_MAX_SIZE):
+    """
+    缓存函数结果的装饰器,缓存的key是参数pickle后的数据,参数不能pickle时不缓存。
+    注意缓存的结果会直接返回给多个调用者,调用者不能修改返回的对象
+    :param ttl: 结果的有效期,单位秒
+    :param max_size: 最多缓存的结果个数
+    """
+    def decorator(func):
+        cache = _TtlCache(ttl, max_size)
+        _cache_dict_lock.acquire()
+        _cache_dict[func.__name__] = cache
+        _cache_dict_lock.release()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                key = pickle.dumps((args, sorted(kwargs.items())), protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                return func(*args, **kwargs)
+            found, ret = cache.get(key)
+            if found:
+                return ret
+            ret = func(*args, **kwargs)
+            if _is_cacheable(ret):
+                cache.put(key, ret)
+            return ret
+
+        wrapper.rpc_cache = cache
+        return wrapper
+    return decorator
+
+
+def invalidate(func_name=None):
+    """
+    清除缓存的结果
+    :param func_name: 函数名,为空时清除所有函数的缓存
+    :return: 清除的结果个数
+    """
+    _cache_dict_lock.acquire()
+    if func_name:
+        cache_list = [_cache_dict[func_name]] if func_name in _cache_dict else []
+    else:
+        cache_list = list(_cache_dict.values())
+    _cache_dict_lock.release()
+    return sum([cache.clear() for cache in cache_list])
+
+
+def get_cache_stats(reset=False):
+    """
+    获得各个函数缓存的命中次数、未命中次数、淘汰次数和当前缓存的个数
+    :param reset: 获取后是否清零
+    :return: dict, 函数名 -> 统计信息
+    """
+    _cache_dict_lock.acquire()
+    cache_items = list(_cache_dict.items())
+    _cache_dict_lock.release()
+    return {func_name: cache.get_stats(reset) for func_name, cache in cache_items}
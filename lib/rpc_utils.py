@@ -23,11 +23,16 @@
 @description: rpc工具的库
 """
 
+import collections
 import logging
 import os
+import socket
+import threading
 import time
+import weakref
 # import traceback
 
+import cs_low_trans
 import csurpc
 
 import config
@@ -35,6 +40,214 @@ import config
 __server_address = None
 __get_server_address_time = 0
 
+# 连接池中每个对端最多保留的连接数
+POOL_MAX_SIZE = 8
+
+# 连接池中的连接空闲超过此时间(秒)后被关闭,需要小于服务端的空闲超时时间(300秒)
+POOL_IDLE_TIMEOUT = 60
+
+
+def _sock_is_alive(sock):
+    """
+    检查连接池中空闲的连接是否还可用: 空闲的连接上不应该有数据可读,如果可读,说明对端已关闭了连接或连接已不同步
+    """
+    try:
+        if not cs_low_trans.wait_readable(sock, 0):
+            return True
+        sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        return False
+    except (OSError, ValueError):
+        return False
+
+
+class _PooledClient:
+    """
+    从连接池中取出的连接,用法与csurpc.Client相同,但调用close()时会把连接放回连接池,而不是真正关闭。
+    没有调用close()就被丢弃时,由垃圾回收把连接交给连接池关闭并归还名额,这时不知道连接的状态,不放回连接池
+    """
+
+    def __init__(self, pool, key, client):
+        self._pool = pool
+        self._key = key
+        self._client = client
+        self._broken = False
+        self._finalizer = weakref.finalize(self, pool.discard, key, client)
+
+    def close(self):
+        client = self._client
+        if client is None:
+            return
+        self._client = None
+        self._finalizer.detach()
+        self._pool.release(self._key, client, self._broken)
+
+    def __call__(self, method, *args, **kwargs):
+        return self._call(self._client, method, *args, **kwargs)
+
+    def _call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except UserWarning as e:
+            # 远程函数本身抛出的异常不影响连接,只有socket出错时连接才不能再使用
+            if str(e).startswith('socket error'):
+                self._broken = True
+            raise
+        except Exception:
+            self._broken = True
+            raise
+
+    def __getattr__(self, name):
+        if self._client is None:
+            raise Exception(f"rpc connection({self._key[0]}:{self._key[1]}) has been closed")
+        attr = getattr(self._client, name)
+        if name[0] == '_' or not callable(attr):
+            return attr
+        return lambda *args, **kwargs: self._call(attr, *args, **kwargs)
+
+    def __str__(self):
+        return str(self._client)
+
+
+class _RpcConnPool:
+    """
+    rpc连接池,按(ip, port, password)缓存已验证过的连接,避免每次调用都要重新建连接和验证
+    """
+
+    def __init__(self, max_size=POOL_MAX_SIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle_dict = {}  # key -> [(client, release_time), ...]
+        self.count_dict = {}  # key -> 连接池管理的连接数(包括正在使用的)
+        # 没有调用close()就被丢弃的连接: [(key, client), ...]
+        # 垃圾回收可能发生在持有self.lock时,所以先放到这里,下次取或放回连接时再关闭
+        self.discard_queue = collections.deque()
+
+    def discard(self, key, client):
+        """
+        由_PooledClient的finalizer调用,不能加锁
+        """
+        self.discard_queue.append((key, client))
+
+    def _close_discarded(self):
+        """
+        关闭被丢弃的连接并归还名额,不能在持有锁时调用
+        """
+        while True:
+            try:
+                key, client = self.discard_queue.popleft()
+            except IndexError:
+                return
+            logging.warning(f"rpc connection to {key[0]}:{key[1]} was not closed, close it now.")
+            self.lock.acquire()
+            self.count_dict[key] -= 1
+            self.lock.release()
+            client.close()
+
+    def _evict_idle(self, curr_time):
+        """
+        关闭空闲时间过长的连接,需要在持有锁时调用,返回需要关闭的连接
+        """
+        evict_list = []
+        for key in list(self.idle_dict):
+            keep_list = []
+            for client, release_time in self.idle_dict[key]:
+                if curr_time - release_time > self.idle_timeout:
+                    evict_list.append(client)
+                    self.count_dict[key] -= 1
+                else:
+                    keep_list.append((client, release_time))
+            if keep_list:
+                self.idle_dict[key] = keep_list
+            else:
+                del self.idle_dict[key]
+        return evict_list
+
+    def get(self, ip, port, password):
+        """
+        从连接池中取一个可用的连接,没有可用的连接时新建一个
+        :return: _PooledClient对象
+        """
+        key = (ip, int(port), password)
+        close_list = []
+        client = None
+        self._close_discarded()
+        self.lock.acquire()
+        try:
+            close_list = self._evict_idle(time.time())
+            idle_list = self.idle_dict.get(key, [])
+            while idle_list:
+                tmp_client, _release_time = idle_list.pop()
+                trans = tmp_client.trans
+                if trans.sock is not None and not trans.broken_msg and _sock_is_alive(trans.sock):
+                    client = tmp_client
+                    break
+                # 连接已断开,丢弃后再取下一个
+                close_list.append(tmp_client)
+                self.count_dict[key] -= 1
+            if client is None:
+                # 先占一个名额,超过最大连接数的连接用完后直接关闭,不放回连接池
+                self.count_dict[key] = self.count_dict.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+        for tmp_client in close_list:
+            tmp_client.close()
+
+        if client is None:
+            try:
+                client = csurpc.Client()
+                # 跨机房等慢速链路上可以在clup-agent.conf中配置rpc_compress = 1,压缩传输的数据
+                compress = str(config.get('rpc_compress', '0')).strip() == '1'
+                client.connect(f"tcp://{ip}:{port}", password=password, compress=compress)
+            except Exception:
+                self.lock.acquire()
+                self.count_dict[key] -= 1
+                self.lock.release()
+                raise
+        return _PooledClient(self, key, client)
+
+    def release(self, key, client, broken):
+        """
+        把用完的连接放回连接池
+        """
+        self._close_discarded()
+        can_reuse = (not broken and client.trans.sock is not None and not client.trans.pending
+                     and not client.trans.broken_msg)
+        self.lock.acquire()
+        try:
+            if can_reuse and self.count_dict.get(key, 0) <= self.max_size:
+                self.idle_dict.setdefault(key, []).append((client, time.time()))
+                return
+            self.count_dict[key] -= 1
+        finally:
+            self.lock.release()
+        client.close()
+
+    def clear(self):
+        """
+        关闭连接池中所有空闲的连接
+        """
+        self.lock.acquire()
+        try:
+            close_list = []
+            for key, idle_list in self.idle_dict.items():
+                for client, _release_time in idle_list:
+                    close_list.append(client)
+                    self.count_dict[key] -= 1
+            self.idle_dict = {}
+        finally:
+            self.lock.release()
+        for client in close_list:
+            client.close()
+
+
+__rpc_pool = _RpcConnPool()
+
+
+def get_rpc_pool():
+    return __rpc_pool
+
 
 def get_server_address():
     return __server_address
@@ -77,8 +290,7 @@ def get_server_connect():
                 for host, port in host_list:
                     server_address = "%s:%d" % (host, port)
                     try:
-                        c1 = csurpc.Client()
-                        c1.connect("tcp://%s" % server_address, password=config.get('internal_rpc_pass'))
+                        c1 = __rpc_pool.get(host, port, config.get('internal_rpc_pass'))
                         rpc_conn_dict[host] = c1
                         primary_host, clup_host_list = c1.get_clup_node_info()
                         logging.debug(f"{host} return primary is {primary_host}, clup_host_list is {repr(clup_host_list)}.")
@@ -103,6 +315,8 @@ def get_server_connect():
                         actual_primary_host = host
                         break
                 if not actual_primary_host:
+                    for c1 in rpc_conn_dict.values():
+                        c1.close()
                     return -1, "Can not find primary clup!"
                 actual_primary_address = f"{actual_primary_host}:{primary_port}"
                 if __server_address is not None and actual_primary_address != __server_address:
@@ -117,8 +331,8 @@ def get_server_connect():
                 return 0, c1
         else:
             __server_address = str_server_address
-        c1 = csurpc.Client()
-        c1.connect("tcp://%s" % __server_address, password=config.get('internal_rpc_pass'))
+        host, port = __server_address.rsplit(':', 1)
+        c1 = __rpc_pool.get(host, port, config.get('internal_rpc_pass'))
         return 0, c1
     except Exception as e:
         return -1, "Can not connect clup: " + str(e)
@@ -128,9 +342,7 @@ def get_rpc_connect(ip, rpc_port=0):
     try:
         if not rpc_port:
             rpc_port = config.get('agent_rpc_port')
-        rpc_address = "tcp://%s:%s" % (ip, rpc_port)
-        c1 = csurpc.Client()
-        c1.connect(rpc_address, password=config.get('internal_rpc_pass'))
+        c1 = __rpc_pool.get(ip, rpc_port, config.get('internal_rpc_pass'))
         return 0, c1
     except Exception as e:
         return -1, "Can not connect %s: %s" % (ip, str(e))
@@ -142,8 +354,10 @@ def os_read_file(host, file_path, offset, data_len):
         logging.error(f"Can not connect {host}: maybe host is down.")
         return err_code, rpc
 
-    err_code, err_msg = rpc.os_read_file(file_path, offset, data_len)
-    rpc.close()
+    try:
+        err_code, err_msg = rpc.os_read_file(file_path, offset, data_len)
+    finally:
+        rpc.close()
     return err_code, err_msg
 
 
@@ -153,12 +367,12 @@ def pg_get_valid_wal_list_le_pt(host, pgdata, pt):
         logging.error(f"Can not connect to {host}: maybe host is down.")
         return err_code, rpc
 
-    err_code, err_msg = rpc.pg_get_valid_wal_list_le_pt(pgdata, pt)
-    if err_code != 0:
+    try:
+        err_code, err_msg = rpc.pg_get_valid_wal_list_le_pt(pgdata, pt)
+    finally:
         rpc.close()
+    if err_code != 0:
         logging.error(f"Call rpc pg_get_valid_wal_list_le_pt({pgdata}, {pt}) failed: {err_msg}.")
-        return err_code, err_msg
-    rpc.close()
     return err_code, err_msg
 
 
@@ -169,7 +383,9 @@ def task_insert_log(task_id, task_state, msg, task_type):
         logging.error(f"connect clup-server failed: {rpc}.")
         return err_code, rpc
 
-    ret = rpc.task_insert_log(task_id, task_state, msg, task_type)
-    rpc.close()
+    try:
+        ret = rpc.task_insert_log(task_id, task_state, msg, task_type)
+    finally:
+        rpc.close()
     return err_code, ret
 
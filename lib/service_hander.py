@@ -44,6 +44,7 @@ import long_term_cmd
 import mount_lib
 import pg_mgr
 import psutil
+import rpc_cache
 import run_lib
 import set_cfg_lib
 import utils
@@ -51,6 +52,61 @@ import version
 
 # import traceback
 
+# agent的RPC服务,用于获取RPC的统计信息
+_rpc_server = None
+
+# 默认的HA控制类调用,使用单独的线程池,不会排在文件传输等大数据量的调用后面,可以在clup-agent.conf中用rpc_lane_control_funcs修改
+DEFAULT_CONTROL_FUNCS = [
+    'vip_exists', 'check_and_add_vip', 'check_and_del_vip',
+    'pg_get_last_valid_wal_file', 'pg_get_valid_wal_list_le_pt',
+    'check_is_mount', 'check_and_mount', 'mount_dev', 'umount_dev',
+    'os_kill', 'get_agent_version', 'get_rpc_stats', 'invalidate_rpc_cache',
+]
+
+# 默认的大数据量调用,可以在clup-agent.conf中用rpc_lane_bulk_funcs修改
+DEFAULT_BULK_FUNCS = [
+    'os_write_file', 'os_read_file', 'os_read_file_iter', 'cft_batch_cmd', 'cft_write_block', 'cft_file_checksums',
+    'cft_get_manifest', 'chp_send_pipe_out_data', 'receive_file', 'extract_file', 'copy_file', 'pg_cp_delay_wal_from_pri',
+]
+
+# 默认合并并发调用的函数,故障切换时多个线程会同时调用这些函数,相同参数的调用只执行一次。
+# 只能是只读且幂等的函数,生成器函数(流式返回)不能合并,会被忽略。可以在clup-agent.conf中用rpc_coalesce_funcs修改
+DEFAULT_COALESCE_FUNCS = [
+    'vip_exists', 'pg_get_last_valid_wal_file', 'pg_get_valid_wal_list_le_pt', 'check_is_mount',
+    'check_os_env', 'get_pg_bin_path_list', 'get_data_disk_use',
+]
+
+
+def get_rpc_coalesce_funcs():
+    """
+    从配置文件中读取需要合并并发调用的函数,没有配置时使用默认值
+    :return: 函数名列表
+    """
+    str_funcs = str(config.get('rpc_coalesce_funcs', '')).strip()
+    if not str_funcs:
+        return DEFAULT_COALESCE_FUNCS
+    return [func_name.strip() for func_name in str_funcs.split(',') if func_name.strip()]
+
+
+def get_rpc_lanes():
+    """
+    从配置文件中读取RPC调用的类别,没有配置时使用默认值
+    :return: [(lane, thread_count, func_name_list), ...], 格式与csurpc.Server的lanes参数相同
+    """
+    lane_list = []
+    for lane, def_thread_count, def_func_list in [
+            (csurpc.LANE_CONTROL, 4, DEFAULT_CONTROL_FUNCS),
+            (csurpc.LANE_BULK, 6, DEFAULT_BULK_FUNCS)]:
+        str_funcs = str(config.get(f'rpc_lane_{lane}_funcs', '')).strip()
+        if str_funcs:
+            func_list = [func_name.strip() for func_name in str_funcs.split(',') if func_name.strip()]
+        else:
+            func_list = def_func_list
+        str_thread_count = str(config.get(f'rpc_lane_{lane}_threads', '')).strip()
+        thread_count = int(str_thread_count) if str_thread_count.isdigit() else def_thread_count
+        lane_list.append((lane, thread_count, func_list))
+    return lane_list
+
 
 def merge_handler(all_handler, prefix, handler):
     attr_name_list = dir(handler)
@@ -174,6 +230,26 @@ class ServiceHandle:
             if fd != -1:
                 os.close(fd)
 
+    @staticmethod
+    def os_read_file_iter(file_path, offset=0, read_len=-1, block_size=1024 * 1024):
+        """
+        分块读取指定的文件,服务端以流的方式返回,客户端得到一个迭代器,不需要每块发一次请求
+        :param read_len: 读取的长度,-1表示读到文件末尾
+        :return: 生成器,每次返回一块数据,出错时抛出异常
+        """
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while read_len != 0:
+                data = os.read(fd, block_size if read_len < 0 else min(block_size, read_len))
+                if not data:
+                    break
+                if read_len > 0:
+                    read_len -= len(data)
+                yield data
+        finally:
+            os.close(fd)
+
     @staticmethod
     def os_write_file(file_path, offset, data):
         """
@@ -364,6 +440,7 @@ class ServiceHandle:
         return 0, err_result
 
     @staticmethod
+    @rpc_cache.cached(ttl=5)
     def get_data_disk_use(directory):
         cmd = f"df {directory}"
         err_code, err_msg, out_msg = run_lib.run_cmd_result(cmd)
@@ -466,9 +543,31 @@ class ServiceHandle:
         return 0, ''
 
     @staticmethod
+    @rpc_cache.cached(ttl=300)
     def get_agent_version():
         return version.get_version()
 
+    @staticmethod
+    def get_rpc_stats(reset=False):
+        """
+        获得agent的RPC统计信息
+        :param reset: 获取后是否清零
+        :return: (0, {'server': 作为服务端的统计, 'client': 作为客户端调用其它agent或服务器的统计,
+                      'cache': 各个函数结果缓存的命中情况})
+        """
+        srv_stats = _rpc_server.get_stats(reset) if _rpc_server is not None else {}
+        return 0, {'server': srv_stats, 'client': csurpc.get_client_stats(reset),
+                   'cache': rpc_cache.get_cache_stats(reset)}
+
+    @staticmethod
+    def invalidate_rpc_cache(func_name=''):
+        """
+        清除函数结果的缓存,如在服务器上新建了用户后,清除pwd_getpwnam的缓存
+        :param func_name: 函数名,为空时清除所有函数的缓存
+        :return: (0, 清除的结果个数)
+        """
+        return 0, rpc_cache.invalidate(func_name)
+
     @staticmethod
     def chp_create_pipe_out_cmd(cmd_dict):
         return cross_host_pipe.create_pipe_out_cmd(cmd_dict)
@@ -497,13 +596,20 @@ class ServiceHandle:
 
 
     @staticmethod
-    def create_cft(src_dir, dst_host, dst_dir, task_id=None, big_file_size=768 * 1024, trans_block_size=512 * 1024):
-        return csu_file_trans.create_cft(src_dir, dst_host, dst_dir, task_id, big_file_size, trans_block_size)
+    def create_cft(src_dir, dst_host, dst_dir, task_id=None, big_file_size=768 * 1024, trans_block_size=512 * 1024,
+                   stream_count=None, range_size=csu_file_trans.CFT_RANGE_SIZE, delta_mode=False,
+                   skip_unchanged=False, delete_extra=False):
+        return csu_file_trans.create_cft(src_dir, dst_host, dst_dir, task_id, big_file_size, trans_block_size,
+                                         stream_count, range_size, delta_mode, skip_unchanged, delete_extra)
 
     @staticmethod
     def get_cft_state(cft_id):
         return csu_file_trans.get_cft_state(cft_id)
 
+    @staticmethod
+    def resume_cft(cft_id):
+        return csu_file_trans.resume_cft(cft_id)
+
     @staticmethod
     def remove_cft(cft_id):
         return csu_file_trans.remove_cft(cft_id)
@@ -516,6 +622,26 @@ class ServiceHandle:
     def set_file_attr(file_path, attr):
         return csu_file_trans.set_file_attr(file_path, attr)
 
+    @staticmethod
+    def cft_open_file(file_path):
+        return csu_file_trans.cft_open_file(file_path)
+
+    @staticmethod
+    def cft_write_block(handle, offset, data):
+        return csu_file_trans.cft_write_block(handle, offset, data)
+
+    @staticmethod
+    def cft_close_file(handle, attr=None, file_size=None):
+        return csu_file_trans.cft_close_file(handle, attr, file_size)
+
+    @staticmethod
+    def cft_file_checksums(file_path, block_size, offset=0, length=-1):
+        return csu_file_trans.cft_file_checksums(file_path, block_size, offset, length)
+
+    @staticmethod
+    def cft_get_manifest(dir_path):
+        return csu_file_trans.cft_get_manifest(dir_path)
+
     @staticmethod
     def check_port_used(port):
         """
@@ -536,6 +662,7 @@ class ServiceHandle:
             return 0
 
     @staticmethod
+    @rpc_cache.cached(ttl=30)
     def get_pg_bin_path_list(pg_bin_path_string_list):
         """ 获得pg软件的目录列表
 
@@ -613,6 +740,7 @@ class ServiceHandle:
 
 
     @staticmethod
+    @rpc_cache.cached(ttl=10)
     def pwd_getpwnam(os_user):
         try:
             pwd_entry = pwd.getpwnam(os_user)
@@ -655,6 +783,7 @@ class ServiceHandle:
             return -1, str(e)
 
     @staticmethod
+    @rpc_cache.cached(ttl=10)
     def grp_getgrall():
         try:
             grp_list = grp.getgrall()
@@ -850,17 +979,28 @@ class ServiceHandle:
 
 
 def run_service():
+    global _rpc_server
+
     try:
         agent_rpc_port = config.get('agent_rpc_port')
         all_handler = ServiceHandle()
         # all_handler = merge_handler(all_handler, 'cvault', handler_cvault)
 
+        str_thread_count = str(config.get('rpc_lane_query_threads', '')).strip()
+        thread_count = int(str_thread_count) if str_thread_count.isdigit() else 10
         srv = csurpc.Server('dbagent-service', all_handler, csuapp.is_exit,
                             password=config.get('internal_rpc_pass'),
-                            thread_count=10, debug=1)
+                            thread_count=thread_count, debug=1, use_epoll=True, version=version.get_version(),
+                            lanes=get_rpc_lanes(), coalesce_funcs=get_rpc_coalesce_funcs())
+        _rpc_server = srv
         agent_rpc_address = "tcp://0.0.0.0:%s" % agent_rpc_port
         logging.info(f"clup-agent listen in {agent_rpc_address}.")
         srv.bind(agent_rpc_address)
+        # 本机的客户端可以通过unix套接字连接,不走tcp协议栈,用SO_PEERCRED验证,不需要密码
+        agent_unix_socket = str(config.get('agent_unix_socket', '')).strip()
+        if agent_unix_socket:
+            logging.info(f"clup-agent listen in unix://{agent_unix_socket}.")
+            srv.bind(f"unix://{agent_unix_socket}")
         srv.run()
     except Exception as e:
         logging.error(f"rpc service stopped with unexpected error,{str(e)}.")